@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+bench_capture
+----------------------------------
+
+Cost and fidelity of capturing the traffic with an interpreter: the time
+of a raw REPL exchange without and with a capture, and of the same
+exchanges replayed from the capture in place of the interpreter.
+
+    $ python benchmarks/bench_capture.py --exe micropython --runs 200
+"""
+from __future__ import print_function
+import io
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from mpkernel import capture  # noqa: E402
+from unix.unix import MPUnixInterpreter  # noqa: E402
+
+CELL = 'x = [i * i for i in range(50)]\nprint(sum(x))'
+
+
+def exchanges(command, runs, recorder=None):
+    """Return the seconds of each exchange with an interpreter"""
+    interp = MPUnixInterpreter(command, capture=recorder)
+    try:
+        if not interp.enter_raw_repl():
+            raise RuntimeError('{} has no raw REPL'.format(command))
+        timings = []
+        for _ in range(runs):
+            start = time.time()
+            interp.exec_raw(CELL, io.StringIO())
+            timings.append(time.time() - start)
+        return timings
+    finally:
+        interp.child.close(force=True)
+        if recorder is not None:
+            recorder.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[-1])
+    parser.add_argument('--exe', default='micropython',
+                        help='micropython executable to benchmark')
+    parser.add_argument('--runs', type=int, default=200, help='exchanges timed')
+    args = parser.parse_args()
+
+    tmp = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmp, 'bench.mpkcap')
+        replay = '{} -m mpkernel.capture replay {}'.format(sys.executable, path)
+        print('{:>12} {:>10} {:>10}'.format('', 'ms median', 'ms total'))
+        for name, run in [('plain', lambda: exchanges(args.exe, args.runs)),
+                          ('captured', lambda: exchanges(args.exe, args.runs,
+                                                         capture.Capture(path))),
+                          ('replayed', lambda: exchanges(replay, args.runs))]:
+            timings = sorted(run())
+            print('{:>12} {:>10.3f} {:>10.1f}'.format(
+                name, timings[len(timings) // 2] * 1e3, sum(timings) * 1e3))
+        print('\n{} bytes captured\n'.format(os.path.getsize(path)))
+        print(capture.format_summary(capture.summary(capture.load(path))))
+    finally:
+        shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+bench_interrupt
+----------------------------------
+
+Time from an interrupt to the prompt returning while MPKernelUnix follows a
+running cell from the IOLoop, at the normal prompt and in the raw REPL.
+
+    $ python benchmarks/bench_interrupt.py --exe micropython
+"""
+from __future__ import print_function
+import io
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from tornado.ioloop import IOLoop  # noqa: E402
+from mpkernel.repl import RawReplReader  # noqa: E402
+from unix.unix import MPUnixInterpreter  # noqa: E402
+
+BUSY = 'while True:\n    pass\n'
+
+
+async def interrupt_once(interp, delay):
+    """Start a busy loop, interrupt it after ``delay`` seconds and return
+    the seconds until the prompt is back"""
+    if interp.raw:
+        interp.send_raw(BUSY, timeout=5)
+        reader = RawReplReader()
+    else:
+        interp.run_command('c = compile({0!r}, "bench", "exec")'.format(BUSY), timeout=5)
+        reader = interp.send_line('exec(c)')
+    done = interp.follow_async(reader, io.StringIO())
+    sent = []
+
+    def interrupt():
+        sent.append(time.time())
+        interp.child.sendintr()
+
+    IOLoop.current().call_later(delay, interrupt)
+    await done
+    return time.time() - sent[0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[-1])
+    parser.add_argument('--exe', default='micropython',
+                        help='micropython executable to benchmark')
+    parser.add_argument('--repeat', type=int, default=50,
+                        help='interrupts per mode')
+    parser.add_argument('--delay', type=float, default=0.05,
+                        help='seconds the busy loop runs before each interrupt')
+    args = parser.parse_args()
+
+    friendly = MPUnixInterpreter(args.exe)
+    raw = MPUnixInterpreter(args.exe)
+    modes = [('prompt', friendly)]
+    if raw.enter_raw_repl():
+        modes.append(('raw', raw))
+
+    print('{:>8} {:>10} {:>10} {:>10}'.format('mode', 'median ms', 'p95 ms', 'max ms'))
+    for name, interp in modes:
+        async def run():
+            return [await interrupt_once(interp, args.delay) for _ in range(args.repeat)]
+        times = sorted(IOLoop.current().run_sync(run))
+        print('{:>8} {:>10.2f} {:>10.2f} {:>10.2f}'.format(
+            name, times[len(times) // 2] * 1000,
+            times[int(len(times) * 0.95) - 1] * 1000, times[-1] * 1000))
+
+
+if __name__ == '__main__':
+    main()
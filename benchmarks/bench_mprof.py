@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+bench_mprof
+----------------------------------
+
+Overhead of the probes of %%mprof: the time of a cell run as it is, with a
+probe before each line and with one around each function, and the cost of a
+probe the profile measures on the interpreter.
+
+    $ python benchmarks/bench_mprof.py --exe micropython --calls 10000
+"""
+from __future__ import print_function
+import io
+import os
+import sys
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from mpkernel import mprof  # noqa: E402
+from mpkernel.repl import RecordFilter  # noqa: E402
+from unix.unix import MPUnixInterpreter  # noqa: E402
+
+CELL = """\
+def step(x):
+    y = x * 3
+    return y % 7
+total = 0
+for i in range({calls}):
+    total += step(i)
+"""
+
+# Times the cell as it is, in the interpreter's own ticks
+PLAIN = """\
+from time import ticks_us, ticks_diff
+_t = ticks_us()
+exec({code!r})
+print(ticks_diff(ticks_us(), _t))
+"""
+
+
+def run_plain(interp, code):
+    output = io.StringIO()
+    error = interp.exec_raw(PLAIN.format(code=code), output, timeout=600)
+    if error:
+        raise RuntimeError(error)
+    return int(output.getvalue().split()[-1]), None
+
+
+def run_profiled(interp, code, functions):
+    instrumented = mprof.Instrumented(code, functions)
+    probe = RecordFilter(io.StringIO(), mprof.MARKER, mprof.END)
+    error = interp.exec_raw(instrumented.program(), probe, timeout=600)
+    probe.close()
+    if error:
+        raise RuntimeError(error)
+    profile = instrumented.profile(probe.record)
+    return profile.elapsed, profile.probe_us
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[-1])
+    parser.add_argument('--exe', default='micropython',
+                        help='micropython executable to benchmark')
+    parser.add_argument('--calls', type=int, default=10000,
+                        help='calls of the function in the cell')
+    parser.add_argument('--repeat', type=int, default=3, help='runs of each, best kept')
+    args = parser.parse_args()
+
+    interp = MPUnixInterpreter(args.exe)
+    if not interp.enter_raw_repl():
+        print('{} has no raw REPL'.format(args.exe))
+        return
+    code = CELL.format(calls=args.calls)
+    print('{:>12} {:>10} {:>10} {:>12}'.format('', 'ms', 'x plain', 'us / probe'))
+    plain = None
+    for name, run in [('plain', lambda: run_plain(interp, code)),
+                      ('lines', lambda: run_profiled(interp, code, False)),
+                      ('functions', lambda: run_profiled(interp, code, True))]:
+        elapsed, probe_us = min(run() for _ in range(args.repeat))
+        plain = plain or elapsed
+        print('{:>12} {:>10.1f} {:>10.2f} {:>12}'.format(
+            name, elapsed / 1000.0, float(elapsed) / plain,
+            '' if probe_us is None else '{:.2f}'.format(probe_us)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+bench_mpy_cache
+----------------------------------
+
+Time per cell and free heap afterwards when cells are sent as source and
+compiled by micropython, compared with compiling them to .mpy on the host,
+with an empty cache (cold) and a populated one (warm).
+
+    $ python benchmarks/bench_mpy_cache.py --exe micropython --mpy-cross mpy-cross
+"""
+from __future__ import print_function
+import io
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from mpkernel import mpy  # noqa: E402
+from unix.unix import MPUnixInterpreter  # noqa: E402
+
+
+def make_cell(functions):
+    """Return a cell defining ``functions`` small functions"""
+    return ''.join('def f{0}(x):\n    return x * {0} + {0}\n'.format(i)
+                   for i in range(functions))
+
+
+def mem_free(interp):
+    """Return the free heap, without collecting first"""
+    out = io.StringIO()
+    interp.exec_raw("import gc\nprint(gc.mem_free() if hasattr(gc, 'mem_free') else '')", out)
+    value = out.getvalue().strip()
+    return int(value) if value else None
+
+
+def run(interp, command):
+    interp.exec_raw('import gc\ngc.collect()', io.StringIO())
+    start = time.time()
+    error = interp.exec_raw(command, io.StringIO(), timeout=30)
+    elapsed = time.time() - start
+    if error:
+        raise RuntimeError(error)
+    return elapsed, mem_free(interp)
+
+
+def measure(interp, cache, code, repeat):
+    """Return the median (host ms, device ms, free heap) of each path"""
+    results = {'source': [], 'mpy cold': [], 'mpy warm': []}
+    for _ in range(repeat):
+        results['source'].append((0.0,) + run(interp, code))
+        for path in ('mpy cold', 'mpy warm'):
+            if path == 'mpy cold':
+                shutil.rmtree(cache.directory)
+                os.makedirs(cache.directory)
+            source = mpy.cell_source(code)
+            start = time.time()
+            compiled = cache.compile(source)
+            host = time.time() - start
+            command = mpy.loader(os.path.dirname(compiled), cache.module_name(source))
+            results[path].append((host,) + run(interp, command))
+    medians = {}
+    for path, samples in results.items():
+        samples.sort(key=lambda s: s[0] + s[1])
+        medians[path] = samples[len(samples) // 2]
+    return medians
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[-1])
+    parser.add_argument('--exe', default='micropython',
+                        help='micropython executable to benchmark')
+    parser.add_argument('--mpy-cross', default='mpy-cross',
+                        help='mpy-cross executable, with any arguments')
+    parser.add_argument('--repeat', type=int, default=10,
+                        help='runs per cell size, the median is reported')
+    parser.add_argument('--functions', default='1,10,100,500',
+                        help='comma separated numbers of functions per cell')
+    args = parser.parse_args()
+
+    interp = MPUnixInterpreter(args.exe)
+    if not interp.enter_raw_repl():
+        sys.exit("{} has no raw REPL".format(args.exe))
+    tmp = tempfile.mkdtemp()
+    try:
+        cache = mpy.MpyCache(tmp, mpy_cross=args.mpy_cross)
+        print('{:>10} {:>8} {:>10} {:>10} {:>10} {:>10}'.format(
+            'path', 'bytes', 'host ms', 'device ms', 'total ms', 'mem free'))
+        for functions in [int(n) for n in args.functions.split(',')]:
+            code = make_cell(functions)
+            medians = measure(interp, cache, code, args.repeat)
+            for path in ('source', 'mpy cold', 'mpy warm'):
+                host, device, free = medians[path]
+                print('{:>10} {:>8} {:>10.2f} {:>10.2f} {:>10.2f} {:>10}'.format(
+                    path, len(code), host * 1000, device * 1000,
+                    (host + device) * 1000, 'n/a' if free is None else free))
+    finally:
+        shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+bench_parallel
+----------------------------------
+
+Time to run a cell for each of a set of inputs on pools of 1, 2 and 4
+interpreters with %%parallel, against a plain loop in the kernel's own
+interpreter, for a CPU-bound and a sleep-bound cell.
+
+    $ python benchmarks/bench_parallel.py --exe micropython --inputs 16
+"""
+from __future__ import print_function
+import os
+import sys
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from suite import KernelRun  # noqa: E402
+
+CELLS = {
+    'cpu': 'n = 0\nfor i in range({work}):\n    n += i * x\nresult = n\n',
+    'sleep': 'import time\ntime.sleep({work} / 1e6)\nresult = x\n',
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[-1])
+    parser.add_argument('--exe', default='micropython',
+                        help='micropython executable to benchmark')
+    parser.add_argument('--inputs', type=int, default=16, help='inputs the cell is run for')
+    parser.add_argument('--work', type=int, default=200000,
+                        help='loop iterations of the CPU-bound cell and microseconds '
+                             'of the sleep-bound one')
+    parser.add_argument('--workers', default='1,2,4',
+                        help='comma separated numbers of workers')
+    parser.add_argument('--verbose', action='store_true', help="show the kernel's log")
+    args = parser.parse_args()
+
+    run = KernelRun('unix', ['--MPKernelUnix.micropython_exe=' + args.exe], args.verbose)
+    try:
+        print('{:>8} {:>10} {:>10}'.format('cell', 'workers', 'seconds'))
+        for name, cell in sorted(CELLS.items()):
+            cell = cell.format(work=args.work)
+            loop = 'results = []\nfor x in range({}):\n{}    results.append(result)\n'.format(
+                args.inputs, ''.join('    ' + line + '\n' for line in cell.splitlines()))
+            print('{:>8} {:>10} {:>10.2f}'.format(name, 'loop', run.execute(loop)))
+            for workers in [int(n) for n in args.workers.split(',')]:
+                code = '%%parallel -n {} x in range({})\n{}'.format(workers, args.inputs, cell)
+                # The first run starts the workers
+                run.execute(code)
+                print('{:>8} {:>10} {:>10.2f}'.format(name, workers, run.execute(code)))
+    finally:
+        run.close()
+
+
+if __name__ == '__main__':
+    main()
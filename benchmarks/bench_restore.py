@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+bench_restore
+----------------------------------
+
+Time to rebuild an interpreter's state from a log of cells, replayed as the
+single program %restore sends against one raw REPL exchange per cell.
+
+    $ python benchmarks/bench_restore.py --exe micropython
+"""
+from __future__ import print_function
+import io
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from mpkernel.replay import CellLog  # noqa: E402
+from unix.unix import MPUnixInterpreter  # noqa: E402
+
+
+def make_log(cells):
+    log = CellLog(max_bytes=0)
+    for i in range(cells):
+        log.record('x{0} = {0}\ndef f{0}():\n    return x{0} * 2\n'.format(i))
+    return log
+
+
+def run_batched(interp, log):
+    output = io.StringIO()
+    interp.exec_raw(log.program(), output, timeout=60)
+    if log.replayed(output.getvalue()) is None:
+        raise RuntimeError('The replay did not finish')
+
+
+def run_per_cell(interp, log):
+    for code in log.cells:
+        interp.exec_raw(code, io.StringIO(), timeout=60)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[-1])
+    parser.add_argument('--exe', default='micropython',
+                        help='micropython executable to benchmark')
+    parser.add_argument('--cells', default='10,100,1000',
+                        help='comma separated numbers of cells in the log')
+    args = parser.parse_args()
+
+    interp = MPUnixInterpreter(args.exe)
+    if not interp.enter_raw_repl():
+        print('{} has no raw REPL'.format(args.exe))
+        return
+
+    print('{:>8} {:>10} {:>12} {:>12}'.format('cells', 'KB', 'batched ms', 'per cell ms'))
+    for cells in [int(n) for n in args.cells.split(',')]:
+        log = make_log(cells)
+        times = []
+        for run in (run_batched, run_per_cell):
+            interp.soft_reset()
+            start = time.time()
+            run(interp, log)
+            times.append(time.time() - start)
+        print('{:>8} {:>10.1f} {:>12.1f} {:>12.1f}'.format(
+            cells, log.size / 1024.0, times[0] * 1000, times[1] * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+bench_sync
+----------------------------------
+
+Time to bring a project of many modules up to date on the board after an edit
+to a few of them: %sync against copying every file again and against %put of
+every file, which skips unchanged files but hashes each one on the board, over
+a fake pyboard on a pseudo terminal.
+
+    $ python benchmarks/bench_sync.py --files 100 --size 2048 --baudrate 115200
+"""
+from __future__ import print_function
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'tests'))
+
+from stmhal import files, sync  # noqa: E402
+from stmhal.transport import SerialTransport  # noqa: E402
+from fake_pyboard import FakePyboard  # noqa: E402
+
+
+def make_project(src, count, size):
+    for i in range(count):
+        directory = os.path.join(src, 'pkg{}'.format(i % 10))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(os.path.join(directory, 'mod{}.py'.format(i)), 'w') as f:
+            f.write(('# module {}\n'.format(i) + 'x = 1\n' * size)[:size])
+
+
+def edit(src, count):
+    """Change ``count`` of the modules"""
+    for i in range(count):
+        with open(os.path.join(src, 'pkg{}'.format(i % 10), 'mod{}.py'.format(i)), 'a') as f:
+            f.write('y = {}\n'.format(time.time()))
+
+
+def put_all(transport, src, dest, force):
+    for root, _, names in os.walk(src):
+        directory = os.path.join(dest, os.path.relpath(root, src))
+        if not os.path.isdir(directory):
+            # The fake board shares the host's filesystem
+            os.makedirs(directory)
+        for name in names:
+            files.put(transport, os.path.join(root, name), os.path.join(directory, name),
+                      force=force)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[-1])
+    parser.add_argument('--files', type=int, default=100, help='modules in the project')
+    parser.add_argument('--size', type=int, default=2048, help='bytes per module')
+    parser.add_argument('--edits', type=int, default=2, help='modules changed each time')
+    parser.add_argument('--baudrate', type=int, default=115200,
+                        help='bits per second of the fake board, 0 for no limit')
+    parser.add_argument('--latency', type=float, default=0.002,
+                        help='seconds the fake board adds before each reply')
+    args = parser.parse_args()
+    tmp = tempfile.mkdtemp()
+    try:
+        src = os.path.join(tmp, 'src')
+        make_project(src, args.files, args.size)
+        cache = sync.SyncCache(os.path.join(tmp, 'cache.json'))
+        with FakePyboard(latency=args.latency, baudrate=args.baudrate) as board:
+            transport = SerialTransport(board.device, 0, chunk_delay=0)
+            try:
+                transport.enter_raw_repl()
+                start = time.time()
+                sync.sync(transport, src, os.path.join(tmp, 'synced'), cache=cache)
+                print('{:>32} {:>8.2f} s'.format('first %sync', time.time() - start))
+                for name, run in [
+                        ('%sync', lambda dest: sync.sync(transport, src, dest, cache=cache)),
+                        ('%put of every file', lambda dest: put_all(transport, src, dest, False)),
+                        ('copy every file again',
+                         lambda dest: put_all(transport, src, dest, True))]:
+                    dest = os.path.join(tmp, name.split()[0].strip('%'))
+                    # Up to date before the edit
+                    run(dest)
+                    edit(src, args.edits)
+                    start = time.time()
+                    run(dest)
+                    print('{:>32} {:>8.2f} s'.format(
+                        '{}, {} edited'.format(name, args.edits), time.time() - start))
+            finally:
+                transport.close()
+    finally:
+        shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+bench_timeit
+----------------------------------
+
+Timing a statement with %timeit, which loops on the interpreter and sends
+back the time of each repeat, against timing one raw REPL exchange per run
+of the statement on the host: the time taken to measure and what each
+reports per loop.
+
+    $ python benchmarks/bench_timeit.py --exe micropython --statement "x = [1] * 10"
+"""
+from __future__ import print_function
+import io
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from mpkernel import timeit  # noqa: E402
+from mpkernel.repl import RecordFilter  # noqa: E402
+from unix.unix import MPUnixInterpreter  # noqa: E402
+
+
+def device_timeit(interp, statement, repeat):
+    timing = timeit.Timeit('-r {} {}'.format(repeat, statement))
+    probe = RecordFilter(io.StringIO(), timeit.MARKER, timeit.END)
+    error = interp.exec_raw(timing.source, probe, timeout=600)
+    probe.close()
+    if error:
+        raise RuntimeError(error)
+    return timing.result(probe.record)
+
+
+def host_timeit(interp, statement, runs):
+    timings = []
+    for _ in range(runs):
+        start = time.time()
+        interp.exec_raw(statement, io.StringIO())
+        timings.append(int((time.time() - start) * 1e6))
+    return timeit.TimeitResult(1, timings, statement)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[-1])
+    parser.add_argument('--exe', default='micropython',
+                        help='micropython executable to benchmark')
+    parser.add_argument('--statement', default='x = [1] * 10', help='statement timed')
+    parser.add_argument('--repeat', type=int, default=7, help='repeats of %%timeit')
+    parser.add_argument('--runs', type=int, default=200, help='exchanges timed on the host')
+    args = parser.parse_args()
+
+    interp = MPUnixInterpreter(args.exe)
+    if not interp.enter_raw_repl():
+        print('{} has no raw REPL'.format(args.exe))
+        return
+    for name, measure in [('%timeit', lambda: device_timeit(interp, args.statement, args.repeat)),
+                          ('per exchange', lambda: host_timeit(interp, args.statement, args.runs))]:
+        start = time.time()
+        result = measure()
+        print('{} ({:.2f} s to measure):\n{}\n'.format(name, time.time() - start, result))
+
+
+if __name__ == '__main__':
+    main()
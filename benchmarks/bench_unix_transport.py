@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+bench_unix_transport
+----------------------------------
+
+Per-cell latency and throughput of the two ways MPKernelUnix runs a cell:
+the compile + exec round trips at the normal prompt, and a single raw REPL
+exchange.
+
+    $ python benchmarks/bench_unix_transport.py --exe micropython
+"""
+from __future__ import print_function
+import io
+import os
+import sys
+import time
+import signal
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from unix.unix import MPUnixInterpreter  # noqa: E402
+
+
+def make_cell(size):
+    """Return a cell of roughly ``size`` bytes of assignments"""
+    line = 'v = 1234567890\n'
+    return line * max(1, size // len(line))
+
+
+def run_compile_exec(interp, code):
+    interp.run_command("c = compile({0!r}, 'mpkernel', 'exec')".format(code))
+    interp.stream_command('exec(c)', io.StringIO())
+
+
+def run_raw(interp, code):
+    interp.exec_raw(code, io.StringIO())
+
+
+class Stalled(Exception):
+    pass
+
+
+def _stalled(signum, frame):
+    raise Stalled()
+
+
+def measure(run, interp, code, repeat, timeout):
+    times = []
+    for _ in range(repeat):
+        # A write can block forever once the pty is full, so use an alarm
+        # rather than the pexpect timeout
+        signal.alarm(timeout)
+        start = time.time()
+        try:
+            run(interp, code)
+        finally:
+            signal.alarm(0)
+        times.append(time.time() - start)
+    times.sort()
+    return times[len(times) // 2]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[-1])
+    parser.add_argument('--exe', default='micropython',
+                        help='micropython executable to benchmark')
+    parser.add_argument('--repeat', type=int, default=20,
+                        help='runs per cell size, the median is reported')
+    parser.add_argument('--sizes', default='64,1024,4096,16384,65536',
+                        help='comma separated cell sizes in bytes')
+    parser.add_argument('--timeout', type=int, default=10,
+                        help='seconds before a single run counts as stalled')
+    args = parser.parse_args()
+    signal.signal(signal.SIGALRM, _stalled)
+
+    compile_interp = MPUnixInterpreter(args.exe)
+    raw_interp = MPUnixInterpreter(args.exe)
+    paths = [('compile+exec', run_compile_exec, compile_interp)]
+    if raw_interp.enter_raw_repl():
+        paths.append(('raw', run_raw, raw_interp))
+    else:
+        print("{} has no raw REPL, only the compile+exec path is measured"
+              .format(args.exe))
+
+    print('{:>14} {:>8} {:>12} {:>12}'.format('path', 'bytes', 'latency ms', 'KB/s'))
+    for size in [int(s) for s in args.sizes.split(',')]:
+        code = make_cell(size)
+        for path in list(paths):
+            name, run, interp = path
+            try:
+                latency = measure(run, interp, code, args.repeat, args.timeout)
+            except Exception as e:
+                print('{:>14} {:>8} {:>12}'.format(name, len(code), 'failed'),
+                      type(e).__name__)
+                # The interpreter is in an unknown state, stop using it
+                paths.remove(path)
+                continue
+            print('{:>14} {:>8} {:>12.2f} {:>12.1f}'.format(
+                name, len(code), latency * 1000, len(code) / latency / 1024))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+bench_variables
+----------------------------------
+
+Time to copy an array of floats from the board to the host with %pull's
+binary frames, against printing it and parsing the text, over a fake pyboard
+on a pseudo terminal or a real board.
+
+    $ python benchmarks/bench_variables.py --baudrate 115200
+    $ python benchmarks/bench_variables.py --device /dev/ttyACM0
+"""
+from __future__ import print_function
+import io
+import os
+import ast
+import sys
+import time
+import argparse
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'tests'))
+
+from stmhal import variables  # noqa: E402
+from stmhal.transport import SerialTransport  # noqa: E402
+from fake_pyboard import FakePyboard  # noqa: E402
+
+
+def pull_text(transport, expression):
+    out = io.StringIO()
+    error = transport.exec_raw('print(list({}))'.format(expression), out, timeout=60)
+    if error:
+        raise RuntimeError(error)
+    return ast.literal_eval(out.getvalue().strip())
+
+
+def pull_binary(transport, expression):
+    return variables.pull(transport, expression, timeout=60)[0]
+
+
+def run(device, baudrate, sizes):
+    transport = SerialTransport(device, baudrate)
+    transport.enter_raw_repl()
+    print('{:>8} {:>10} {:>10} {:>8}'.format('floats', 'text ms', 'binary ms', 'speedup'))
+    try:
+        for size in sizes:
+            transport.exec_raw('import array\nv = array.array("f", [i / 7 for i in range({})])'
+                               .format(size), io.StringIO(), timeout=60)
+            times = []
+            for pull in (pull_text, pull_binary):
+                start = time.time()
+                values = pull(transport, 'v')
+                times.append(time.time() - start)
+                if len(values) != size:
+                    raise RuntimeError('Got {} of {} values'.format(len(values), size))
+            print('{:>8} {:>10.1f} {:>10.1f} {:>7.1f}x'.format(
+                size, times[0] * 1000, times[1] * 1000, times[0] / times[1]))
+    finally:
+        transport.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[-1])
+    parser.add_argument('--device', help='serial device of a board, instead of the fake')
+    parser.add_argument('--baudrate', type=int, default=115200,
+                        help='rate of the link, the fake pyboard is limited to it')
+    parser.add_argument('--sizes', default='100,1000,10000',
+                        help='comma separated numbers of floats')
+    args = parser.parse_args()
+    sizes = [int(s) for s in args.sizes.split(',')]
+    if args.device:
+        run(args.device, args.baudrate, sizes)
+        return
+    with FakePyboard(baudrate=args.baudrate) as board:
+        run(board.device, args.baudrate, sizes)
+
+
+if __name__ == '__main__':
+    main()
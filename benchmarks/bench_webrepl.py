@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+bench_webrepl
+----------------------------------
+
+Per-cell latency over the WebREPL, with the connection kept open and with a
+new connection and login for every cell, against the serial transport, over
+a fake WebREPL on a local port and a fake pyboard on a pseudo terminal.
+
+    $ python benchmarks/bench_webrepl.py --cells 200 --latency 0.001
+"""
+from __future__ import print_function
+import io
+import os
+import sys
+import time
+import argparse
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'tests'))
+
+from stmhal.transport import SerialTransport  # noqa: E402
+from stmhal.webrepl import WebReplTransport  # noqa: E402
+from fake_pyboard import FakePyboard  # noqa: E402
+from fake_webrepl import FakeWebRepl  # noqa: E402
+
+PASSWORD = 'bench'
+
+
+def run_cells(transport, cells):
+    for i in range(cells):
+        transport.exec_raw('x = {}'.format(i), io.StringIO(), timeout=10)
+
+
+def persistent(url, cells):
+    transport = WebReplTransport(url, PASSWORD, chunk_delay=0)
+    try:
+        transport.enter_raw_repl()
+        start = time.time()
+        run_cells(transport, cells)
+        return time.time() - start
+    finally:
+        transport.close()
+
+
+def per_cell(url, cells):
+    start = time.time()
+    for i in range(cells):
+        transport = WebReplTransport(url, PASSWORD, chunk_delay=0)
+        try:
+            transport.enter_raw_repl()
+            run_cells(transport, 1)
+        finally:
+            transport.close()
+    return time.time() - start
+
+
+def serial(device, cells):
+    transport = SerialTransport(device, 0, chunk_delay=0)
+    try:
+        transport.enter_raw_repl()
+        start = time.time()
+        run_cells(transport, cells)
+        return time.time() - start
+    finally:
+        transport.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[-1])
+    parser.add_argument('--cells', type=int, default=200, help='cells run by each client')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds the fake boards add before each reply')
+    args = parser.parse_args()
+    print('{:>24} {:>10}'.format('', 'ms / cell'))
+    with FakeWebRepl(PASSWORD, latency=args.latency) as board:
+        for name, run in [('webrepl, kept open', persistent),
+                          ('webrepl, per cell', per_cell)]:
+            seconds = run(board.url, args.cells)
+            print('{:>24} {:>10.2f}'.format(name, seconds * 1000 / args.cells))
+    with FakePyboard(latency=args.latency) as board:
+        seconds = serial(board.device, args.cells)
+        print('{:>24} {:>10.2f}'.format('serial', seconds * 1000 / args.cells))
+
+
+if __name__ == '__main__':
+    main()
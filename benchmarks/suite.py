@@ -0,0 +1,333 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+suite
+----------------------------------
+
+Startup and import time, cells per second one at a time and queued together as by Run
+All, per-cell latency, output throughput and restart time of both kernels,
+run through jupyter_client against the stand-ins in tests/
+(a fake micropython REPL for MPKernelUnix and a fake pyboard on a pseudo
+terminal for MPKernelStmhal), so no micropython build or board is needed.
+
+The results are compared with stored baselines and the run fails if any is
+worse by more than the tolerance.
+
+    $ python benchmarks/suite.py
+    $ python benchmarks/suite.py --save
+"""
+from __future__ import print_function
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
+sys.path.insert(0, os.path.join(ROOT, 'tests'))
+
+from jupyter_client import KernelManager  # noqa: E402
+from jupyter_client.kernelspec import KernelSpecManager  # noqa: E402
+
+import fake_micropython  # noqa: E402
+from fake_pyboard import FakePyboard  # noqa: E402
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+
+# Whether a larger value of each measurement is better
+HIGHER_IS_BETTER = {
+    'cells_per_second': True,
+    'run_all_cells_per_second': True,
+    'latency_median_ms': False,
+    'latency_p95_ms': False,
+    'throughput_kb_s': True,
+    'restart_ms': False,
+    'kernel_info_ms': False,
+    'first_result_ms': False,
+    'import_ms': False,
+    'modules_imported': False,
+}
+
+# The packages whose modules a kernel's import is measured by
+PACKAGES = ('mpkernel', 'unix', 'stmhal')
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+class KernelRun(object):
+    """A kernel started from a temporary kernel spec, with a client"""
+    def __init__(self, module, options, verbose=False):
+        self.tmp = tempfile.mkdtemp()
+        name = 'mpkernel-bench-' + module
+        os.makedirs(os.path.join(self.tmp, name))
+        with open(os.path.join(self.tmp, name, 'kernel.json'), 'w') as f:
+            json.dump({'argv': [sys.executable, '-m', module, '-f', '{connection_file}'] + options,
+                       'display_name': name, 'language': 'python'}, f)
+        specs = KernelSpecManager(kernel_dirs=[self.tmp])
+        self.km = KernelManager(kernel_name=name, kernel_spec_manager=specs)
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(
+            [ROOT] + [p for p in [os.environ.get('PYTHONPATH')] if p]))
+        self.log = None if verbose else open(os.devnull, 'w')
+        self.km.start_kernel(cwd=ROOT, env=env, stdout=self.log, stderr=self.log)
+        self.kc = self.km.client()
+        self.kc.start_channels()
+        self.kc.wait_for_ready(timeout=60)
+
+    def execute(self, code, output=None):
+        """Run a cell and return the seconds until the kernel is idle again"""
+        start = time.time()
+        reply = self.kc.execute_interactive(code, output_hook=output, timeout=120)
+        elapsed = time.time() - start
+        if reply['content']['status'] != 'ok':
+            raise RuntimeError('{!r} failed: {}'.format(code, reply['content']))
+        return elapsed
+
+    def close(self):
+        self.kc.stop_channels()
+        self.km.shutdown_kernel(now=True)
+        shutil.rmtree(self.tmp)
+        if self.log is not None:
+            self.log.close()
+
+
+def run_all(run, cells):
+    """Return the seconds taken by cells sent all at once, as by Run All"""
+    start = time.time()
+    ids = [run.kc.execute(code) for code in cells]
+    pending = set(ids)
+    while pending:
+        reply = run.kc.get_shell_msg(timeout=120)
+        if reply['content']['status'] != 'ok':
+            raise RuntimeError('A queued cell failed: {}'.format(reply['content']))
+        pending.discard(reply['parent_header']['msg_id'])
+    elapsed = time.time() - start
+    # The cells' output must not be left for the next measurement to read
+    while True:
+        msg = run.kc.get_iopub_msg(timeout=120)
+        if (msg['parent_header'].get('msg_id') == ids[-1] and
+                msg['msg_type'] == 'status' and msg['content']['execution_state'] == 'idle'):
+            return elapsed
+
+
+def measure(run, cells, output_bytes, restarts):
+    """Return the measurements of one kernel"""
+    # The first cell also connects to the board
+    run.execute('x = 0')
+    latencies = [run.execute('x += 1') for _ in range(cells)]
+    queued = run_all(run, ['x += 1'] * cells)
+
+    received = []
+
+    def output(msg):
+        if msg['msg_type'] == 'stream':
+            received.append(len(msg['content']['text']))
+
+    lines = output_bytes // 64
+    elapsed = run.execute("for i in range({}):\n    print('{}')".format(lines, 'x' * 63), output)
+    if sum(received) < lines * 64:
+        raise RuntimeError('Only {} of {} bytes of output arrived'.format(
+            sum(received), lines * 64))
+
+    restart_times = []
+    for _ in range(restarts):
+        start = time.time()
+        run.km.restart_kernel()
+        run.kc.wait_for_ready(timeout=60)
+        run.execute('x = 0')
+        restart_times.append(time.time() - start)
+
+    return {
+        'cells_per_second': round(len(latencies) / sum(latencies), 1),
+        'run_all_cells_per_second': round(cells / queued, 1),
+        'latency_median_ms': round(percentile(latencies, 0.5) * 1000, 2),
+        'latency_p95_ms': round(percentile(latencies, 0.95) * 1000, 2),
+        'throughput_kb_s': round(sum(received) / elapsed / 1024, 1),
+        'restart_ms': round(percentile(restart_times, 0.5) * 1000, 1),
+    }
+
+
+def measure_startup(start, starts):
+    """Return the median times from launching a kernel to its kernel_info
+    reply and to the result of its first cell"""
+    ready, first = [], []
+    for _ in range(starts):
+        begin = time.time()
+        run = start()
+        ready.append(time.time() - begin)
+        try:
+            run.execute('x = 0')
+            first.append(time.time() - begin)
+        finally:
+            run.close()
+    return {
+        'kernel_info_ms': round(percentile(ready, 0.5) * 1000, 1),
+        'first_result_ms': round(percentile(first, 0.5) * 1000, 1),
+    }
+
+
+def measure_import(module, starts):
+    """Return the median time python -X importtime gives the modules of this
+    package that importing a kernel loads, besides the kernel's own, and how
+    many it loads"""
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(
+        [ROOT] + [p for p in [os.environ.get('PYTHONPATH')] if p]))
+    times = []
+    for _ in range(starts):
+        log = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import ' + module],
+                             env=env, cwd=ROOT, stderr=subprocess.PIPE, check=True,
+                             universal_newlines=True).stderr
+        # Lines of "import time: self [us] | cumulative | imported package"
+        own = {}
+        for line in log.splitlines():
+            if not line.startswith('import time:'):
+                continue
+            self_us, _, name = line[len('import time:'):].split('|')
+            name = name.strip()
+            if name.split('.')[0] in PACKAGES and name != module:
+                own[name] = int(self_us)
+        times.append(sum(own.values()) / 1e6)
+    return {
+        'import_ms': round(percentile(times, 0.5) * 1000, 1),
+        'modules_imported': len(own),
+    }
+
+
+def bench_unix(args):
+    exe = fake_micropython.command(latency=args.latency)
+    # Output is not limited, so that all of it is relayed and timed
+    options = ['--MPKernelUnix.micropython_exe=' + exe, '--MPKernelUnix.output_head_bytes=0',
+               '--MPKernelUnix.pipeline_cells=32']
+    results = measure_startup(lambda: KernelRun('unix', options, args.verbose), args.starts)
+    results.update(measure_import('unix.unix', args.starts))
+    run = KernelRun('unix', options, args.verbose)
+    try:
+        results.update(measure(run, args.cells, args.output_bytes, args.restarts))
+    finally:
+        run.close()
+    return results
+
+
+def bench_stmhal(args, broker_options=()):
+    with FakePyboard(latency=args.latency, baudrate=args.baudrate) as board:
+        options = ['--MPKernelStmhal.device=' + board.device,
+                   '--MPKernelStmhal.baudrate={}'.format(args.baudrate),
+                   '--MPKernelStmhal.output_head_bytes=0'] + list(broker_options)
+        results = measure_startup(lambda: KernelRun('stmhal', options, args.verbose),
+                                  args.starts)
+        results.update(measure_import('stmhal.stmhal', args.starts))
+        run = KernelRun('stmhal', options, args.verbose)
+        try:
+            # The output is limited by the link rate, so less is sent
+            results.update(measure(run, args.cells, min(args.output_bytes, args.baudrate // 10),
+                                   args.restarts))
+        finally:
+            run.close()
+    return results
+
+
+def bench_stmhal_broker(args):
+    """The stmhal kernel opening the board through a broker, which is left
+    running between the kernels as it would be between notebooks"""
+    tmp = tempfile.mkdtemp()
+    path = os.path.join(tmp, 'broker.sock')
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(
+        [ROOT] + [p for p in [os.environ.get('PYTHONPATH')] if p]))
+    broker = subprocess.Popen([sys.executable, '-m', 'stmhal.broker', '--socket', path,
+                               '--idle-timeout', '0'], env=env, cwd=ROOT,
+                              stderr=None if args.verbose else subprocess.DEVNULL)
+    try:
+        return bench_stmhal(args, ['--MPKernelStmhal.broker=True',
+                                   '--MPKernelStmhal.broker_socket=' + path])
+    finally:
+        broker.terminate()
+        broker.wait()
+        shutil.rmtree(tmp)
+
+
+KERNELS = {'unix': bench_unix, 'stmhal': bench_stmhal, 'stmhal_broker': bench_stmhal_broker}
+
+
+def compare(results, baselines, tolerance):
+    """Return a description of each measurement worse than its baseline by
+    more than ``tolerance``, as a fraction of the baseline"""
+    regressions = []
+    for kernel, measurements in sorted(results.items()):
+        for name, value in sorted(measurements.items()):
+            baseline = baselines.get(kernel, {}).get(name)
+            if not baseline:
+                continue
+            change = (value - baseline) / float(baseline)
+            if HIGHER_IS_BETTER[name]:
+                change = -change
+            if change > tolerance:
+                regressions.append('{} {}: {} against a baseline of {} ({:+.0%})'.format(
+                    kernel, name, value, baseline, change))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark both kernels against the stand-ins')
+    parser.add_argument('--kernels', default='unix,stmhal',
+                        help='comma separated kernels to benchmark')
+    parser.add_argument('--cells', type=int, default=100,
+                        help='cells timed for the rate and latency')
+    parser.add_argument('--output-bytes', type=int, default=256 * 1024,
+                        help='output printed by the throughput cell')
+    parser.add_argument('--restarts', type=int, default=3,
+                        help='kernel restarts timed, the median is reported')
+    parser.add_argument('--starts', type=int, default=5,
+                        help='kernel launches timed, the median is reported')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds the stand-ins add before each reply')
+    parser.add_argument('--baudrate', type=int, default=115200,
+                        help='rate of the fake pyboard link')
+    parser.add_argument('--baseline', default=BASELINE,
+                        help='JSON file of the baseline results')
+    parser.add_argument('--tolerance', type=float, default=0.5,
+                        help='fraction a result may be worse than its baseline')
+    parser.add_argument('--save', action='store_true',
+                        help='store the results as the new baselines')
+    parser.add_argument('--verbose', action='store_true',
+                        help="show the kernels' logs")
+    args = parser.parse_args()
+
+    results = {}
+    for kernel in args.kernels.split(','):
+        results[kernel] = KERNELS[kernel](args)
+        print(kernel)
+        for name, value in sorted(results[kernel].items()):
+            print('  {:<24} {:>10}'.format(name, value))
+
+    if args.save:
+        baselines = {}
+        if os.path.exists(args.baseline):
+            with open(args.baseline) as f:
+                baselines = json.load(f)
+        baselines.update(results)
+        with open(args.baseline, 'w') as f:
+            json.dump(baselines, f, indent=2, sort_keys=True)
+            f.write('\n')
+        print('Saved the baselines to', args.baseline)
+        return
+
+    if not os.path.exists(args.baseline):
+        print('No baselines at {}, run with --save to store them'.format(args.baseline))
+        return
+    with open(args.baseline) as f:
+        regressions = compare(results, json.load(f), args.tolerance)
+    for regression in regressions:
+        print('REGRESSION', regression)
+    if regressions:
+        sys.exit(1)
+    print('No regressions beyond {:.0%} of the baselines'.format(args.tolerance))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,300 @@
+"""
+capture.py
+
+Record the traffic between a kernel and its device, and replay it
+
+A capture file holds every read and write of one connection, to a unix
+interpreter or to a board, in order, each with the microseconds of the
+monotonic clock since the record before it, along with notes such as the
+start of each cell. :func:`summary` splits the time of each cell between the
+kernel, from a read to its next write, sending, between writes, waiting for
+the device to answer a write, and running, between reads, while the device
+runs the cell and its output comes in.
+
+A :class:`Replayer` stands in for the device. It waits for the kernel to
+write what was written in the capture, then sends what the device sent, as
+long after the kernel's last write as it came in the capture, so a session
+runs with the device's own timing without the device. It serves the
+standard streams, as the unix kernel's ``micropython_exe``, or a pseudo
+terminal, as the stmhal kernel's device:
+
+    $ python -m mpkernel.capture summary capture.mpkcap
+    $ python -m mpkernel.capture replay --pty capture.mpkcap
+"""
+from __future__ import print_function
+import io
+import os
+import sys
+import time
+import uuid
+import struct
+import argparse
+import threading
+import collections
+
+MAGIC = b'MPKCAP\x01\n'
+
+# Kind, microseconds since the previous record and size of the data
+HEADER = struct.Struct('<BII')
+READ, WRITE, NOTE = 0, 1, 2
+MAX_DELTA = 0xffffffff
+
+Record = collections.namedtuple('Record', 'kind time data')
+
+
+def capture_path(directory, name):
+    """Return a new capture file in ``directory`` for a connection to ``name``"""
+    name = ''.join(c if c.isalnum() else '_' for c in name).strip('_')[-40:] or 'device'
+    return os.path.join(directory, '{}-{}-{}.mpkcap'.format(
+        name, time.strftime('%Y%m%d-%H%M%S'), uuid.uuid4().hex[:6]))
+
+
+class _Side(object):
+    """The reads or the writes of a capture, as a file for pexpect's
+    ``logfile_read`` and ``logfile_send``"""
+    def __init__(self, capture, kind):
+        self.capture = capture
+        self.kind = kind
+
+    def write(self, data):
+        if not isinstance(data, bytes):
+            data = data.encode('utf-8', 'surrogateescape')
+        self.capture.record(self.kind, data)
+
+    def flush(self):
+        pass
+
+
+class Capture(object):
+    """
+    A capture file being recorded
+
+    Each record is written through to the file, so that a capture is
+    complete up to the moment a kernel dies.
+
+    :param str path: The file, created with its directory.
+    :param str note: The first note, e.g. what the connection is to.
+    """
+    def __init__(self, path, note=None):
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.path = path
+        self._file = io.open(path, 'wb')
+        self._file.write(MAGIC)
+        self._lock = threading.Lock()
+        self._last = time.monotonic()
+        self.reads = _Side(self, READ)
+        self.writes = _Side(self, WRITE)
+        if note:
+            self.note(note)
+
+    def record(self, kind, data):
+        with self._lock:
+            if self._file is None:
+                return
+            now = time.monotonic()
+            delta = int(round((now - self._last) * 1e6))
+            self._last = now
+            while delta > MAX_DELTA:
+                self._file.write(HEADER.pack(NOTE, MAX_DELTA, 0))
+                delta -= MAX_DELTA
+            self._file.write(HEADER.pack(kind, delta, len(data)) + data)
+            self._file.flush()
+
+    def read(self, data):
+        self.record(READ, data)
+
+    def write(self, data):
+        self.record(WRITE, data)
+
+    def note(self, text):
+        self.record(NOTE, text.encode('utf-8'))
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+def load(path):
+    """Return the records of a capture file, their time in seconds from the
+    start of the capture"""
+    records = []
+    elapsed = 0
+    with io.open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError('{} is not a capture file'.format(path))
+        while True:
+            header = f.read(HEADER.size)
+            if len(header) < HEADER.size:
+                break
+            kind, delta, size = HEADER.unpack(header)
+            data = f.read(size)
+            if len(data) < size:
+                # Cut short by a kernel that died while writing it
+                break
+            elapsed += delta
+            if kind != NOTE or data:
+                records.append(Record(kind, elapsed / 1e6, data))
+    return records
+
+
+class Section(object):
+    """The time and bytes of part of a capture, e.g. one cell"""
+    def __init__(self, name):
+        self.name = name
+        # Seconds from a read to the kernel's next write, between writes,
+        # from a write to the device's answer and between reads
+        self.host = self.sending = self.waiting = self.running = 0.0
+        self.written = self.read = 0
+        self.exchanges = 0
+
+    @property
+    def total(self):
+        return self.host + self.sending + self.waiting + self.running
+
+    def __str__(self):
+        return (u'{:<24} {:>9.1f} {:>9.1f} {:>9.1f} {:>9.1f} {:>9.1f} {:>8} {:>8} {:>6}'.format(
+            self.name[:24], self.total * 1e3, self.host * 1e3, self.sending * 1e3,
+            self.waiting * 1e3, self.running * 1e3, self.written, self.read, self.exchanges))
+
+
+def summary(records):
+    """Return a :class:`Section` for each part of a capture between notes,
+    and one for the whole capture"""
+    sections = [Section(u'(connect)')]
+    whole = Section(u'total')
+    previous = None
+    for record in records:
+        if record.kind == NOTE:
+            sections.append(Section(record.data.decode('utf-8', 'replace')))
+            continue
+        section = sections[-1]
+        if previous is not None:
+            gap = record.time - previous.time
+            field = {(READ, WRITE): 'host', (WRITE, WRITE): 'sending',
+                     (WRITE, READ): 'waiting', (READ, READ): 'running'}[
+                         (previous.kind, record.kind)]
+            for part in (section, whole):
+                setattr(part, field, getattr(part, field) + gap)
+        for part in (section, whole):
+            if record.kind == WRITE:
+                part.written += len(record.data)
+                if previous is None or previous.kind == READ:
+                    part.exchanges += 1
+            else:
+                part.read += len(record.data)
+        previous = record
+    return [s for s in sections if s.exchanges or s.read or s.name != u'(connect)'] + [whole]
+
+
+def format_summary(sections):
+    lines = [u'{:<24} {:>9} {:>9} {:>9} {:>9} {:>9} {:>8} {:>8} {:>6}'.format(
+        'ms', 'total', 'host', 'sending', 'waiting', 'running', 'B out', 'B in', 'turns')]
+    lines += [str(section) for section in sections]
+    return u'\n'.join(lines)
+
+
+class Replayer(object):
+    """
+    Stand in for the device of a capture
+
+    :param records: The records of the capture.
+    :param read: Returns the next bytes the kernel wrote, ``b''`` at the end.
+    :param write: Sends bytes to the kernel.
+    :param float speed: How much faster than in the capture to answer.
+    :param log: Where mismatches with the capture are reported.
+    """
+    def __init__(self, records, read, write, speed=1.0, log=None):
+        self.records = [r for r in records if r.kind != NOTE]
+        self._read = read
+        self._write = write
+        self.speed = speed
+        self.log = log
+        # Bytes the kernel wrote that differed from the capture
+        self.mismatches = 0
+        self._input = b''
+
+    def _expect(self, data):
+        """Wait for the kernel to write ``data``"""
+        while len(self._input) < len(data):
+            chunk = self._read()
+            if not chunk:
+                raise EOFError()
+            self._input += chunk
+        received, self._input = self._input[:len(data)], self._input[len(data):]
+        if received != data:
+            self.mismatches += 1
+            if self.log is not None:
+                self.log.write(u'Expected {!r}, the kernel wrote {!r}\n'.format(data, received))
+
+    def run(self):
+        """Replay the capture, returning once it has ended or the kernel has
+        gone"""
+        # The time in the capture and here of the kernel's last write
+        anchor = (self.records[0].time if self.records else 0.0, time.monotonic())
+        try:
+            for record in self.records:
+                if record.kind == WRITE:
+                    self._expect(record.data)
+                    anchor = (record.time, time.monotonic())
+                else:
+                    delay = anchor[1] + (record.time - anchor[0]) / self.speed - time.monotonic()
+                    if delay > 0:
+                        time.sleep(delay)
+                    self._write(record.data)
+        except EOFError:
+            return False
+        return True
+
+
+def _write_all(fd, data):
+    while data:
+        data = data[os.write(fd, data):]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Summarize or replay a capture of the '
+                                     'traffic between a kernel and its device')
+    commands = parser.add_subparsers(dest='command')
+    command = commands.add_parser('summary', help='where the time of each cell went')
+    command.add_argument('path')
+    command = commands.add_parser('replay', help='stand in for the device')
+    command.add_argument('path')
+    command.add_argument('--pty', action='store_true',
+                         help='serve a pseudo terminal, whose path is printed, '
+                         'rather than the standard streams')
+    command.add_argument('--speed', type=float, default=1.0,
+                         help='how much faster than in the capture to answer')
+    args = parser.parse_args()
+    if args.command == 'summary':
+        print(format_summary(summary(load(args.path))))
+        return
+    if args.command != 'replay':
+        parser.print_usage()
+        return
+    import tty
+    records = load(args.path)
+    if args.pty:
+        import pty
+        master, slave = pty.openpty()
+        tty.setraw(slave)
+        print(os.ttyname(slave))
+        sys.stdout.flush()
+        read_fd = write_fd = master
+    else:
+        read_fd, write_fd = sys.stdin.fileno(), sys.stdout.fileno()
+        if os.isatty(read_fd):
+            tty.setraw(read_fd)
+    replayer = Replayer(records, lambda: os.read(read_fd, 4096),
+                        lambda data: _write_all(write_fd, data), args.speed, sys.stderr)
+    if replayer.run():
+        # Keep the connection open, as the device would, until the kernel goes
+        while os.read(read_fd, 4096):
+            pass
+
+
+if __name__ == '__main__':
+    main()
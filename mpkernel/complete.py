@@ -0,0 +1,195 @@
+"""
+complete.py
+
+Tab completion and inspection of the objects on the device
+
+Asking the device for ``dir()`` on every keystroke would be far too slow
+over a serial link, so the answers are kept in a host-side cache. A miss is
+filled by a single query that also returns the builtins and the attributes
+of every module imported in ``__main__`` not already cached, so that later
+completions of those are answered without a round trip.
+
+The cache has a generation, moved on after each cell runs, since a cell can
+change any global. Names found under a module are assumed not to change and
+are kept across generations; everything else is queried again once stale.
+
+The query function is defined on the device once, as ``_mpk_query``, so
+that each query after the first sends a single line.
+"""
+import re
+import ast
+import keyword
+from collections import OrderedDict
+
+DEFINE = """\
+def _mpk_query(paths, info, known):
+    import sys
+    g = globals()
+    r = {}
+    for p in paths:
+        try:
+            o = g[p.split('.')[0]] if p else None
+            m = type(o) is type(sys)
+            for a in p.split('.')[1:]:
+                o = getattr(o, a)
+        except Exception:
+            continue
+        if info:
+            r[p] = (m, (type(o).__name__, repr(o)[:200], getattr(o, '__doc__', None)))
+        elif p:
+            r[p] = (m, dir(o))
+        else:
+            r[p] = (False, list(g))
+            if '<builtins>' not in known:
+                try:
+                    import builtins
+                    r['<builtins>'] = (True, dir(builtins))
+                except ImportError:
+                    pass
+            for k in g:
+                if type(g[k]) is type(sys) and k not in known:
+                    r[k] = (True, dir(g[k]))
+    print(repr(r))
+"""
+
+QUERY = '_mpk_query({paths!r}, {info!r}, {known!r})\n'
+
+BUILTINS = '<builtins>'
+
+_TOKEN = re.compile(r'[A-Za-z_][\w.]*$')
+_TOKEN_END = re.compile(r'^\w*')
+
+
+def token_before(code, cursor_pos):
+    """Return the dotted name ending at ``cursor_pos``, or None if the
+    object it belongs to cannot be named, as in ``x[0].ap``"""
+    text = code[:cursor_pos]
+    m = _TOKEN.search(text)
+    if m is None:
+        return None if text[-1:] in ('.', '"', "'") else ''
+    before = text[:m.start()]
+    if before[-1:] in ('.', '"', "'") or before[-1:].isdigit():
+        return None
+    return m.group()
+
+
+class NamespaceCache(object):
+    """
+    Names and descriptions of the objects on the device
+
+    :param query: Called with a program to run on the device and returning
+      its output, or '' if it could not be run.
+    :param int max_entries: Entries kept, the least recently used are
+      dropped beyond this.
+    """
+    def __init__(self, query, max_entries=256):
+        self.query = query
+        self.max_entries = max_entries
+        self.generation = 0
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.queries = 0
+        # Whether _mpk_query is thought to be defined on the device
+        self.defined = False
+
+    def invalidate(self):
+        """Mark what was learnt from the device as stale, after a cell ran"""
+        self.generation += 1
+
+    def clear(self):
+        """Forget everything, after the device was reset"""
+        self.entries.clear()
+        self.defined = False
+        self.invalidate()
+
+    def _get(self, key, stale=False):
+        entry = self.entries.get(key)
+        if entry is None or not (stale or entry[0] is None or entry[0] == self.generation):
+            return None
+        self.entries.move_to_end(key)
+        return entry[1]
+
+    def _put(self, key, value, stable):
+        self.entries[key] = (None if stable else self.generation, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def _fetch(self, paths, info):
+        self.queries += 1
+        # Modules whose names are cached are not sent again
+        known = [key[1] for key, (generation, _) in self.entries.items()
+                 if generation is None and key[0] == 'names' and '.' not in key[1]]
+        query = QUERY.format(paths=list(paths), info=info, known=known)
+        lines = []
+        for define in ([False, True] if self.defined else [True]):
+            output = self.query(DEFINE + query if define else query)
+            lines = [line for line in output.splitlines() if line.startswith('{')]
+            if lines:
+                break
+        # Defined again on the next query if it failed, e.g. after a soft reset
+        self.defined = bool(lines)
+        try:
+            result = ast.literal_eval(lines[-1]) if lines else {}
+        except (ValueError, SyntaxError):
+            return
+        for path, (stable, value) in result.items():
+            self._put(('info' if info else 'names', path), value, stable)
+
+    def _lookup(self, kind, path, query):
+        value = self._get((kind, path))
+        if value is None:
+            if query:
+                self.misses += 1
+                self._fetch([path], kind == 'info')
+                value = self._get((kind, path))
+            else:
+                # Busy, an out of date answer is better than none
+                value = self._get((kind, path), stale=True)
+        else:
+            self.hits += 1
+        return value
+
+    def names(self, path, query=True):
+        """Return the attribute names of ``path``, or the names in scope
+        for the empty path.
+
+        :param bool query: Ask the device on a miss; otherwise stale entries
+          are used, e.g. while a cell is running.
+        """
+        names = self._lookup('names', path, query) or []
+        if not path:
+            names = [n for n in names if not n.startswith('_mpk')]
+            names += (self._get(('names', BUILTINS), stale=True) or []) + keyword.kwlist
+        return names
+
+    def info(self, path, query=True):
+        """Return the type name, repr and docstring of ``path``, or None"""
+        return self._lookup('info', path, query)
+
+    def complete(self, code, cursor_pos, query=True):
+        """Return the matches for the name before ``cursor_pos`` and where
+        that name starts"""
+        token = token_before(code, cursor_pos)
+        if token is None:
+            return [], cursor_pos
+        path, _, prefix = token.rpartition('.')
+        matches = sorted(set(n for n in self.names(path, query) if n.startswith(prefix) and
+                             (prefix.startswith('_') or not n.startswith('_'))))
+        return matches, cursor_pos - len(prefix)
+
+    def inspect(self, code, cursor_pos, query=True):
+        """Return a text description of the name at ``cursor_pos``, or None"""
+        token = token_before(code, cursor_pos)
+        if not token:
+            return None
+        path = (token + _TOKEN_END.match(code[cursor_pos:]).group()).rstrip('.')
+        info = self.info(path, query)
+        if info is None:
+            return None
+        type_name, value, doc = info
+        text = 'Type:        {}\nString form: {}'.format(type_name, value)
+        if doc:
+            text += '\nDocstring:   {}'.format(doc)
+        return text
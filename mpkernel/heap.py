@@ -0,0 +1,231 @@
+"""
+heap.py
+
+The device's heap before and after each cell, measured in the cell's own
+exchange
+
+The cell is run with ``exec`` by a probe that collects garbage and reads
+``gc.mem_alloc()`` and ``gc.mem_free()`` before it, reads them again once it
+has finished, collects and reads them a third time, then prints them after
+the cell's output along with ``micropython.mem_info()``, whose largest free
+block shows how fragmented the heap is. The kernel strips this record from
+the output, so measuring costs no round trip, and keeps the usage of every
+cell for ``%memtrace``.
+"""
+import re
+import collections
+
+from .magics import MagicParser
+from .repl import RecordFilter
+
+MARKER = u'\x1e_mpk_heap'
+END = u'\x1e'
+
+PROBE = """\
+import gc as _mpk_gc
+_mpk_gc.collect()
+_mpk_heap = [4 * __import__('struct').calcsize('P'), _mpk_gc.mem_alloc(), _mpk_gc.mem_free()]
+try:
+    exec({code!r})
+finally:
+    _mpk_heap += [_mpk_gc.mem_alloc(), _mpk_gc.mem_free()]
+    _mpk_gc.collect()
+    _mpk_heap += [_mpk_gc.mem_alloc(), _mpk_gc.mem_free()]
+    print({marker!r}, *_mpk_heap)
+    _mpk_heap = getattr(__import__('micropython'), 'mem_info', None)
+    if _mpk_heap:
+        _mpk_heap()
+    print({end!r}, end='')
+    del _mpk_gc, _mpk_heap
+"""
+
+_LARGEST_FREE = re.compile(r'max free sz: (\d+)')
+
+
+def probe(code):
+    """Return the program running ``code`` and printing its heap usage"""
+    return PROBE.format(code=code, marker=MARKER, end=END)
+
+
+class HeapUsage(object):
+    """
+    The heap of the device around one cell, in bytes
+
+    ``alloc`` and ``free`` are measured after the cell and a collection, so
+    ``kept`` is what the cell left allocated and ``garbage`` what it left
+    for the collector. ``largest_free`` is None if the port has no
+    ``micropython.mem_info``.
+    """
+    def __init__(self, alloc_before, free_before, alloc_after, free_after,
+                 alloc, free, largest_free=None):
+        self.alloc_before = alloc_before
+        self.free_before = free_before
+        self.alloc_after = alloc_after
+        self.free_after = free_after
+        self.alloc = alloc
+        self.free = free
+        self.largest_free = largest_free
+
+    @classmethod
+    def parse(cls, record):
+        """Return the usage printed by the probe, None if it is incomplete"""
+        first, _, rest = record.strip().partition('\n')
+        try:
+            block, alloc_before, free_before, alloc_after, free_after, alloc, free = [
+                int(n) for n in first.split()]
+        except ValueError:
+            return None
+        match = _LARGEST_FREE.search(rest)
+        largest_free = int(match.group(1)) * block if match else None
+        return cls(alloc_before, free_before, alloc_after, free_after, alloc, free,
+                   largest_free)
+
+    @property
+    def total(self):
+        return self.alloc + self.free
+
+    @property
+    def kept(self):
+        return self.alloc - self.alloc_before
+
+    @property
+    def garbage(self):
+        return self.alloc_after - self.alloc
+
+    @property
+    def fragmentation(self):
+        """The part of the free heap outside its largest block, None if unknown"""
+        if self.largest_free is None or not self.free:
+            return None
+        return max(1.0 - float(self.largest_free) / self.free, 0.0)
+
+    def as_dict(self):
+        """The usage for execute_reply metadata"""
+        fragmentation = self.fragmentation
+        return {
+            'alloc_before': self.alloc_before,
+            'free_before': self.free_before,
+            'alloc_after': self.alloc_after,
+            'free_after': self.free_after,
+            'alloc': self.alloc,
+            'free': self.free,
+            'kept': self.kept,
+            'garbage': self.garbage,
+            'largest_free': self.largest_free,
+            'fragmentation': None if fragmentation is None else round(fragmentation, 3),
+        }
+
+
+class HeapFilter(RecordFilter):
+    """
+    Pass a cell's output on to ``stream`` without the probe's record, whose
+    usage is left in ``usage``
+    """
+    def __init__(self, stream):
+        super(HeapFilter, self).__init__(stream, MARKER, END)
+
+    @property
+    def usage(self):
+        return None if self.record is None else HeapUsage.parse(self.record)
+
+
+class HeapTrace(object):
+    """
+    The heap usage of the cells run in a session, newest last, for
+    ``%memtrace``
+
+    :param int size: Number of cells kept.
+    """
+    def __init__(self, size=1000):
+        self.cells = collections.deque(maxlen=size)
+
+    def __len__(self):
+        return len(self.cells)
+
+    def add(self, execution_count, usage):
+        self.cells.append((execution_count, usage))
+
+    def clear(self):
+        self.cells.clear()
+
+    def flagged(self, leak_bytes=1024, fragmentation=0.5):
+        """Return the execution count of each cell that kept more than
+        ``leak_bytes`` or left the free heap more fragmented than
+        ``fragmentation``, with the reasons"""
+        flagged = []
+        for count, usage in self.cells:
+            reasons = []
+            if usage.kept > leak_bytes:
+                reasons.append('kept {}'.format(_size(usage.kept)))
+            if usage.fragmentation is not None and usage.fragmentation > fragmentation:
+                reasons.append('{:.0%} fragmented, largest free block {} of {}'.format(
+                    usage.fragmentation, _size(usage.largest_free), _size(usage.free)))
+            if reasons:
+                flagged.append((count, reasons))
+        return flagged
+
+    def report(self, leak_bytes=1024, fragmentation=0.5):
+        if not self.cells:
+            return u'No cells traced, set heap_usage or run %memtrace on'
+        first, last = self.cells[0][1], self.cells[-1][1]
+        peak = max(usage.alloc_after for _, usage in self.cells)
+        lines = [u'{} cells: {} of {} in use ({:+.1f} KB since the first), '
+                 u'{} at most at the end of a cell'.format(
+                     len(self.cells), _size(last.alloc), _size(last.total),
+                     (last.alloc - first.alloc_before) / 1024.0, _size(peak))]
+        if last.largest_free is not None:
+            lines.append(u'Largest free block {}'.format(_size(last.largest_free)))
+        for count, reasons in self.flagged(leak_bytes, fragmentation):
+            lines.append(u'  [{}] {}'.format(count, ', '.join(reasons)))
+        return u'\n'.join(lines)
+
+    def svg(self, leak_bytes=1024, fragmentation=0.5, width=600, height=160):
+        """Return an SVG plot of the heap in use after each cell and at its
+        end before the collection, with the flagged cells marked in red"""
+        cells = list(self.cells)
+        top = max([usage.total for _, usage in cells] or [1]) or 1
+        step = float(width) / max(len(cells) - 1, 1)
+        flagged = set(count for count, _ in self.flagged(leak_bytes, fragmentation))
+
+        def y(value):
+            return height - float(value) * height / top
+
+        def line(values, color):
+            points = ' '.join('{:.1f},{:.1f}'.format(i * step, y(v)) for i, v in enumerate(values))
+            return u'<polyline points="{}" stroke="{}" fill="none"/>'.format(points, color)
+
+        parts = [line([usage.alloc_after for _, usage in cells], 'lightsteelblue'),
+                 line([usage.alloc for _, usage in cells], 'steelblue')]
+        parts += [u'<circle cx="{:.1f}" cy="{:.1f}" r="3" fill="red"><title>[{}]</title>'
+                  u'</circle>'.format(i * step, y(usage.alloc), count)
+                  for i, (count, usage) in enumerate(cells) if count in flagged]
+        parts.append(u'<text x="0" y="12" font-size="12">heap in use, of {}</text>'.format(
+            _size(top)))
+        return (u'<svg xmlns="http://www.w3.org/2000/svg" width="{0}" height="{1}" '
+                u'viewBox="0 0 {0} {1}">{2}</svg>'.format(width, height, u''.join(parts)))
+
+    def view(self, leak_bytes=1024, fragmentation=0.5):
+        """Return the display data bundle of ``%memtrace``"""
+        bundle = {'text/plain': self.report(leak_bytes, fragmentation)}
+        if self.cells:
+            bundle['image/svg+xml'] = self.svg(leak_bytes, fragmentation)
+        return bundle
+
+
+def memtrace_args(line):
+    """Parse the arguments of ``%memtrace``"""
+    parser = MagicParser('memtrace')
+    parser.add_argument('action', nargs='?', choices=['on', 'off', 'clear'],
+                        help='start or stop measuring cells, or forget those measured')
+    parser.add_argument('-l', '--leak', type=int, default=1024,
+                        help='bytes a cell may keep before it is flagged')
+    parser.add_argument('-f', '--fragmentation', type=float, default=0.5,
+                        help='part of the free heap outside its largest block '
+                        'above which a cell is flagged')
+    return parser.parse(line)
+
+
+def _size(n):
+    if abs(n) < 1024:
+        return u'{} B'.format(n)
+    return u'{:.1f} KB'.format(n / 1024.0)
@@ -0,0 +1,45 @@
+"""
+magics.py
+
+Parsing of the ``%name args`` and ``%%name args`` cells handled by the kernels
+"""
+import shlex
+import argparse
+
+
+class MagicError(Exception):
+    pass
+
+
+class MagicParser(argparse.ArgumentParser):
+    """
+    An argument parser for a magic's arguments that raises :class:`MagicError`
+    instead of exiting
+    """
+    def __init__(self, name, **kwargs):
+        super(MagicParser, self).__init__(prog='%' + name, add_help=False, **kwargs)
+
+    def error(self, message):
+        raise MagicError('{}\n{}'.format(message, self.format_usage().strip()))
+
+    def parse(self, line):
+        return self.parse_args(shlex.split(line))
+
+
+def split_magic(code):
+    """Split a cell into a magic name, its argument line and the cell body.
+
+    Line magics (``%name``) have an empty body; cell magics (``%%name``) are
+    given the rest of the cell. Returns None if the cell is not a magic.
+    """
+    stripped = code.lstrip()
+    if not stripped.startswith('%'):
+        return None
+    cell = stripped.startswith('%%')
+    first, _, body = stripped.partition('\n')
+    name, _, line = first.lstrip('%').partition(' ')
+    if not name:
+        return None
+    if not cell and body.strip():
+        raise MagicError("%{} takes no cell body, use %%{}".format(name, name))
+    return name, line.strip(), body if cell else ''
@@ -0,0 +1,192 @@
+"""
+metrics.py
+
+Per-cell timing and latency histograms in the Prometheus text format
+
+Each cell's time is split into phases:
+
+- queue: from the frontend sending the request until the kernel handles it
+- compile: compiling the cell when that is a separate step (mpy-cross, or the
+  compile round trip at the unix port's normal prompt); in the raw REPL the
+  device compiles as part of exec
+- transfer: sending the cell, or its bytecode, to the device
+- exec: from the cell being sent until its reply is complete
+- relay: the part of exec spent sending output to the frontend
+- connect: opening the connection to a board, on its first cell
+
+Latencies outside of cells, such as restarting the interpreter, have their
+own histograms, labelled by how the event happened.
+"""
+import os
+import time
+import threading
+from datetime import datetime
+
+# Seconds, from a fast local cell to a slow transfer
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+           1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# The latencies :meth:`Metrics.observe` accepts, with their help text
+LATENCIES = {
+    'interrupt': 'Time from interrupting a cell until its prompt returned',
+    'restart': 'Time taken to restart the interpreter, by how it was restarted',
+}
+
+
+def seconds_since(date):
+    """Seconds since a message header's ``date``, None if it is not known"""
+    if not isinstance(date, datetime):
+        return None
+    now = datetime.now(date.tzinfo) if date.tzinfo else datetime.utcnow()
+    return max((now - date).total_seconds(), 0.0)
+
+
+class CellTimer(object):
+    """
+    Time the phases of a single cell
+
+    ``with timer.phase('exec'):`` adds the time the block takes to a phase;
+    :meth:`add` adds a time measured elsewhere.
+    """
+    def __init__(self, queue=None):
+        self.start = time.time()
+        self.seconds = {}
+        if queue is not None:
+            self.seconds['queue'] = queue
+
+    def add(self, phase, seconds):
+        self.seconds[phase] = self.seconds.get(phase, 0.0) + seconds
+
+    def phase(self, name):
+        return _Phase(self, name)
+
+    def total(self):
+        return time.time() - self.start
+
+    def as_dict(self):
+        """The phases and total in milliseconds, for execute_reply metadata"""
+        timings = dict((phase, round(seconds * 1000, 3))
+                       for phase, seconds in self.seconds.items())
+        timings['total'] = round(self.total() * 1000, 3)
+        return timings
+
+
+class _Phase(object):
+    def __init__(self, timer, name):
+        self.timer = timer
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+
+    def __exit__(self, *exc):
+        self.timer.add(self.name, time.time() - self.start)
+
+
+class Histogram(object):
+    """Cumulative bucket counts, sum and count of observed values"""
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * len(self.buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+
+def _labels(labels):
+    return ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                    for k, v in sorted(labels.items()))
+
+
+def _histogram(name, labels, hist):
+    """Return the sample lines of a histogram"""
+    lines = []
+    for bound, count in zip(hist.buckets, hist.counts):
+        lines.append('{}_bucket{{{}}} {}'.format(
+            name, _labels(dict(labels, le=repr(float(bound)))), count))
+    lines.append('{}_bucket{{{}}} {}'.format(name, _labels(dict(labels, le='+Inf')), hist.count))
+    lines.append('{}_sum{{{}}} {!r}'.format(name, _labels(labels), hist.sum))
+    lines.append('{}_count{{{}}} {}'.format(name, _labels(labels), hist.count))
+    return lines
+
+
+class Metrics(object):
+    """
+    The cell phase histograms and counts of one kernel
+
+    :param dict labels: Added to every sample, e.g. ``{'kernel': 'unix'}``.
+    """
+    def __init__(self, labels=None, prefix='mpkernel'):
+        self.labels = dict(labels or {})
+        self.prefix = prefix
+        self.phases = {}
+        self.cells = {}
+        # The histograms of each latency, by their labels
+        self.latencies = {}
+        self._lock = threading.Lock()
+
+    def record(self, timer, status):
+        """Add a finished cell's phases, total and status"""
+        with self._lock:
+            seconds = dict(timer.seconds, total=timer.total())
+            for phase, value in seconds.items():
+                self.phases.setdefault(phase, Histogram()).observe(value)
+            self.cells[status] = self.cells.get(status, 0) + 1
+
+    def observe(self, latency, seconds, **labels):
+        """Add the time of an event outside of cells, one of ``LATENCIES``"""
+        if latency not in LATENCIES:
+            raise ValueError('Unknown latency {!r}'.format(latency))
+        with self._lock:
+            histograms = self.latencies.setdefault(latency, {})
+            key = tuple(sorted(labels.items()))
+            histograms.setdefault(key, Histogram()).observe(seconds)
+
+    def render(self):
+        """Return the metrics in the Prometheus text exposition format"""
+        name = self.prefix + '_cell_phase_seconds'
+        lines = ['# HELP {} Time spent in each phase of running a cell'.format(name),
+                 '# TYPE {} histogram'.format(name)]
+        with self._lock:
+            for phase in sorted(self.phases):
+                lines += _histogram(name, dict(self.labels, phase=phase), self.phases[phase])
+            name = self.prefix + '_cells_total'
+            lines += ['# HELP {} Cells run, by reply status'.format(name),
+                      '# TYPE {} counter'.format(name)]
+            for status in sorted(self.cells):
+                lines.append('{}{{{}}} {}'.format(
+                    name, _labels(dict(self.labels, status=status)), self.cells[status]))
+            for latency in sorted(self.latencies):
+                name = '{}_{}_seconds'.format(self.prefix, latency)
+                lines += ['# HELP {} {}'.format(name, LATENCIES[latency]),
+                          '# TYPE {} histogram'.format(name)]
+                for key, hist in sorted(self.latencies[latency].items()):
+                    lines += _histogram(name, dict(self.labels, **dict(key)), hist)
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path):
+        """Write :meth:`render` to ``path``, replacing it atomically, as read by
+        the node_exporter textfile collector"""
+        tmp = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp, 'w') as f:
+            f.write(self.render())
+        os.rename(tmp, path)
+
+    def serve(self, port, address='127.0.0.1'):
+        """Serve :meth:`render` at ``/metrics`` from the current IOLoop"""
+        from tornado.web import Application, RequestHandler
+        metrics = self
+
+        class MetricsHandler(RequestHandler):
+            def get(self):
+                self.set_header('Content-Type', 'text/plain; version=0.0.4')
+                self.write(metrics.render())
+
+        app = Application([('/metrics', MetricsHandler)])
+        return app.listen(port, address=address)
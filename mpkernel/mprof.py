@@ -0,0 +1,311 @@
+"""
+mprof.py
+
+Profile the lines or functions of a cell on the device, for ``%%mprof``
+
+The cell's syntax tree is rewritten on the host so that a probe reading
+``time.ticks_us()`` runs before each line, or around the body of each
+function with ``-f``, and the rewritten cell is run in one exchange. The
+probes count in two arrays on the device, the hits and microseconds of each
+line or function, which are sent back at the end of the cell as a single
+base64 record that the kernel strips from the output.
+
+A line's time runs from its probe until the next line's, and a function
+restores its caller's line when it returns, so a line that calls a
+function is not charged for the function's lines. A loop's header is only
+probed when the loop starts, so the time it takes to advance the loop counts
+towards the last line of its body. Generators and functions compiled by the
+native, viper or assembler emitters are not wrapped. Each probe's own cost
+is measured on the device after the cell, and the part of it that falls
+between two lines is included in their time, so lines hit many times look
+slower than they are by about that much per hit.
+"""
+import re
+import ast
+import uuid
+import struct
+import binascii
+
+from .magics import MagicError, MagicParser
+
+MARKER = u'\x1e_mpk_mprof'
+END = u'\x1e'
+
+# Decorators whose functions are not compiled to bytecode
+NATIVE = ('native', 'viper', 'asm_thumb', 'asm_xtensa')
+
+# Probe calls timed after the cell to measure their cost
+CALIBRATION = 200
+
+# The probes of one run, named after it so that functions profiled by an
+# earlier run never count into this run's arrays. Afterwards they do nothing.
+PRELUDE = """\
+from time import ticks_us as _mpk_tu, ticks_diff as _mpk_td
+_mpk_s = [__import__('array').array('L', [0] * {slots}) for _mpk_i in range(2)] + [-1, 0]
+"""
+
+LINE_PROBES = """\
+def _mpk_m{run}(i, s=_mpk_s, tu=_mpk_tu, td=_mpk_td):
+    t = tu()
+    if s[2] >= 0:
+        s[1][s[2]] += td(t, s[3])
+    s[0][i] += 1
+    s[2] = i
+    s[3] = tu()
+def _mpk_x{run}(i, s=_mpk_s, tu=_mpk_tu, td=_mpk_td):
+    t = tu()
+    if s[2] >= 0:
+        s[1][s[2]] += td(t, s[3])
+    s[2] = i
+    s[3] = tu()
+def _mpk_e{run}(s=_mpk_s):
+    return s[2]
+"""
+
+FUNCTION_PROBES = """\
+def _mpk_x{run}(i, t, s=_mpk_s, tu=_mpk_tu, td=_mpk_td):
+    s[1][i] += td(tu(), t)
+    s[0][i] += 1
+_mpk_e{run} = _mpk_tu
+"""
+
+PROGRAM = """\
+_mpk_t = _mpk_tu()
+try:
+    exec({code!r})
+finally:
+    _mpk_t = _mpk_td(_mpk_tu(), _mpk_t)
+    {flush}
+    _mpk_c = _mpk_tu()
+    for _mpk_i in range({calibration}):
+        pass
+    _mpk_c = [_mpk_td(_mpk_tu(), _mpk_c), _mpk_tu()]
+    for _mpk_i in range({calibration}):
+        {probe}
+    _mpk_c[1] = _mpk_td(_mpk_tu(), _mpk_c[1])
+    print({marker!r}, _mpk_t, _mpk_c[1] - _mpk_c[0], {calibration},
+          __import__('binascii').b2a_base64(bytes(_mpk_s[0]) + bytes(_mpk_s[1])).decode(),
+          {end!r}, end='')
+    _mpk_m{run} = _mpk_x{run} = _mpk_e{run} = lambda *a: None
+    del _mpk_s, _mpk_tu, _mpk_td, _mpk_t, _mpk_c, _mpk_i
+"""
+
+_STDIN_LINE = re.compile(r'(File "<stdin>", line )(\d+)')
+
+
+def mprof_args(line):
+    """Parse the arguments of ``%%mprof``"""
+    parser = MagicParser('mprof')
+    parser.add_argument('-f', '--functions', action='store_true',
+                        help='time each function rather than each line')
+    parser.add_argument('-s', '--sort', choices=['time', 'hits', 'line'], default='time',
+                        help='order of the table')
+    parser.add_argument('-n', '--rows', type=int, default=20,
+                        help='rows of the table, 0 for all')
+    return parser.parse(line)
+
+
+def _is_native(function):
+    for decorator in function.decorator_list:
+        if ast.unparse(decorator).split('.')[-1] in NATIVE:
+            return True
+    return False
+
+
+def _suspends(function):
+    """Whether a function is a generator or a coroutine"""
+    if isinstance(function, ast.AsyncFunctionDef):
+        return True
+    nodes = list(function.body)
+    while nodes:
+        node = nodes.pop()
+        if isinstance(node, (ast.Yield, ast.YieldFrom, ast.Await)):
+            return True
+        if not isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef,
+                                 ast.Lambda)):
+            nodes.extend(ast.iter_child_nodes(node))
+    return False
+
+
+def _call(name, *args):
+    return ast.Expr(ast.Call(ast.Name(name, ast.Load()), [ast.Constant(a) for a in args], []))
+
+
+class Instrumented(object):
+    """
+    A cell rewritten with the probes of one profile
+
+    :param str code: The cell.
+    :param bool functions: Probe each function rather than each line.
+    """
+    def __init__(self, code, functions=False):
+        self.code = code
+        self.functions = functions
+        self.run = uuid.uuid4().hex[:8]
+        # The line number and the source or name of each probe
+        self.probes = []
+        self._lines = {}
+        self._source_lines = code.splitlines()
+        self._names = []
+        try:
+            tree = ast.parse(code)
+        except SyntaxError as e:
+            raise MagicError('Could not instrument the cell: {}'.format(e))
+        tree.body = self._body(tree.body, None)
+        ast.fix_missing_locations(tree)
+        self.source = ast.unparse(tree) + '\n'
+        # The line of the cell of each line of the source, from the nodes
+        # of the source parsed again, which are those of the tree
+        self.line_map = {}
+        for node, parsed in zip(ast.walk(tree), ast.walk(ast.parse(self.source))):
+            if type(node) is not type(parsed):
+                break
+            if getattr(parsed, 'lineno', None) is not None:
+                self.line_map.setdefault(parsed.lineno, node.lineno)
+
+    def _probe(self, lineno, label):
+        self.probes.append((lineno, label))
+        return len(self.probes) - 1
+
+    def _body(self, body, parent):
+        """Return the statements of a block with their probes"""
+        statements = []
+        last = parent
+        for node in body:
+            if not self.functions and node.lineno != last:
+                if node.lineno not in self._lines:
+                    line = self._source_lines[node.lineno - 1].strip()
+                    self._lines[node.lineno] = self._probe(node.lineno, line)
+                mark = _call('_mpk_m' + self.run, self._lines[node.lineno])
+                statements.append(ast.copy_location(mark, node))
+            self._children(node)
+            last = node.lineno
+            statements.append(node)
+        return statements
+
+    def _children(self, node):
+        function = isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef))
+        if function and _is_native(node):
+            return
+        if function or isinstance(node, ast.ClassDef):
+            self._names.append(node.name)
+        for field, value in ast.iter_fields(node):
+            if isinstance(value, list) and value and isinstance(value[0], ast.stmt):
+                setattr(node, field, self._body(value, node.lineno))
+            elif field == 'handlers':
+                for handler in value:
+                    handler.body = self._body(handler.body, handler.lineno)
+        if function and not _suspends(node):
+            self._wrap(node)
+        if function or isinstance(node, ast.ClassDef):
+            self._names.pop()
+
+    def _wrap(self, function):
+        """Run the body of a function between an entry and an exit probe"""
+        if self.functions:
+            exit_args = (self._probe(function.lineno, '.'.join(self._names)),)
+        else:
+            exit_args = ()
+        first = function.body[0]
+        enter = ast.Assign([ast.Name('_mpk_c', ast.Store())],
+                           ast.Call(ast.Name('_mpk_e' + self.run, ast.Load()), [], []))
+        leave = _call('_mpk_x' + self.run, *exit_args)
+        leave.value.args.append(ast.Name('_mpk_c', ast.Load()))
+        wrapper = ast.Try(function.body, [], [], [ast.copy_location(leave, first)])
+        function.body = [ast.copy_location(enter, first), ast.copy_location(wrapper, first)]
+
+    def program(self, calibration=CALIBRATION):
+        """Return the program running the cell with its probes"""
+        # A spare slot for the calibration
+        slots = len(self.probes) + 1
+        prelude = PRELUDE.format(slots=slots)
+        if self.functions:
+            prelude += FUNCTION_PROBES.format(run=self.run)
+            flush = 'pass'
+            probe = '_mpk_x{}({}, _mpk_c[1])'.format(self.run, slots - 1)
+        else:
+            prelude += LINE_PROBES.format(run=self.run)
+            flush = '_mpk_x{}(-1)'.format(self.run)
+            probe = '_mpk_m{}({})'.format(self.run, slots - 1)
+        return prelude + PROGRAM.format(code=self.source, flush=flush, probe=probe,
+                                        calibration=calibration, marker=MARKER, end=END,
+                                        run=self.run)
+
+    def fix_traceback(self, error):
+        """Give the lines of the cell in a traceback of the rewritten cell,
+        once :func:`~mpkernel.repl.fix_traceback` has been applied"""
+        return _STDIN_LINE.sub(
+            lambda m: m.group(1) + str(self.line_map.get(int(m.group(2)), m.group(2))), error)
+
+    def profile(self, record):
+        """Return the :class:`Profile` of the record the program printed,
+        None if it is missing or incomplete"""
+        if record is None:
+            return None
+        try:
+            elapsed, probe_us, calls, data = record.split()
+            data = binascii.a2b_base64(data)
+            slots = len(self.probes) + 1
+            size = len(data) // (2 * slots)
+            counters = struct.unpack('<{}{}'.format(2 * slots, {4: 'I', 8: 'Q'}[size]), data)
+        except (ValueError, KeyError, binascii.Error, struct.error):
+            return None
+        return Profile(self.probes, counters[:slots - 1], counters[slots:-1], int(elapsed),
+                       max(float(probe_us) / int(calls), 0.0), self.functions)
+
+
+class Profile(object):
+    """
+    The hits and time of each line or function of a profiled cell
+
+    :param list probes: The line number and source or name of each probe.
+    :param hits: The hits of each probe.
+    :param times: The microseconds of each probe.
+    :param int elapsed: The microseconds the cell ran for.
+    :param float probe_us: The cost of one probe in microseconds.
+    """
+    def __init__(self, probes, hits, times, elapsed, probe_us, functions=False):
+        self.probes = probes
+        self.hits = list(hits)
+        self.times = list(times)
+        self.elapsed = elapsed
+        self.probe_us = probe_us
+        self.functions = functions
+
+    def rows(self, sort='time'):
+        """Return the line number, source or name, hits and microseconds of
+        each probe that was hit"""
+        rows = [(lineno, label, hits, us)
+                for (lineno, label), hits, us in zip(self.probes, self.hits, self.times) if hits]
+        key = {'time': lambda row: (-row[3], row[0]), 'hits': lambda row: (-row[2], row[0]),
+               'line': lambda row: row[0]}[sort]
+        return sorted(rows, key=key)
+
+    def table(self, rows=20, sort='time'):
+        """Return the profile as a text table of the ``rows`` first rows"""
+        lines = [u'{:>6} {:>10} {:>11} {:>11} {:>7}  {}'.format(
+            'Line', 'Hits', 'Time ms', 'Per hit us', '% time',
+            'Function' if self.functions else 'Source')]
+        shown = self.rows(sort)
+        for lineno, label, hits, us in shown[:rows or None]:
+            lines.append(u'{:>6} {:>10} {:>11.3f} {:>11.1f} {:>6.1f}%  {}'.format(
+                lineno, hits, us / 1000.0, float(us) / hits,
+                100.0 * us / max(self.elapsed, 1), label))
+        if rows and len(shown) > rows:
+            lines.append(u'{:>6} ... {} more'.format('', len(shown) - rows))
+        probes = sum(self.hits)
+        cost = probes * self.probe_us
+        lines.append(u'Ran in {:.3f} ms; {} {} probes of {:.1f} us each took about {:.3f} ms '
+                     u'({:.0f}%)'.format(self.elapsed / 1000.0, probes,
+                                         'function' if self.functions else 'line',
+                                         self.probe_us, cost / 1000.0,
+                                         100.0 * cost / max(self.elapsed, 1)))
+        return u'\n'.join(lines)
+
+    def as_dict(self):
+        return {
+            'elapsed_us': self.elapsed,
+            'probe_us': round(self.probe_us, 3),
+            'rows': [{'line': lineno, 'label': label, 'hits': hits, 'us': us}
+                     for lineno, label, hits, us in self.rows('line')],
+        }
@@ -0,0 +1,216 @@
+"""
+mpy.py
+
+Precompile cells to micropython bytecode (.mpy) on the host with mpy-cross
+
+The device can only run a .mpy file by importing it, so a precompiled cell
+runs as a module: it starts with a copy of the public names in ``__main__``
+and the names it defines are copied back afterwards. Functions defined in a
+precompiled cell therefore see the globals as they were when the cell ran.
+
+A board is sent the .mpy inside the command, and imports it from a
+filesystem held in RAM that is mounted for the import, rather than from a
+file written to its flash.
+"""
+import os
+import re
+import base64
+import shlex
+import hashlib
+import tempfile
+import subprocess
+
+# Put on the same line as the cell's first statement would break compound
+# statements, so it takes a line of its own and tracebacks are corrected
+CELL_HEADER = 'from __main__ import *\n'
+CELL_SOURCE = 'cell'
+
+LOADER = """\
+def _mpk_load(g):
+    import sys
+    if {path!r} not in sys.path:
+        sys.path.append({path!r})
+    try:
+        for k, v in __import__({module!r}).__dict__.items():
+            if k[:2] != '__':
+                g[k] = v
+    finally:
+        sys.modules.pop({module!r}, None)
+_mpk_load(globals())
+del _mpk_load
+"""
+
+# A filesystem with the one file, as the device's VFS expects of a mounted
+# object, see micropython's tests/micropython/import_mpy_native.py
+RAM_LOADER = """\
+def _mpk_load(g, data):
+    import io, sys
+    try:
+        from vfs import mount, umount
+    except ImportError:
+        from os import mount, umount
+
+    class File(io.IOBase):
+        def __init__(self, data):
+            self.data = data
+            self.pos = 0
+
+        def readinto(self, buf):
+            n = min(len(buf), len(self.data) - self.pos)
+            buf[:n] = self.data[self.pos:self.pos + n]
+            self.pos += n
+            return n
+
+        def ioctl(self, request, arg):
+            return 0
+
+    class FS:
+        def __init__(self, data):
+            self.data = data
+
+        def mount(self, readonly, mkfs):
+            pass
+
+        def umount(self):
+            pass
+
+        def stat(self, path):
+            if path != {file!r}:
+                raise OSError(2)
+            return (0x8000, 0, 0, 0, 0, 0, len(self.data), 0, 0, 0)
+
+        def open(self, path, mode):
+            return File(self.data)
+
+    try:
+        umount({mount!r})
+    except OSError:
+        pass
+    mount(FS(data), {mount!r})
+    sys.path.append({mount!r})
+    try:
+        for k, v in __import__({module!r}).__dict__.items():
+            if k[:2] != '__':
+                g[k] = v
+    finally:
+        sys.path.remove({mount!r})
+        umount({mount!r})
+        sys.modules.pop({module!r}, None)
+_mpk_load(globals(), memoryview(__import__('binascii').a2b_base64({data!r})))
+del _mpk_load
+"""
+
+# Where a board mounts the filesystem of a compiled cell
+RAM_MOUNT = '/_mpk'
+
+
+class MpyCrossError(Exception):
+    """mpy-cross rejected the source; the message is its output"""
+
+
+class MpyCache(object):
+    """
+    .mpy files keyed by the hash of their source, in an on-disk directory
+
+    :param directory: Where the files are kept.
+    :param int max_bytes: Total size above which the least recently used
+      files are removed.
+    :param mpy_cross: The mpy-cross executable, with any arguments, e.g.
+      ``mpy-cross -march=armv7m``.
+    """
+    def __init__(self, directory=None, max_bytes=16 * 1024 * 1024,
+                 mpy_cross='mpy-cross'):
+        self.directory = directory or default_cache_dir()
+        self.max_bytes = max_bytes
+        self.command = shlex.split(mpy_cross)
+        self.hits = 0
+        self.misses = 0
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+    def key(self, source, name=CELL_SOURCE):
+        h = hashlib.sha256(source.encode('utf-8'))
+        # The same source compiles differently for other targets, and the
+        # name is part of the .mpy
+        h.update(' '.join(self.command + [name]).encode('utf-8'))
+        return h.hexdigest()
+
+    def module_name(self, source, name=CELL_SOURCE):
+        """The name the cached file is imported as"""
+        return 'mpk_' + self.key(source, name)[:24]
+
+    def path(self, source, name=CELL_SOURCE):
+        return os.path.join(self.directory, self.module_name(source, name) + '.mpy')
+
+    def compile(self, source, name=CELL_SOURCE):
+        """Return the path of the .mpy for ``source``, compiling it if needed.
+
+        :param name: The file name shown in tracebacks.
+        :raises MpyCrossError: If ``source`` does not compile.
+        :raises OSError: If mpy-cross could not be run.
+        """
+        path = self.path(source, name)
+        if os.path.exists(path):
+            self.hits += 1
+            # The modification time orders the files for eviction
+            os.utime(path, None)
+            return path
+        self.misses += 1
+        fd, src = tempfile.mkstemp(suffix='.py', dir=self.directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(source.encode('utf-8'))
+            tmp = src[:-3] + '.tmp'
+            proc = subprocess.Popen(self.command + ['-s', name, '-o', tmp, src],
+                                    stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            output = proc.communicate()[0].decode('utf-8', 'replace')
+            if proc.returncode:
+                raise MpyCrossError(output.replace(src, name))
+            os.rename(tmp, path)
+        finally:
+            for leftover in (src, src[:-3] + '.tmp'):
+                if os.path.exists(leftover):
+                    os.remove(leftover)
+        self.evict()
+        return path
+
+    def evict(self):
+        """Remove the least recently used files until under ``max_bytes``"""
+        entries = []
+        for filename in os.listdir(self.directory):
+            if filename.endswith('.mpy'):
+                st = os.stat(os.path.join(self.directory, filename))
+                entries.append((st.st_mtime, st.st_size, filename))
+        total = sum(size for _, size, _ in entries)
+        for _, size, filename in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            os.remove(os.path.join(self.directory, filename))
+            total -= size
+
+
+def default_cache_dir():
+    return os.path.join(os.path.expanduser('~'), '.cache', 'mpkernel', 'mpy')
+
+
+def cell_source(code):
+    """Return a cell's source as a module that starts from ``__main__``'s names"""
+    return CELL_HEADER + code
+
+
+def loader(directory, module):
+    """Return the device command importing ``module`` from ``directory`` into ``__main__``"""
+    return LOADER.format(path=directory, module=module)
+
+
+def ram_loader(data, module, mount=RAM_MOUNT):
+    """Return the device command importing the .mpy ``data`` as ``module``
+    from a filesystem in RAM mounted at ``mount``, into ``__main__``"""
+    return RAM_LOADER.format(file='/' + module + '.mpy', mount=mount, module=module,
+                             data=base64.b64encode(data).decode('ascii'))
+
+
+def fix_line_numbers(error, name=CELL_SOURCE):
+    """Correct the line numbers of a precompiled cell's traceback for the header"""
+    return re.sub(r'(File "{}", line )(\d+)'.format(re.escape(name)),
+                  lambda m: m.group(1) + str(int(m.group(2)) - 1), error)
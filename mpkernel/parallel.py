@@ -0,0 +1,140 @@
+"""
+parallel.py
+
+Run a cell on a pool of interpreters at once, for ``%%parallel``
+
+Each worker compiles the cell once, then runs it for one input after another,
+taking the next input as soon as it is free, in a raw REPL exchange that
+binds the input to the cell's loop variable. The inputs are the ``repr`` of
+the values of an expression evaluated by the kernel's own interpreter, so
+they must read back as the same values. The output of each input is held
+until that of every input before it has been shown, so it reads as if the
+inputs had run in turn, and the value each run leaves in ``result`` is
+collected, in order, into a list in the kernel's interpreter.
+"""
+import re
+
+from .magics import MagicError, MagicParser
+
+MARKER = u'\x1e_mpk_result'
+
+# Prints the repr of each value of the expression on a line of its own
+INPUTS = """\
+for _mpk_x in ({expression}):
+    print(repr(_mpk_x))
+del _mpk_x
+"""
+
+SETUP = """\
+_mpk_cell = compile({cell!r}, '<stdin>', 'exec')
+"""
+
+RUN = """\
+{target} = {value}
+exec(_mpk_cell)
+print({marker!r}, repr(globals().pop('result')) if 'result' in globals() else '', sep='', end='')
+"""
+
+_LOOP = re.compile(r'(?:^|\s)([A-Za-z_]\w*(?:\s*,\s*[A-Za-z_]\w*)*)\s+in\s+(\S.*)$')
+
+
+def parallel_args(line):
+    """Parse the arguments of ``%%parallel``, returning the loop variable
+    and the expression of its values, both None without a loop, and the
+    options"""
+    match = _LOOP.search(line)
+    target = expression = None
+    if match:
+        target, expression = match.group(1), match.group(2).strip()
+        line = line[:match.start(1)]
+    parser = MagicParser('parallel')
+    parser.add_argument('-n', '--workers', type=int, default=0,
+                        help='interpreters to run the cell on, by default parallel_workers')
+    parser.add_argument('-X', dest='options', action='append', default=[],
+                        help="the workers' micropython -X options, e.g. heapsize=4M")
+    parser.add_argument('-o', '--output', default='results',
+                        help="the list the runs' results are left in")
+    args = parser.parse(line)
+    if args.workers < 0:
+        raise MagicError('%parallel needs at least one worker')
+    return target, expression, args
+
+
+def parse_inputs(output):
+    """Return the repr of each input printed by :data:`INPUTS`"""
+    return [line for line in output.splitlines() if line.strip()]
+
+
+class ParallelRun(object):
+    """
+    The inputs of a ``%%parallel`` cell, handed out to the workers, and
+    what each run printed and left in ``result``
+
+    A run that raises stops the inputs after it from being handed out.
+
+    :param str target: The cell's loop variable.
+    :param list values: The ``repr`` of each input.
+    """
+    def __init__(self, target, values):
+        self.target = target
+        self.values = values
+        self.outputs = [None] * len(values)
+        self.results = [None] * len(values)
+        # The error of each run that raised, by the index of its input
+        self.errors = {}
+        # Set to stop handing out inputs, e.g. on an interrupt
+        self.stopped = False
+        self._next = 0
+        # The inputs whose output has been shown, and whether the last of
+        # them raised
+        self._shown = 0
+        self._ended = False
+
+    def __len__(self):
+        return len(self.values)
+
+    def take(self):
+        """Return the index of the next input to run, None once there is none"""
+        if self.stopped or self.errors or self._next >= len(self.values):
+            return None
+        self._next += 1
+        return self._next - 1
+
+    def program(self, index):
+        return RUN.format(target=self.target, value=self.values[index], marker=MARKER)
+
+    def finish(self, index, output, error=u''):
+        """Record what the run of an input printed and the error it raised"""
+        if MARKER in output:
+            output, _, result = output.rpartition(MARKER)
+            self.results[index] = result or None
+        self.outputs[index] = output
+        if error.strip():
+            self.errors[index] = error
+
+    def ready(self):
+        """Return the output of the inputs that finished since the last call
+        and of which every input before them has finished, up to the first
+        that raised"""
+        parts = []
+        while (not self._ended and self._shown < len(self.outputs) and
+               self.outputs[self._shown] is not None):
+            parts.append(self.outputs[self._shown])
+            self._ended = self._shown in self.errors
+            self._shown += 1
+        return u''.join(parts)
+
+    @property
+    def error(self):
+        """The index and error of the first input that raised, else None"""
+        if not self.errors:
+            return None
+        index = min(self.errors)
+        return index, self.errors[index]
+
+    def results_program(self, name):
+        """Return the program leaving the results in ``name``, None if no
+        run set ``result``"""
+        if not any(self.results):
+            return None
+        return '{} = [{}]\n'.format(name, ', '.join(r or 'None' for r in self.results))
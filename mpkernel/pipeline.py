@@ -0,0 +1,103 @@
+"""
+pipeline.py
+
+Run cells that are queued together, as in Run All, as a single program
+
+The program runs each cell in turn and prints a marker after each but the
+last, so the cells are sent in one transfer and none waits for a round trip
+to the interpreter before it starts. The output is split at the markers as
+it arrives, each part going to its own cell. A cell that raises ends the
+program, and its exception is the raw REPL's error, which
+:func:`~mpkernel.repl.fix_traceback` makes read as if the cell had run alone.
+"""
+import uuid
+
+from .repl import RawReplReader
+
+PIPELINE = """\
+for _mpk_cell in {cells!r}:
+    exec(_mpk_cell)
+    print({marker!r}, end='')
+del _mpk_cell
+exec({last!r})
+"""
+
+
+class Pipeline(object):
+    """
+    Cells sent to the interpreter as one program, and how far its output
+    has been read
+
+    :param list requests: The ``(msg_id, code)`` of each cell, in order.
+    """
+    def __init__(self, requests):
+        self.ids = [msg_id for msg_id, _ in requests]
+        self.cells = [code for _, code in requests]
+        self.marker = u'\x1e_mpk_{}\x1e'.format(uuid.uuid4().hex[:8])
+        # The index of the cell whose output is read next
+        self.position = 0
+
+    def __len__(self):
+        return len(self.cells)
+
+    @property
+    def next_id(self):
+        """The msg_id of the cell whose output is read next, None at the end"""
+        return self.ids[self.position] if self.position < len(self.ids) else None
+
+    def program(self):
+        return PIPELINE.format(cells=self.cells[:-1], marker=self.marker,
+                               last=self.cells[-1])
+
+    def reader(self):
+        """Return the reader of the next cell's output and move past it"""
+        self.position += 1
+        if self.position == len(self.cells):
+            return RawReplReader()
+        return CellReader(self.marker)
+
+
+class CellReader(object):
+    """
+    Incrementally read one cell's part of a pipeline's output
+
+    :meth:`feed` returns the output up to the marker that ends the cell, and
+    what follows it is left in ``rest`` for the next cell. If the program
+    ends first, because the cell raised, the rest of the raw REPL reply is
+    read as by :class:`RawReplReader` and ``ended`` is set.
+    """
+    def __init__(self, marker):
+        self.marker = marker
+        self.done = False
+        self.ended = False
+        self.rest = u''
+        self._raw = RawReplReader()
+        self._held = u''
+
+    @property
+    def error(self):
+        return self._raw.error
+
+    def feed(self, data):
+        if self.ended:
+            out = self._raw.feed(data)
+            self.done = self._raw.done
+            return out
+        text, self._held = self._held + data, u''
+        eot = text.find(u'\x04')
+        end = text.find(self.marker, 0, len(text) if eot < 0 else eot)
+        if end >= 0:
+            self.done = True
+            self.rest = text[end + len(self.marker):]
+            return text[:end]
+        if eot >= 0:
+            self.ended = True
+            out = self._raw.feed(text)
+            self.done = self._raw.done
+            return out
+        # Text that may be the start of the marker is held back
+        for size in range(min(len(text), len(self.marker) - 1), 0, -1):
+            if self.marker.startswith(text[-size:]):
+                self._held = text[-size:]
+                return text[:-size]
+        return text
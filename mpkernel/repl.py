@@ -0,0 +1,266 @@
+"""
+repl.py
+
+Pieces of the micropython REPL protocol shared by the kernels
+"""
+import io
+import os
+import time
+from html import escape as html_escape
+
+
+class RemoteError(Exception):
+    """
+    An exception raised by code running on the device, whose message is the
+    traceback it printed
+    """
+
+
+class OutputStream(object):
+    """
+    Coalesce device output into a small number of writes
+
+    Text passed to :meth:`write` is held back until ``max_bytes`` characters
+    are pending or ``interval`` seconds have passed since the last flush, then
+    handed to ``send`` in a single call.
+    """
+    def __init__(self, send, interval=0.05, max_bytes=4096):
+        self.send = send
+        self.interval = interval
+        self.max_bytes = max_bytes
+        self._pending = []
+        self._size = 0
+        self._last = time.time()
+        # Time spent in send, for the relay phase of the cell's timings
+        self.send_seconds = 0.0
+
+    def write(self, text):
+        if not text:
+            return
+        self._pending.append(text)
+        self._size += len(text)
+        if (self._size >= self.max_bytes or
+                time.time() - self._last >= self.interval):
+            self.flush()
+
+    def flush(self):
+        if self._pending:
+            start = time.time()
+            self.send(u''.join(self._pending))
+            self.send_seconds += time.time() - start
+            self._pending = []
+            self._size = 0
+        self._last = time.time()
+
+
+class OutputLimit(object):
+    """
+    Keep the output a cell leaves in the notebook to a bounded head and tail
+
+    The first ``head_bytes`` characters written are passed to ``send``. All
+    the output is then written to the log file ``path`` instead, and the
+    notebook gets a single display, updated in place at most every
+    ``interval`` seconds, of where the log is and the last ``tail_bytes``
+    characters. Memory use is constant however much is written.
+
+    :param send: Sends stream text.
+    :param display: Called with a display's mime bundle and whether it updates
+      the one shown before.
+    :param path: The log file, created only if the output overflows.
+    :param int head_bytes: 0 for no limit.
+    :param bool live: Send output as it is written, otherwise only on
+      :meth:`close`.
+    """
+    def __init__(self, send, display, path, head_bytes=65536, tail_bytes=8192,
+                 interval=0.5, live=True):
+        self.send = send
+        self.display = display
+        self.path = path
+        self.head_bytes = head_bytes
+        self.tail_bytes = tail_bytes
+        self.interval = interval
+        self.live = live
+        self.head = []
+        self.size = 0
+        self.tail = u''
+        self.log = None
+        self._shown = None
+        self._pending = []
+
+    def write(self, text):
+        if not self.head_bytes:
+            (self.send if self.live else self._pending.append)(text)
+            return
+        if self.log is None:
+            room = self.head_bytes - self.size
+            self.size += len(text)
+            if len(text) <= room:
+                self._send(text)
+                return
+            self._send(text[:room])
+            self._spill()
+            text = text[room:]
+        else:
+            self.size += len(text)
+        self.log.write(text)
+        # With the character before it, to tell if it starts a line
+        self.tail = (self.tail + text)[-(self.tail_bytes + 1):]
+        if self.live and (self._shown is None or time.time() - self._shown >= self.interval):
+            self._show()
+
+    def _send(self, text):
+        # The head is kept for the log, should the output overflow
+        self.head.append(text)
+        if self.live:
+            self.send(text)
+        else:
+            self._pending.append(text)
+
+    def _spill(self):
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.log = io.open(self.path, 'w', encoding='utf-8', errors='surrogateescape')
+        self.log.write(u''.join(self.head))
+        self.head = []
+
+    def _show(self):
+        tail = self.tail
+        if len(tail) > self.tail_bytes:
+            before, tail = tail[0], tail[1:]
+            if before != '\n' and '\n' in tail:
+                tail = tail[tail.index('\n') + 1:]
+        skipped = self.size - self.head_bytes - len(tail)
+        notice = u'[{} characters not shown, the full output is in {}]\n'.format(
+            skipped, self.path)
+        link = u'<a href="{0}" target="_blank">{0}</a>'.format(html_escape(self.path))
+        bundle = {
+            'text/plain': notice + tail,
+            'text/html': u'<pre>[{} characters not shown, the full output is in {}]\n{}'
+                         u'</pre>'.format(skipped, link, html_escape(tail)),
+        }
+        self.display(bundle, self._shown is not None)
+        self._shown = time.time()
+
+    def close(self):
+        """Send what is held back, and the final tail"""
+        if self._pending:
+            self.send(u''.join(self._pending))
+            self._pending = []
+        if self.log is not None:
+            self.log.close()
+            self._show()
+
+
+class RawReplReader(object):
+    """
+    Incrementally split the reply to a raw REPL command
+
+    The reply is the command's output, a ``\\x04``, any exception message,
+    another ``\\x04`` and then the ``>`` prompt. :meth:`feed` returns the
+    output as it arrives; the exception message is collected in ``error``.
+    Pass ``empty=b''`` to read bytes rather than text.
+    """
+    OUTPUT, ERROR, PROMPT = range(3)
+
+    def __init__(self, empty=u''):
+        self.state = self.OUTPUT
+        self.done = False
+        self.error = empty
+        if isinstance(empty, bytes):
+            self._eot, self._prompt = b'\x04', b'>'
+        else:
+            self._eot, self._prompt = u'\x04', u'>'
+
+    def feed(self, data):
+        """Consume ``data`` and return the output that is safe to emit"""
+        out = data[:0]
+        while data and not self.done:
+            if self.state == self.PROMPT:
+                self.done = data.startswith(self._prompt)
+                break
+            end = data.find(self._eot)
+            chunk = data if end < 0 else data[:end]
+            if self.state == self.OUTPUT:
+                out += chunk
+            else:
+                self.error += chunk
+            if end < 0:
+                break
+            self.state += 1
+            data = data[end + 1:]
+        return out
+
+
+class RecordFilter(object):
+    """
+    Pass a program's output on to ``stream`` without the record the kernel's
+    own code printed into it between ``marker`` and ``end``, whose text is
+    left in ``record``
+
+    Text that may be the start of the record is held back until more
+    arrives, or until :meth:`close` once the output has ended.
+    """
+    def __init__(self, stream, marker, end=u'\x1e'):
+        self.stream = stream
+        self.marker = marker
+        self.end = end
+        self.record = None
+        # The record read so far, None outside it
+        self._record = None
+        self._held = u''
+
+    def write(self, text):
+        text, self._held = self._held + text, u''
+        while text:
+            if self._record is not None:
+                end = text.find(self.end)
+                if end < 0:
+                    self._record += text
+                    return
+                self.record = self._record + text[:end]
+                self._record = None
+                text = text[end + len(self.end):]
+                continue
+            start = text.find(self.marker)
+            if start >= 0:
+                self.stream.write(text[:start])
+                self._record = u''
+                text = text[start + len(self.marker):]
+                continue
+            for size in range(min(len(text), len(self.marker) - 1), 0, -1):
+                if self.marker.startswith(text[-size:]):
+                    self._held = text[-size:]
+                    text = text[:-size]
+                    break
+            self.stream.write(text)
+            return
+
+    def flush(self):
+        self.stream.flush()
+
+    def close(self):
+        """Pass on the text held back, once the output has ended"""
+        held, self._held = self._held, u''
+        if held:
+            self.stream.write(held)
+        self.stream.flush()
+
+
+def split_exception(error):
+    """Return the name, value and traceback lines of a micropython exception message"""
+    traceback = error.strip().splitlines()
+    ename, _, evalue = traceback[-1].partition(':') if traceback else ('', '', '')
+    return ename, evalue.strip(), traceback
+
+
+def fix_traceback(error, wrappers=1):
+    """Make the traceback of a cell the kernel ran with ``exec`` inside
+    ``wrappers`` programs of its own read as if the cell had been sent
+    alone, without the frames of those programs"""
+    lines = error.splitlines(True)
+    frames = [i for i, line in enumerate(lines) if line.startswith('  File ')]
+    if len(frames) > wrappers:
+        for i in reversed(frames[:wrappers]):
+            del lines[i]
+    return ''.join(lines).replace('File "<string>"', 'File "<stdin>"')
@@ -0,0 +1,86 @@
+"""
+replay.py
+
+Rebuild the interpreter's state after a restart by running again the cells
+that succeeded before it
+
+The cells are sent as a single program that runs each of them in turn, so a
+restore is one transfer and one exec however many cells there are, and its
+time grows with the size of the code rather than the number of cells. A cell
+that fails is skipped and the rest still run. The program prints the cells'
+own output and, last, the indices of those that failed.
+"""
+import ast
+
+REPLAY = """\
+_mpk_failed = []
+for _mpk_i, _mpk_cell in enumerate({cells!r}):
+    try:
+        exec(_mpk_cell)
+    except Exception:
+        _mpk_failed.append(_mpk_i)
+print({marker!r}, _mpk_failed)
+del _mpk_failed, _mpk_i, _mpk_cell
+"""
+
+MARKER = '_mpk_replayed'
+
+
+class CellLog(object):
+    """
+    The source of the cells that ran without error, in order
+
+    :param int max_bytes: Source kept, 0 for no limit. Past this no more
+      cells are recorded, since the state could no longer be rebuilt from
+      them, and the log is marked ``truncated``.
+    """
+    def __init__(self, max_bytes=1024 * 1024):
+        self.max_bytes = max_bytes
+        self.cells = []
+        self.size = 0
+        self.truncated = False
+
+    def __len__(self):
+        return len(self.cells)
+
+    def record(self, code):
+        code = code.strip()
+        if not code or self.truncated:
+            return
+        if self.max_bytes and self.size + len(code) > self.max_bytes:
+            self.truncated = True
+            return
+        self.cells.append(code)
+        self.size += len(code)
+
+    def extend(self, other):
+        """Append the cells of another log, which ran after these"""
+        for code in other.cells:
+            self.record(code)
+        self.truncated = self.truncated or other.truncated
+
+    def clear(self):
+        self.cells = []
+        self.size = 0
+        self.truncated = False
+
+    def program(self):
+        """Return the program running all the cells"""
+        return REPLAY.format(cells=self.cells, marker=MARKER)
+
+    def replayed(self, output):
+        """Return the log of the cells that succeeded, given the output of
+        :meth:`program`, or None if it did not finish"""
+        for line in reversed(output.splitlines()):
+            if line.startswith(MARKER):
+                try:
+                    failed = set(ast.literal_eval(line[len(MARKER):].strip()))
+                except (ValueError, SyntaxError):
+                    return None
+                log = CellLog(self.max_bytes)
+                for i, code in enumerate(self.cells):
+                    if i not in failed:
+                        log.record(code)
+                log.truncated = self.truncated
+                return log
+        return None
@@ -0,0 +1,34 @@
+"""
+startup.py
+
+Overlap the slow parts of a kernel's startup with the rest of it
+
+Starting the interpreter or opening the board takes about as long as the
+kernel's own startup, so it is done in a background thread while the kernel
+binds its sockets and starts answering requests, and the first cell waits
+for it.
+"""
+import threading
+from concurrent.futures import Future
+
+
+def background(func, *args):
+    """Call ``func(*args)`` in a thread and return a Future of its result.
+
+    The thread is a daemon, unlike those of an executor, so that a call that
+    hangs does not hold up the kernel's exit.
+    """
+    future = Future()
+
+    def run():
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            future.set_result(func(*args))
+        except Exception as e:
+            future.set_exception(e)
+
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.start()
+    return future
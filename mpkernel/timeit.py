@@ -0,0 +1,294 @@
+"""
+timeit.py
+
+Time a statement on the device, for ``%timeit`` and ``%%timeit``
+
+The statement is run in a loop inside a function on the device, as by the
+standard library's ``timeit``, and the whole measurement runs there in one
+exchange: the number of loops is found by trying 1, 2, 5, 10, 20, 50...
+loops until one run takes ``target`` seconds, then each repeat collects
+garbage and times that many loops with ``time.ticks_us()``. The raw time of
+every repeat comes back in one record stripped from the output, and the
+statistics are worked out on the host. Results can be appended to a JSON
+lines file; a statement timed before on the same target is then timed with
+the same number of loops, and its median is compared with the last run.
+"""
+import io
+import os
+import re
+import json
+import math
+import time
+
+from .magics import MagicError, MagicParser
+from .repl import fix_traceback
+
+MARKER = u'\x1e_mpk_timeit'
+END = u'\x1e'
+
+PROGRAM = """\
+def _mpk_inner(_mpk_n, _mpk_tu=__import__('time').ticks_us, _mpk_td=__import__('time').ticks_diff):
+{setup}
+    _mpk_t = _mpk_tu()
+    for _mpk_i in range(_mpk_n):
+{stmt}
+    return _mpk_td(_mpk_tu(), _mpk_t)
+def _mpk_timeit(loops, repeat, target):
+    import gc
+    base = 1
+    while not loops:
+        for n in (base, 2 * base, 5 * base):
+            gc.collect()
+            if _mpk_inner(n) >= target:
+                loops = n
+                break
+        base *= 10
+    times = []
+    for _ in range(repeat):
+        gc.collect()
+        times.append(_mpk_inner(loops))
+    print({marker!r}, loops, *times, end={end!r})
+try:
+    _mpk_timeit({loops}, {repeat}, {target})
+finally:
+    del _mpk_inner, _mpk_timeit
+"""
+
+# The options at the start of a %timeit line, before the statement
+_OPTIONS = re.compile(r'\s*(?:-[nrt](?:\s+|(?=[\d.]))[\d.]+(?=\s|$)|(?:-s|--save)(?:\s+|=)\S+)')
+
+_INNER_FRAME = re.compile(r'(File "<stdin>", line )(\d+)(, in )_mpk_inner')
+
+
+def timeit_args(line):
+    """Split the line of ``%timeit`` into its options and the rest of the
+    line, returning the options and the rest"""
+    end = 0
+    while True:
+        match = _OPTIONS.match(line, end)
+        if not match:
+            break
+        end = match.end()
+    parser = MagicParser('timeit')
+    parser.add_argument('-n', '--loops', type=int, default=0,
+                        help='loops per repeat, by default enough for one to take -t seconds')
+    parser.add_argument('-r', '--repeat', type=int, default=7, help='repeats timed')
+    parser.add_argument('-t', '--target', type=float, default=0.2,
+                        help='seconds a repeat should take when the loops are found')
+    parser.add_argument('-s', '--save',
+                        help='JSON lines file the result is appended to and compared with')
+    args = parser.parse(line[:end])
+    if args.loops < 0 or args.repeat < 1 or args.target <= 0:
+        raise MagicError('%timeit needs a positive number of loops, repeats and seconds')
+    return args, line[end:].strip()
+
+
+def _indent(code, spaces):
+    lines = code.rstrip('\n').splitlines() or ['pass']
+    return '\n'.join(' ' * spaces + line for line in lines)
+
+
+def format_time(us, precision=3):
+    """Return a duration in microseconds in the unit that suits it"""
+    for unit, scale in (('s', 1e6), ('ms', 1e3), ('us', 1.0)):
+        if us >= scale:
+            break
+    else:
+        unit, scale = 'ns', 1e-3
+    return u'{:.{}g} {}'.format(us / scale, precision, unit)
+
+
+class Timeit(object):
+    """
+    One ``%timeit`` or ``%%timeit``: the statement, its setup and the
+    program timing it on the device
+
+    :param str line: The magic's line.
+    :param str body: The cell body of ``%%timeit``, whose line is then the
+      setup; None for ``%timeit``, whose line is the statement.
+    :param str target: What the statement runs on, e.g. the device, so that
+      saved results are only compared with others from the same one.
+    """
+    def __init__(self, line, body=None, target=u''):
+        self.args, rest = timeit_args(line)
+        if body is None:
+            self.statement, self.setup = rest, u''
+            # The cell line of the first line of each
+            self._lines = (1, 1)
+        else:
+            self.statement, self.setup = body.rstrip('\n'), rest
+            self._lines = (1, 2)
+        if not self.statement.strip():
+            raise MagicError('Give the statement to time')
+        self.target = target
+        self.loops = self.args.loops
+        self.previous = None
+        if self.args.save:
+            self.previous = last_saved(self.args.save, self.statement, self.setup, target)
+            if self.previous and not self.loops:
+                # Timed as before, so that the runs compare
+                self.loops = self.previous['loops']
+        self.source = PROGRAM.format(setup=_indent(self.setup, 4),
+                                     stmt=_indent(self.statement, 8),
+                                     marker=MARKER, end=END, loops=self.loops,
+                                     repeat=self.args.repeat, target=int(self.args.target * 1e6))
+        try:
+            compile(self.source, '<stdin>', 'exec')
+        except SyntaxError as e:
+            raise MagicError('SyntaxError: {} (line {})'.format(e.msg, self._cell_line(e.lineno)))
+
+    def _cell_line(self, line):
+        """Return the line of the cell of a line of the program"""
+        first_stmt = 4 + (len(self.setup.rstrip('\n').splitlines()) or 1)
+        if line < first_stmt:
+            return line - 2 + self._lines[0]
+        return line - first_stmt + self._lines[1]
+
+    def fix_traceback(self, error):
+        """Make a traceback of the program read as if the statement had
+        been run as a cell"""
+        return _INNER_FRAME.sub(
+            lambda m: '{}{}{}<module>'.format(m.group(1), self._cell_line(int(m.group(2))),
+                                              m.group(3)),
+            fix_traceback(error, 2))
+
+    def result(self, record):
+        """Return the :class:`TimeitResult` of the record the program
+        printed, None if it is missing or incomplete"""
+        try:
+            values = [int(value) for value in (record or '').split()]
+        except ValueError:
+            return None
+        if len(values) < 2:
+            return None
+        return TimeitResult(values[0], values[1:], self.statement, self.setup, self.target)
+
+    def save(self, result):
+        """Append the result to the --save file, returning the comparison
+        with the last run saved, if any"""
+        if not self.args.save:
+            return None
+        save(self.args.save, result)
+        if self.previous is None:
+            return None
+        return result.compare(self.previous)
+
+
+class TimeitResult(object):
+    """
+    The time of each repeat of a statement, in microseconds for ``loops``
+    loops, and its statistics per loop
+    """
+    def __init__(self, loops, timings, statement=u'', setup=u'', target=u'', saved=None):
+        self.loops = loops
+        self.timings = list(timings)
+        self.statement = statement
+        self.setup = setup
+        self.target = target
+        self.saved = saved or time.strftime('%Y-%m-%dT%H:%M:%S')
+
+    @property
+    def per_loop(self):
+        return sorted(float(timing) / self.loops for timing in self.timings)
+
+    @property
+    def mean(self):
+        return sum(self.per_loop) / len(self.timings)
+
+    @property
+    def stdev(self):
+        """The sample standard deviation, 0 for a single repeat"""
+        if len(self.timings) < 2:
+            return 0.0
+        mean = self.mean
+        return math.sqrt(sum((t - mean) ** 2 for t in self.per_loop) / (len(self.timings) - 1))
+
+    def percentile(self, percent):
+        """Return the percentile of the time per loop, interpolated between
+        the repeats"""
+        per_loop = self.per_loop
+        position = (len(per_loop) - 1) * percent / 100.0
+        low = int(math.floor(position))
+        high = min(low + 1, len(per_loop) - 1)
+        return per_loop[low] + (per_loop[high] - per_loop[low]) * (position - low)
+
+    def stats(self):
+        return {
+            'mean': self.mean,
+            'stdev': self.stdev,
+            'min': self.per_loop[0],
+            'median': self.percentile(50),
+            'p90': self.percentile(90),
+            'max': self.per_loop[-1],
+        }
+
+    def __str__(self):
+        stats = self.stats()
+        runs = len(self.timings)
+        return (u'{} ± {} per loop (mean ± std. dev. of {} run{}, {:,} loop{} each)\n'
+                u'min {}, median {}, p90 {}, max {}'.format(
+                    format_time(stats['mean']), format_time(stats['stdev']),
+                    runs, '' if runs == 1 else 's', self.loops, '' if self.loops == 1 else 's',
+                    format_time(stats['min']), format_time(stats['median']),
+                    format_time(stats['p90']), format_time(stats['max'])))
+
+    def as_dict(self):
+        """The result as it is saved, times in microseconds"""
+        return {
+            'statement': self.statement,
+            'setup': self.setup,
+            'target': self.target,
+            'saved': self.saved,
+            'loops': self.loops,
+            'timings_us': self.timings,
+            'per_loop_us': dict((k, round(v, 4)) for k, v in self.stats().items()),
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['loops'], data['timings_us'], data.get('statement', u''),
+                   data.get('setup', u''), data.get('target', u''), data.get('saved'))
+
+    def compare(self, previous):
+        """Return the change of the median against an earlier result, as a
+        dict or a :class:`TimeitResult`"""
+        if isinstance(previous, dict):
+            previous = TimeitResult.from_dict(previous)
+        before, after = previous.percentile(50), self.percentile(50)
+        change = (after - before) / before if before else 0.0
+        return u'median {:+.1%} ({} -> {}) against the run saved {}'.format(
+            change, format_time(before), format_time(after), previous.saved)
+
+
+def save(path, result):
+    """Append a result to a JSON lines file"""
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    with io.open(path, 'a', encoding='utf-8') as f:
+        f.write(json.dumps(result.as_dict(), sort_keys=True) + u'\n')
+
+
+def load(path):
+    """Return the results saved in a JSON lines file, oldest first"""
+    results = []
+    try:
+        with io.open(path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    results.append(json.loads(line))
+                except ValueError:
+                    continue
+    except (IOError, OSError):
+        pass
+    return results
+
+
+def last_saved(path, statement, setup=u'', target=u''):
+    """Return the last result saved for the statement on the target, None
+    if there is none"""
+    for data in reversed(load(path)):
+        if (data.get('statement'), data.get('setup', u''), data.get('target', u'')) == (
+                statement, setup, target):
+            return data
+    return None
@@ -91,8 +91,12 @@ setup(
     test_suite='tests',
     tests_require=[
     ],
+    # The unix kernel overrides ipykernel 7's shell dispatch, and runs the
+    # cells it handles itself in tasks with their own context (3.11)
+    python_requires='>=3.11',
     install_requires=[
         'jupyter>=1.0.0',
+        'ipykernel>=7,<8',
         'pyserial>=2.7'
         ],
 
@@ -113,8 +117,9 @@ setup(
         'Natural Language :: English',
         'Programming Language :: Python',
         'Programming Language :: Python :: 3',
-        'Programming Language :: Python :: 3.3',
-        'Programming Language :: Python :: 3.4',
+        'Programming Language :: Python :: 3 :: Only',
+        'Programming Language :: Python :: 3.11',
+        'Programming Language :: Python :: 3.12',
         'License :: OSI Approved :: MIT License'
         ]
 )
@@ -0,0 +1,146 @@
+"""
+broadcast.py
+
+Run a cell on several boards at once
+
+Each board is driven from a thread of a pool, so a cell takes as long as the
+slowest board rather than the sum of all of them. Only the kernel's thread
+may send messages, so the boards' output is passed back to it through a
+queue, and either interleaved line by line with each board's label or
+grouped by board as each one finishes.
+"""
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from mpkernel.repl import RemoteError, split_exception
+
+
+def parse_devices(entries):
+    """Return ``(label, device)`` pairs of ``label=device`` or ``device``
+    entries, labelled by the device's file name by default"""
+    boards = []
+    for entry in entries:
+        label, _, device = entry.rpartition('=')
+        boards.append((label or device.rstrip('/').split('/')[-1], device))
+    labels = [label for label, _ in boards]
+    if len(set(labels)) != len(labels):
+        raise ValueError('Board labels must be unique: {}'.format(', '.join(labels)))
+    return boards
+
+
+class BoardResult(object):
+    """How a cell went on one board"""
+    def __init__(self, label):
+        self.label = label
+        self.status = 'ok'
+        self.ename = ''
+        self.evalue = ''
+        self.traceback = []
+        self.seconds = 0.0
+
+    def failed(self, error):
+        self.status = 'error'
+        if isinstance(error, RemoteError):
+            self.ename, self.evalue, self.traceback = split_exception(str(error))
+        else:
+            self.ename, self.evalue = type(error).__name__, str(error)
+            self.traceback = ['{}: {}'.format(self.ename, self.evalue)]
+
+    def as_dict(self):
+        return {'status': self.status, 'seconds': round(self.seconds, 3),
+                'ename': self.ename, 'evalue': self.evalue}
+
+    def __str__(self):
+        outcome = 'ok' if self.status == 'ok' else '{}: {}'.format(self.ename, self.evalue)
+        return '{}: {} in {:.2f} s'.format(self.label, outcome, self.seconds)
+
+
+class LabelledLines(object):
+    """Prefix each complete line of a board's output with its label"""
+    def __init__(self, label):
+        self.prefix = u'[{}] '.format(label)
+        self.partial = u''
+
+    def feed(self, text):
+        lines = (self.partial + text).split(u'\n')
+        self.partial = lines.pop()
+        return u''.join(self.prefix + line + u'\n' for line in lines)
+
+    def close(self):
+        text, self.partial = self.partial, u''
+        return self.prefix + text + u'\n' if text else u''
+
+
+class Broadcast(object):
+    """
+    Run a job on several boards concurrently
+
+    :param labels: The boards' labels.
+    :param int workers: Threads in the pool, by default one per board.
+    """
+    def __init__(self, labels, workers=None):
+        self.labels = list(labels)
+        self.pool = ThreadPoolExecutor(max_workers=workers or len(self.labels))
+
+    def _run_one(self, job, label, messages):
+        result = BoardResult(label)
+        start = time.time()
+        try:
+            job(label, lambda text: messages.put((label, text, None)))
+        except Exception as e:
+            result.failed(e)
+        result.seconds = time.time() - start
+        messages.put((label, None, result))
+
+    def run(self, job, write, flush, interrupt, grouped=False, interval=0.05):
+        """Call ``job(label, write)`` for every board and wait for all of them.
+
+        The job's output is passed to ``write`` from the calling thread,
+        which also calls ``flush`` every ``interval`` seconds. A
+        KeyboardInterrupt while waiting calls ``interrupt(label)`` for each
+        board still running.
+
+        :param bool grouped: Write each board's output in one piece once it
+          finishes, instead of as it arrives.
+        :return: The :class:`BoardResult` of each label.
+        """
+        messages = queue.Queue()
+        for label in self.labels:
+            self.pool.submit(self._run_one, job, label, messages)
+        lines = dict((label, LabelledLines(label)) for label in self.labels)
+        groups = dict((label, []) for label in self.labels)
+        results = {}
+        while len(results) < len(self.labels):
+            try:
+                label, text, result = messages.get(timeout=interval)
+            except queue.Empty:
+                flush()
+                continue
+            except KeyboardInterrupt:
+                for label in self.labels:
+                    if label not in results:
+                        interrupt(label)
+                continue
+            if result is not None:
+                results[label] = result
+                if grouped:
+                    output = u''.join(groups.pop(label))
+                    if output and not output.endswith(u'\n'):
+                        output += u'\n'
+                    write(u'=== {} ===\n{}'.format(result, output))
+                else:
+                    write(lines[label].close())
+            elif grouped:
+                groups[label].append(text)
+            else:
+                write(lines[label].feed(text))
+        flush()
+        return results
+
+    def close(self):
+        self.pool.shutdown(wait=False)
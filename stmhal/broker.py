@@ -0,0 +1,541 @@
+"""
+broker.py
+
+Share the boards on serial devices between kernels
+
+A broker process opens each board once, keeps it in its raw REPL and serves
+any number of kernels over a Unix socket, so a second notebook can use a
+board that another one has open, and a kernel starts or restarts by
+connecting to the socket rather than by opening the device and entering the
+raw REPL.
+
+A kernel's connection carries the raw REPL as the serial link would, in
+frames, but its data only reaches the board while it holds the board. A
+kernel asks for the board when it starts an exchange and gives it back once
+it has read the reply, and the board goes to the kernels that asked in turn,
+so one running cell after cell keeps the others waiting for one exchange at
+most. If a kernel goes away while it holds the board, the broker interrupts
+whatever it left running before the next kernel has it.
+
+    $ python -m stmhal.broker --socket ~/.cache/mpkernel/broker.sock
+"""
+import os
+import sys
+import json
+import time
+import errno
+import socket
+import struct
+import logging
+import argparse
+import threading
+import subprocess
+import collections
+
+from .transport import SerialTransport, Transport, TransportError
+
+log = logging.getLogger('mpkernel.broker')
+
+# Message kind and payload size
+HEADER = struct.Struct('<BI')
+# A kernel names its board with HELLO and the broker answers READY or ERROR.
+# The kernel asks for the board with ACQUIRE and has it once the broker sends
+# GRANT, until it sends RELEASE. DATA carries the raw REPL either way.
+HELLO, READY, ERROR, ACQUIRE, GRANT, DATA, RELEASE = range(1, 8)
+
+
+def default_socket_path():
+    return os.path.join(os.path.expanduser('~'), '.cache', 'mpkernel', 'broker.sock')
+
+
+def encode_message(kind, payload=b''):
+    if isinstance(payload, dict):
+        payload = json.dumps(payload).encode('utf-8')
+    return HEADER.pack(kind, len(payload)) + payload
+
+
+class MessageParser(object):
+    """Split a byte stream into ``(kind, payload)`` messages"""
+    def __init__(self):
+        self.buffer = b''
+
+    def feed(self, data):
+        self.buffer += data
+        messages = []
+        while len(self.buffer) >= HEADER.size:
+            kind, size = HEADER.unpack_from(self.buffer)
+            if len(self.buffer) < HEADER.size + size:
+                break
+            messages.append((kind, self.buffer[HEADER.size:HEADER.size + size]))
+            self.buffer = self.buffer[HEADER.size + size:]
+        return messages
+
+
+class Board(object):
+    """
+    A board opened by the broker, and the kernels waiting for it
+
+    A thread relays what the board sends to the kernel holding it, and
+    hands the board to the next kernel in the queue once it is given back.
+    """
+    def __init__(self, device, baudrate, on_failure):
+        self.device = device
+        self.transport = SerialTransport(device, baudrate, chunk_delay=0)
+        try:
+            self.transport.enter_raw_repl()
+        except TransportError:
+            self.transport.close()
+            raise
+        self.on_failure = on_failure
+        # The (client, seq, op) of each request for the board, in turn
+        self.queue = collections.deque()
+        self.holder = None
+        # Whether the last holder may have left a command running
+        self.dirty = False
+        self.closed = False
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def acquire(self, client, seq, op):
+        with self._cond:
+            self.queue.append((client, seq, op))
+            self._cond.notify_all()
+
+    def release(self, client, clean=True):
+        """Give the board back, or withdraw the client's request for it"""
+        with self._cond:
+            self.queue = collections.deque(r for r in self.queue if r[0] is not client)
+            if self.holder is client:
+                self.holder = None
+                self.dirty = self.dirty or not clean
+                # The relay waiting for the board's output moves on
+                self.transport.buffer.wake()
+            self._cond.notify_all()
+
+    def write(self, client, data):
+        if self.holder is not client:
+            log.warning('%s: dropped %d bytes from a client without the board',
+                        self.device, len(data))
+            return
+        self.transport._write(data)
+
+    def close(self):
+        self.closed = True
+        with self._cond:
+            self._cond.notify_all()
+        self.transport.close()
+
+    def _run(self):
+        try:
+            while not self.closed:
+                holder = self.holder
+                if holder is None:
+                    self._grant()
+                    continue
+                data = self.transport.read(4096, 0.05)
+                if data and holder is self.holder:
+                    holder.send(DATA, data)
+        except TransportError as e:
+            if not self.closed:
+                log.error('%s failed: %s', self.device, e)
+                self.close()
+                self.on_failure(self)
+
+    def _grant(self):
+        """Hand the board to the next client waiting for it"""
+        with self._cond:
+            if not self.queue:
+                self._cond.wait(0.05)
+            if not self.queue or self.closed:
+                return
+            client, seq, op = self.queue.popleft()
+            self.holder = client
+        error = ''
+        try:
+            if op != 'exchange' or self.dirty:
+                self.transport.enter_raw_repl(soft_reset=op == 'reset')
+                self.dirty = False
+            else:
+                # Anything the board sent since the last exchange
+                self.transport.drain(0)
+        except TransportError as e:
+            if self.transport.buffer.closed:
+                raise
+            error = 'Could not enter the raw REPL of {}: {}'.format(self.device, e)
+            self.release(client)
+        client.send(GRANT, {'seq': seq, 'error': error})
+
+
+class Client(object):
+    """A kernel connected to the broker"""
+    def __init__(self, broker, sock):
+        self.broker = broker
+        self.sock = sock
+        self.board = None
+        self._send_lock = threading.Lock()
+
+    def send(self, kind, payload=b''):
+        try:
+            with self._send_lock:
+                self.sock.sendall(encode_message(kind, payload))
+        except (socket.error, OSError):
+            # The client's own thread sees it is gone
+            pass
+
+    def run(self):
+        messages = MessageParser()
+        try:
+            while True:
+                data = self.sock.recv(65536)
+                if not data:
+                    break
+                for kind, payload in messages.feed(data):
+                    self.handle(kind, payload)
+        except (socket.error, OSError):
+            pass
+        finally:
+            if self.board is not None:
+                self.board.release(self, clean=False)
+            self.sock.close()
+            self.broker.disconnected(self)
+
+    def handle(self, kind, payload):
+        if kind == DATA:
+            if self.board is not None:
+                self.board.write(self, payload)
+            return
+        message = json.loads(payload.decode('utf-8')) if payload else {}
+        if kind == HELLO:
+            try:
+                self.board = self.broker.board(message['device'], message['baudrate'])
+            except (TransportError, OSError, ValueError) as e:
+                self.send(ERROR, str(e).encode('utf-8'))
+                return
+            self.send(READY)
+        elif self.board is None:
+            self.send(ERROR, b'No board opened')
+        elif kind == ACQUIRE:
+            self.board.acquire(self, message['seq'], message['op'])
+        elif kind == RELEASE:
+            self.board.release(self, message.get('clean', True))
+
+    def close(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except (socket.error, OSError):
+            pass
+
+
+class Broker(object):
+    """
+    Serve the boards to the kernels that connect to a Unix socket
+
+    :param str path: The socket's path.
+    :param float idle_timeout: Seconds without any kernel connected after
+      which the boards are closed and :meth:`serve` returns, 0 to serve
+      until :meth:`close`.
+    """
+    def __init__(self, path=None, idle_timeout=600):
+        self.path = path or default_socket_path()
+        self.idle_timeout = idle_timeout
+        self.boards = {}
+        self.clients = set()
+        self.closed = False
+        self._lock = threading.Lock()
+        self._idle_since = time.time()
+        self.sock = None
+
+    def listen(self):
+        """Bind the socket, False if another broker is serving it"""
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        if os.path.exists(self.path):
+            try:
+                _connect(self.path).close()
+                return False
+            except (socket.error, OSError):
+                # Left by a broker that is gone
+                os.remove(self.path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(self.path)
+        self.sock.listen(16)
+        self.sock.settimeout(0.5)
+        return True
+
+    def serve(self):
+        if self.sock is None and not self.listen():
+            log.info('A broker is already serving %s', self.path)
+            return
+        log.info('Serving %s', self.path)
+        try:
+            while not self.closed:
+                try:
+                    sock, _ = self.sock.accept()
+                except socket.timeout:
+                    if (self.idle_timeout and not self.clients and
+                            time.time() - self._idle_since > self.idle_timeout):
+                        break
+                    continue
+                except (socket.error, OSError):
+                    if self.closed:
+                        break
+                    raise
+                client = Client(self, sock)
+                with self._lock:
+                    self.clients.add(client)
+                thread = threading.Thread(target=client.run)
+                thread.daemon = True
+                thread.start()
+        finally:
+            self.close()
+
+    def board(self, device, baudrate):
+        """Return the open board on ``device``, opening it if need be"""
+        with self._lock:
+            board = self.boards.get(device)
+            if board is None:
+                log.info('Opening %s', device)
+                board = self.boards[device] = Board(device, baudrate, self._failed)
+            return board
+
+    def _failed(self, board):
+        """Drop a board that stopped working and the kernels using it, which
+        open it again on their next cell"""
+        with self._lock:
+            if self.boards.get(board.device) is board:
+                del self.boards[board.device]
+            clients = [client for client in self.clients if client.board is board]
+        for client in clients:
+            client.close()
+
+    def disconnected(self, client):
+        with self._lock:
+            self.clients.discard(client)
+            if not self.clients:
+                self._idle_since = time.time()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self.sock is not None:
+            self.sock.close()
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+        with self._lock:
+            clients, boards = list(self.clients), list(self.boards.values())
+            self.boards = {}
+        for client in clients:
+            client.close()
+        for board in boards:
+            board.close()
+
+
+def _connect(path):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except (socket.error, OSError):
+        sock.close()
+        raise
+    return sock
+
+
+def connect(path=None, spawn=True, timeout=5):
+    """Return a socket connected to the broker, starting one in the
+    background if none is running"""
+    path = path or default_socket_path()
+    try:
+        return _connect(path)
+    except (socket.error, OSError) as e:
+        if not spawn or e.errno not in (errno.ENOENT, errno.ECONNREFUSED):
+            raise TransportError('Could not connect to the broker at {}: {}'.format(path, e))
+    spawn_broker(path)
+    deadline = time.time() + timeout
+    while True:
+        try:
+            return _connect(path)
+        except (socket.error, OSError) as e:
+            if time.time() > deadline:
+                raise TransportError('The broker at {} did not start: {}'.format(path, e))
+            time.sleep(0.05)
+
+
+def spawn_broker(path):
+    """Start a broker serving ``path`` in a process of its own, which logs
+    to ``path`` + ``.log``"""
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(
+        [root] + [p for p in [os.environ.get('PYTHONPATH')] if p]))
+    with open(os.devnull, 'rb') as devnull, open(path + '.log', 'ab') as out:
+        subprocess.Popen([sys.executable, '-m', 'stmhal.broker', '--socket', path],
+                         stdin=devnull, stdout=out, stderr=out, env=env,
+                         close_fds=True, start_new_session=True)
+
+
+class BrokerTransport(Transport):
+    """
+    Raw REPL connection to a board through the broker, e.g.
+    ``BrokerTransport('/dev/ttyACM0')``
+
+    The board is asked for by the first write of an exchange and given back
+    once :meth:`follow` has read the reply, so a cell waits while another
+    kernel's cell runs on the board. The board is in its raw REPL from the
+    start, without a reset.
+
+    :param str device: The board's serial device.
+    :param str path: The broker's socket, started if no broker serves it.
+    """
+    def __init__(self, device, baudrate=115200, path=None, timeout=5, **kw):
+        super(BrokerTransport, self).__init__(**kw)
+        self.device = device
+        self.path = path or default_socket_path()
+        # Whether this connection has the board
+        self.holding = False
+        self._messages = MessageParser()
+        self._send_lock = threading.Lock()
+        self._granted = threading.Condition()
+        self._seq = 0
+        # The last GRANT message
+        self._grant = None
+        self.sock = connect(self.path, timeout=timeout)
+        try:
+            self.sock.settimeout(timeout)
+            self._send(HELLO, {'device': device, 'baudrate': baudrate})
+            kind, payload = self._receive()
+            if kind != READY:
+                raise TransportError(payload.decode('utf-8', 'replace'))
+        except (socket.error, OSError) as e:
+            self.sock.close()
+            raise TransportError('Could not open {} through the broker: {}'.format(device, e))
+        except TransportError:
+            self.sock.close()
+            raise
+        self.sock.settimeout(0.05)
+        self.start()
+
+    def _receive(self):
+        """Read the answer to HELLO, before the reader thread starts"""
+        messages = []
+        while not messages:
+            data = self.sock.recv(4096)
+            if not data:
+                raise TransportError('The broker closed the connection')
+            messages = self._messages.feed(data)
+        return messages[0]
+
+    def _send(self, kind, payload=b''):
+        try:
+            with self._send_lock:
+                self.sock.sendall(encode_message(kind, payload))
+        except (socket.error, OSError) as e:
+            raise TransportError('Connection to the broker lost: {}'.format(e))
+
+    def _read_chunk(self):
+        try:
+            data = self.sock.recv(65536)
+        except socket.timeout:
+            return b''
+        except (socket.error, OSError) as e:
+            raise TransportError('Connection to the broker lost: {}'.format(e))
+        if not data:
+            raise TransportError('The broker closed the connection')
+        out = []
+        for kind, payload in self._messages.feed(data):
+            if kind == DATA:
+                out.append(payload)
+            elif kind == GRANT:
+                with self._granted:
+                    self._grant = json.loads(payload.decode('utf-8'))
+                    self._granted.notify_all()
+            elif kind == ERROR:
+                raise TransportError(payload.decode('utf-8', 'replace'))
+        return b''.join(out)
+
+    def acquire(self, op='exchange'):
+        """Wait for the board.
+
+        :param str op: ``'enter'`` to have the broker enter the raw REPL
+          first, or ``'reset'`` to soft reset the board too.
+        """
+        with self._granted:
+            self._seq += 1
+            seq = self._seq
+        self._send(ACQUIRE, {'seq': seq, 'op': op})
+        with self._granted:
+            while self._grant is None or self._grant['seq'] != seq:
+                if self.buffer.closed:
+                    raise TransportError('Connection closed: {}'.format(self.error))
+                self._granted.wait(0.05)
+            error = self._grant['error']
+        if error:
+            raise TransportError(error)
+        self.holding = True
+
+    def release(self, clean=True):
+        """Give the board back, or stop waiting for it.
+
+        :param bool clean: False if a command may have been left running.
+        """
+        self.holding = False
+        if not self.buffer.closed:
+            self._send(RELEASE, {'clean': clean})
+
+    def _write(self, data):
+        if not self.holding:
+            self.acquire()
+        self._send(DATA, data)
+
+    def follow(self, stream, timeout=None, interval=0.05):
+        error = super(BrokerTransport, self).follow(stream, timeout, interval)
+        self.release()
+        return error
+
+    def enter_raw_repl(self, soft_reset=False, timeout=5):
+        """Have the broker interrupt the board and enter its raw REPL"""
+        if self.holding:
+            self.release(clean=False)
+        self._pushback = b''
+        self.acquire('reset' if soft_reset else 'enter')
+        self.release()
+
+    def exit_raw_repl(self):
+        # The broker keeps the board in its raw REPL
+        pass
+
+    def interrupt(self, timeout=1):
+        if not self.holding:
+            # Still waiting for the board
+            self.release()
+            return
+        super(BrokerTransport, self).interrupt(timeout)
+        self.release(clean=False)
+
+    def close(self):
+        super(BrokerTransport, self).close()
+        self._reader.join(1)
+        self.sock.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Share serial boards between mpkernel kernels')
+    parser.add_argument('--socket', default=default_socket_path(),
+                        help='the Unix socket the kernels connect to')
+    parser.add_argument('--idle-timeout', type=float, default=600,
+                        help='seconds without kernels after which the broker '
+                        'closes the boards and exits, 0 for never')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+    Broker(args.socket, args.idle_timeout).serve()
+
+
+if __name__ == '__main__':
+    main()
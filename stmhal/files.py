@@ -0,0 +1,244 @@
+"""
+files.py
+
+Copy files to and from the board's filesystem
+
+Rather than building a file up through a series of REPL commands, a small
+program is started on the board that reads or writes length prefixed frames
+of raw bytes on the serial link, so a transfer runs close to the link's line
+rate. Frames sent to the board can be zlib compressed and are then
+decompressed as they arrive. Files whose SHA-256 already matches on both
+ends are skipped.
+"""
+import io
+import os
+import time
+import zlib
+import struct
+import hashlib
+
+from mpkernel.repl import RemoteError
+
+READY = b'\x06'
+
+HASH_PROGRAM = """\
+try:
+    import hashlib
+except ImportError:
+    import uhashlib as hashlib
+import binascii
+def _hash(path):
+    try:
+        f = open(path, 'rb')
+    except OSError:
+        return ''
+    h = hashlib.sha256()
+    b = bytearray(1024)
+    m = memoryview(b)
+    while True:
+        n = f.readinto(b)
+        if not n:
+            break
+        h.update(m[:n])
+    f.close()
+    return binascii.hexlify(h.digest()).decode()
+print(_hash({path!r}))
+"""
+
+# Ctrl-C is disabled while the frames are read, since they may contain \x03
+PUT_PROGRAM = """\
+import sys, struct, micropython
+{decompress}
+micropython.kbd_intr(-1)
+try:
+    f = open({path!r}, 'wb')
+    r = sys.stdin.buffer.read
+    w = sys.stdout.write
+    w('\\x06')
+    while True:
+        n = struct.unpack('<I', r(4))[0]
+        if not n:
+            break
+        f.write({frame})
+        w('\\x06')
+    f.close()
+finally:
+    micropython.kbd_intr(3)
+"""
+
+DECOMPRESS = """\
+try:
+    import io, deflate
+    def unz(b):
+        return deflate.DeflateIO(io.BytesIO(b), deflate.ZLIB).read()
+except ImportError:
+    from zlib import decompress as unz
+"""
+
+GET_PROGRAM = """\
+import sys, struct
+f = open({path!r}, 'rb')
+w = sys.stdout.buffer.write
+w(b'\\x06')
+b = bytearray({chunk_size})
+m = memoryview(b)
+while True:
+    n = f.readinto(b)
+    if not n:
+        break
+    w(struct.pack('<I', n))
+    w(m[:n])
+w(b'\\0\\0\\0\\0')
+f.close()
+"""
+
+
+class Transfer(object):
+    """The outcome of a single file copy"""
+    def __init__(self, src, dest, size=0, seconds=0.0, skipped=False):
+        self.src = src
+        self.dest = dest
+        self.size = size
+        self.seconds = seconds
+        self.skipped = skipped
+
+    @property
+    def rate(self):
+        """Bytes per second"""
+        return self.size / self.seconds if self.seconds else 0.0
+
+    def __str__(self):
+        if self.skipped:
+            return '{} -> {}: unchanged, skipped'.format(self.src, self.dest)
+        return '{} -> {}: {} bytes in {:.2f} s ({:.1f} KB/s)'.format(
+            self.src, self.dest, self.size, self.seconds, self.rate / 1024)
+
+
+def local_hash(path):
+    """Return the hex SHA-256 of a local file, or '' if it does not exist"""
+    if not os.path.isfile(path):
+        return ''
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(65536), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def remote_hash(transport, path, timeout=30):
+    """Return the hex SHA-256 of a file on the board, or '' if it does not exist"""
+    out = io.StringIO()
+    error = transport.exec_raw(HASH_PROGRAM.format(path=path), out, timeout=timeout)
+    if error:
+        raise RemoteError(error)
+    return out.getvalue().strip()
+
+
+def frames(f, chunk_size, compress=False):
+    """Yield the contents of file ``f`` as frames, ending with an empty one"""
+    for chunk in iter(lambda: f.read(chunk_size), b''):
+        if compress:
+            chunk = zlib.compress(chunk)
+        yield struct.pack('<I', len(chunk)) + chunk
+    yield struct.pack('<I', 0)
+
+
+def _abort(transport, timeout):
+    """Collect the error after the board stopped a transfer part way"""
+    error = transport.follow(io.StringIO(), timeout)
+    # Frames the board did not read were taken as raw REPL input
+    transport.enter_raw_repl()
+    return RemoteError(error or 'Transfer stopped by the board')
+
+
+def put(transport, src, dest, chunk_size=4096, compress=False, window=2,
+        force=False, timeout=10):
+    """Copy local file ``src`` to ``dest`` on the board.
+
+    :param int chunk_size: Bytes of the file per frame, which the board
+      must be able to hold in memory.
+    :param bool compress: zlib compress each frame.
+    :param int window: Frames sent before waiting for the board to
+      acknowledge the first of them.
+    :param bool force: Copy even if ``dest`` has the same contents.
+    :return: A :class:`Transfer`.
+
+    Over a transport with ``binary_files``, such as the WebREPL, the file
+    is sent with the transport's own protocol, uncompressed.
+    """
+    if not force and local_hash(src) == remote_hash(transport, dest):
+        return Transfer(src, dest, skipped=True)
+
+    start = time.time()
+    size = os.path.getsize(src)
+    if transport.binary_files:
+        with open(src, 'rb') as f:
+            transport.put_file(f, dest, size, chunk_size, timeout)
+        return Transfer(src, dest, size, time.time() - start)
+    program = PUT_PROGRAM.format(path=dest,
+                                 decompress=DECOMPRESS if compress else '',
+                                 frame='unz(r(n))' if compress else 'r(n)')
+    transport.exec_start(program, timeout)
+    with open(src, 'rb') as f:
+        send_frames(transport, frames(f, chunk_size, compress), window, timeout)
+    return Transfer(src, dest, size, time.time() - start)
+
+
+def send_frames(transport, frames, window=2, timeout=10):
+    """Send frames to a program on the board that acknowledges it is ready
+    and then each frame with :data:`READY`, and wait for it to finish.
+
+    :param int window: Frames sent before waiting for the board to
+      acknowledge the first of them.
+    """
+    def acknowledged():
+        ack = transport.read_exactly(1, timeout)
+        if ack != READY:
+            transport.unread(ack)
+            raise _abort(transport, timeout)
+
+    acknowledged()
+    pending = 0
+    for frame in frames:
+        if len(frame) == 4:
+            while pending:
+                acknowledged()
+                pending -= 1
+        elif pending >= window:
+            acknowledged()
+            pending -= 1
+        transport.write(frame, paced=False)
+        pending += 1
+    error = transport.follow(io.StringIO(), timeout)
+    if error:
+        raise RemoteError(error)
+
+
+def get(transport, src, dest, chunk_size=4096, force=False, timeout=10):
+    """Copy ``src`` on the board to local file ``dest``, see :func:`put`"""
+    if not force and os.path.isfile(dest) and \
+            local_hash(dest) == remote_hash(transport, src):
+        return Transfer(src, dest, skipped=True)
+
+    start = time.time()
+    if transport.binary_files:
+        with open(dest, 'wb') as f:
+            size = transport.get_file(src, f, timeout)
+        return Transfer(src, dest, size, time.time() - start)
+    size = 0
+    transport.exec_start(GET_PROGRAM.format(path=src, chunk_size=chunk_size), timeout)
+    ready = transport.read_exactly(1, timeout)
+    if ready != READY:
+        transport.unread(ready)
+        raise RemoteError(transport.follow(io.StringIO(), timeout))
+    with open(dest, 'wb') as f:
+        while True:
+            n = struct.unpack('<I', transport.read_exactly(4, timeout))[0]
+            if not n:
+                break
+            f.write(transport.read_exactly(n, timeout))
+            size += n
+    error = transport.follow(io.StringIO(), timeout)
+    if error:
+        raise RemoteError(error)
+    return Transfer(src, dest, size, time.time() - start)
@@ -4,7 +4,12 @@ stmhal.py
 Jupyter kernel for the stmhal port of micropython
 
 Notes:
-    - The following must be run prior to any micropython code
+    - Set MPKernelStmhal.device (e.g. /dev/ttyACM0, or ws://<ip>:8266
+        for a board's WebREPL) to have the kernel open the board itself;
+        cells are then sent over its raw REPL and their output streams
+        back while the board runs
+    - Without a device, the following must be run prior to any
+        micropython code
         $ import sys!!
         $ sys.path.append('<path_to>/micropython/tools')!!
         $ import pyboard!!
@@ -15,8 +20,12 @@ Notes:
 """
 #!/usr/bin/env python
 from __future__ import print_function
+import io
 import os
 import sys
+import time
+import uuid
+import struct
 import signal
 from tornado.ioloop import IOLoop
 
@@ -25,14 +34,26 @@ try:
 except ImportError:
     from IPython.kernel.zmq.kernelbase import Kernel
 
+from ipykernel.comm import Comm
 from ipykernel.ipkernel import IPythonKernel
 
+from mpkernel import mpy
+from mpkernel.complete import NamespaceCache
+from mpkernel.metrics import CellTimer, Metrics, seconds_since
+from mpkernel.magics import MagicError, MagicParser, split_magic
+from mpkernel.repl import (OutputLimit, OutputStream, RecordFilter, RemoteError,
+                           fix_traceback, split_exception)
+from mpkernel.startup import background
+from .transport import SerialTransport, TransportError
+# The modules of the magics and of optional connections and features are
+# imported when they are first used
+
 __version__ = '0.2'
 
 try:
-    from traitlets import Unicode
+    from traitlets import Unicode, Bool, Float, Integer, List, Enum
 except ImportError:
-    from IPython.utils.traitlets import Unicode
+    from IPython.utils.traitlets import Unicode, Bool, Float, Integer, List, Enum
 
 
 class MPKernelStmhal(IPythonKernel):
@@ -51,9 +72,101 @@ class MPKernelStmhal(IPythonKernel):
                     'file_extension': '.py'
                     }
 
+    device = Unicode('', help="Serial device of the board, e.g. /dev/ttyACM0, "
+                     "or the ws:// URL of its WebREPL, e.g. ws://192.168.4.1:8266. "
+                     "Leave empty to drive a pyboard.Pyboard created in the notebook"
+                     ).tag(config=True)
+    devices = List(Unicode(), help="Serial devices or WebREPL URLs of several "
+                   "boards, each device or label=device, to run every cell on all "
+                   "of them at once instead of on device").tag(config=True)
+    webrepl_password = Unicode('', help="Password of the boards' WebREPL, unless "
+                               "given in the URL as ws://:password@host"
+                               ).tag(config=True)
+    broadcast_output = Enum(['interleaved', 'grouped'], 'interleaved',
+                            help="Show the boards' output line by line with their "
+                            "labels as it arrives, or each board's in one piece "
+                            "once it finishes").tag(config=True)
+    baudrate = Integer(115200, help="Baud rate of the serial device").tag(config=True)
+    broker = Bool(False, help="Open serial devices through a broker process, "
+                  "started if none is running, which keeps each board open and "
+                  "in its raw REPL and shares it with other kernels").tag(config=True)
+    broker_socket = Unicode('', help="Unix socket of the broker, by default "
+                            "~/.cache/mpkernel/broker.sock").tag(config=True)
+    write_chunk_size = Integer(256, help="Bytes written to the board at a time, "
+                               "sized for its USB CDC receive buffer").tag(config=True)
+    write_chunk_delay = Float(0.01, help="Seconds to wait between chunks written "
+                              "to the board").tag(config=True)
+    soft_reset = Bool(False, help="Soft reset the board when connecting").tag(config=True)
+    stream_interval = Float(0.05, help="Seconds between flushes of a running "
+                            "cell's output").tag(config=True)
+    stream_max_bytes = Integer(4096, help="Flush a running cell's output once "
+                               "this many bytes are buffered").tag(config=True)
+    output_head_bytes = Integer(65536, help="Characters of a cell's output shown "
+                                "before the rest goes to a log file, of which only "
+                                "the last output_tail_bytes are shown, 0 for no limit"
+                                ).tag(config=True)
+    output_tail_bytes = Integer(8192, help="Characters shown from the end of a "
+                                "cell's output once it overflows").tag(config=True)
+    output_log_dir = Unicode('mpkernel_output', help="Directory of the log files of "
+                             "cells whose output overflows, relative to the "
+                             "kernel's working directory").tag(config=True)
+    transfer_chunk_size = Integer(4096, help="Bytes per frame in %put and %get, "
+                                  "held in the board's memory").tag(config=True)
+    transfer_window = Integer(2, help="Frames %put sends ahead of the board's "
+                              "acknowledgements").tag(config=True)
+    precompile = Bool(False, help="Compile cells to .mpy bytecode on the host "
+                      "with mpy-cross and send them to be imported from a "
+                      "filesystem in the board's RAM, instead of sending the "
+                      "source. Nothing is written to the board's flash. "
+                      "Functions defined in such a cell see the globals as they "
+                      "were when the cell ran").tag(config=True)
+    mpy_cross = Unicode('mpy-cross', help="The mpy-cross executable, with any "
+                        "arguments (e.g. -march=armv7m); its bytecode version "
+                        "must match the board's firmware").tag(config=True)
+    mpy_cache_dir = Unicode('', help="Directory of compiled cells and modules, "
+                            "by default ~/.cache/mpkernel/mpy").tag(config=True)
+    mpy_cache_size = Integer(16 * 1024 * 1024, help="Size in bytes above which "
+                             "the least recently used .mpy files are removed"
+                             ).tag(config=True)
+    capture_dir = Unicode('', help="Directory to record every byte read from "
+                          "and written to the boards in, with its time, one capture "
+                          "file per connection that python -m mpkernel.capture can "
+                          "summarize or replay in place of the board; empty to "
+                          "disable").tag(config=True)
+    metrics_file = Unicode('', help="File the cell timing metrics are written "
+                           "to after each cell, in the Prometheus text format"
+                           ).tag(config=True)
+    metrics_port = Integer(0, help="Serve the cell timing metrics at "
+                           "http://127.0.0.1:<port>/metrics, 0 to disable"
+                           ).tag(config=True)
+    completion_cache_size = Integer(256, help="Board objects whose names are "
+                                    "kept for completion and inspection"
+                                    ).tag(config=True)
+    heap_usage = Bool(False, help="Measure the board's heap before and after "
+                      "each cell, in the same exchange, for the reply metadata "
+                      "and %memtrace").tag(config=True)
+
     def __init__(self, **kwargs):
         super(MPKernelStmhal, self).__init__(**kwargs)
         self._output = None
+        self.transport = None
+        # The connection opened in the background at startup, until taken
+        self._connecting = None
+        # The open connections of the boards in devices, by label
+        self.transports = {}
+        self._broadcast = None
+        # Each board's outcome of the last broadcast cell, for its reply metadata
+        self._board_results = None
+        self._mpy_cache = None
+        self.metrics = Metrics({'kernel': 'stmhal'})
+        # Times the phases of the cell being run
+        self.timer = None
+        self.completions = NamespaceCache(self._query, self.completion_cache_size)
+        # The heap usage of the cells, once measured, and of the cell being run
+        self._heap_trace = None
+        self._heap = None
+        # Whether the cell being run is silent, when magics send no displays
+        self._silent = False
         # Need to run this code to setup the notebook  for us
         # setup_code = "import sys\nsys.path.append('/Users/User/dev/micropython/tools')\nimport pyboard\npyb = pyboard.Pyboard('/dev/tty.usbmodem1422')\n"
         # super(MPKernelStmhal, self).do_execute(setup_code, silent=True)
@@ -73,6 +186,10 @@ class MPKernelStmhal(IPythonKernel):
         if '!!' in code:
             # allows us to enter a command and not send it to the board
             newCodeStr = code.replace('!!', '')
+        elif self.devices:
+            return self.execute_broadcast(code, silent, store_history)
+        elif self.device:
+            return self.execute_on_board(code, silent, store_history)
         else:
             lines = code.splitlines()
             newlines = '\n'.join(lines)
@@ -84,3 +201,660 @@ class MPKernelStmhal(IPythonKernel):
         self._output = super(MPKernelStmhal, self).do_execute(newCodeStr, silent, store_history, user_expressions, allow_stdin)
         return self._output
 
+    @property
+    def heap_trace(self):
+        """The :class:`~mpkernel.heap.HeapTrace` of the cells"""
+        if self._heap_trace is None:
+            from mpkernel.heap import HeapTrace
+            self._heap_trace = HeapTrace()
+        return self._heap_trace
+
+    @property
+    def mpy_cache(self):
+        if self._mpy_cache is None:
+            self._mpy_cache = mpy.MpyCache(self.mpy_cache_dir or None,
+                                           max_bytes=self.mpy_cache_size,
+                                           mpy_cross=self.mpy_cross)
+        return self._mpy_cache
+
+    def _precompiled(self, code):
+        """Return the command importing the cell compiled to .mpy from the
+        board's RAM, or None if mpy-cross cannot be run"""
+        source = mpy.cell_source(code)
+        try:
+            with self.timer.phase('compile'):
+                path = self.mpy_cache.compile(source)
+        except OSError as e:
+            self.log.warning("Could not run %s (%s), sending cells as source",
+                             self.mpy_cross, e)
+            self.precompile = False
+            return None
+        with open(path, 'rb') as f:
+            return mpy.ram_loader(f.read(), self.mpy_cache.module_name(source))
+
+    def start(self):
+        super(MPKernelStmhal, self).start()
+        if self.metrics_port:
+            self.metrics.serve(self.metrics_port)
+        if self.device:
+            # Opened while the frontend connects, the first cell waits for it
+            self._connecting = background(self.open_board, self.device)
+
+    def init_metadata(self, parent):
+        self.timer = CellTimer(queue=seconds_since(parent['header'].get('date')))
+        return super(MPKernelStmhal, self).init_metadata(parent)
+
+    def finish_metadata(self, parent, metadata, reply_content):
+        """Add the cell's timings and heap usage to the reply metadata, and
+        the timings to the metrics"""
+        metadata = super(MPKernelStmhal, self).finish_metadata(parent, metadata,
+                                                               reply_content)
+        if self._heap is not None:
+            metadata['heap'] = self._heap.as_dict()
+            self._heap = None
+        if self._board_results is not None:
+            metadata['boards'] = self._board_results
+            self._board_results = None
+        if self.timer is not None:
+            metadata['timings'] = self.timer.as_dict()
+            self.metrics.record(self.timer, reply_content.get('status'))
+            if self.metrics_file:
+                self.metrics.write(self.metrics_file)
+            self.timer = None
+        return metadata
+
+    def open_board(self, device):
+        """Return a connection to a board, in its raw REPL"""
+        kw = {'chunk_size': self.write_chunk_size, 'chunk_delay': self.write_chunk_delay}
+        if self.capture_dir:
+            from mpkernel import capture
+            kw['capture'] = capture.Capture(
+                capture.capture_path(self.capture_dir, device),
+                'open {} baudrate={}'.format(device, self.baudrate))
+        if device.startswith('ws://'):
+            from .webrepl import WebReplTransport
+            transport = WebReplTransport(device, self.webrepl_password, **kw)
+        elif self.broker:
+            from .broker import BrokerTransport
+            transport = BrokerTransport(device, self.baudrate, self.broker_socket or None, **kw)
+            if not self.soft_reset:
+                # The broker keeps the board in its raw REPL
+                return transport
+        else:
+            transport = SerialTransport(device, baudrate=self.baudrate, **kw)
+        try:
+            transport.enter_raw_repl(soft_reset=self.soft_reset)
+        except TransportError:
+            transport.close()
+            raise
+        return transport
+
+    def connect(self):
+        """Open the device and enter the board's raw REPL, or take the
+        connection opened at startup"""
+        connecting, self._connecting = self._connecting, None
+        transport = None
+        if connecting is not None:
+            try:
+                transport = connecting.result()
+            except (TransportError, OSError) as e:
+                self.log.warning("Could not open %s at startup (%s), trying again",
+                                 self.device, e)
+        self.transport = transport or self.open_board(self.device)
+        self.completions.clear()
+
+    def disconnect(self):
+        if self._connecting is not None:
+            self._connecting.add_done_callback(
+                lambda future: future.exception() is None and future.result().close())
+            self._connecting = None
+        if self.transport is not None:
+            self.transport.exit_raw_repl()
+            self.transport.close()
+            self.transport = None
+        for transport in self.transports.values():
+            transport.exit_raw_repl()
+            transport.close()
+        self.transports = {}
+        if self._broadcast is not None:
+            self._broadcast.close()
+            self._broadcast = None
+
+    def do_shutdown(self, restart):
+        self.disconnect()
+        return super(MPKernelStmhal, self).do_shutdown(restart)
+
+    def _query(self, program):
+        """Run a completion query on the board, returning its output or ''"""
+        try:
+            if self.transport is None:
+                self.connect()
+            output = io.StringIO()
+            if self.transport.exec_raw(program, output, timeout=2):
+                return ''
+        except (TransportError, OSError) as e:
+            self.log.warning("Completion query failed: %s", e)
+            return ''
+        return output.getvalue()
+
+    def do_complete(self, code, cursor_pos):
+        """Complete names on the board, from the cache where possible"""
+        if not self.device:
+            return super(MPKernelStmhal, self).do_complete(code, cursor_pos)
+        matches, start = self.completions.complete(code, cursor_pos)
+        return {'status': 'ok', 'matches': matches, 'cursor_start': start,
+                'cursor_end': cursor_pos, 'metadata': {}}
+
+    def do_inspect(self, code, cursor_pos, detail_level=0, omit_sections=()):
+        if not self.device:
+            return super(MPKernelStmhal, self).do_inspect(code, cursor_pos, detail_level,
+                                                          omit_sections)
+        text = self.completions.inspect(code, cursor_pos)
+        return {'status': 'ok', 'found': text is not None, 'metadata': {},
+                'data': {'text/plain': text} if text else {}}
+
+    def _send_stdout(self, text):
+        self.send_response(self.iopub_socket, 'stream',
+                           {'name': 'stdout', 'text': text})
+
+    def _output_limit(self, execution_count):
+        """Return the limit on a cell's output in the notebook"""
+        display_id = uuid.uuid4().hex
+
+        def display(bundle, update):
+            content = {'data': bundle, 'metadata': {}, 'transient': {'display_id': display_id}}
+            self.send_response(self.iopub_socket,
+                               'update_display_data' if update else 'display_data', content)
+
+        path = os.path.join(self.output_log_dir, 'cell-{}-{}.log'.format(
+            time.strftime('%Y%m%d-%H%M%S'), execution_count))
+        return OutputLimit(self._send_stdout, display, path,
+                           head_bytes=self.output_head_bytes,
+                           tail_bytes=self.output_tail_bytes,
+                           interval=max(self.stream_interval, 0.5))
+
+    def execute_on_board(self, code, silent, store_history=True):
+        """Run a cell on the board over its transport"""
+        shell = self.shell
+        execution_count = shell.execution_count
+        if store_history:
+            shell.history_manager.store_inputs(execution_count, code)
+            shell.execution_count += 1
+
+        status = 'ok'
+        ename, evalue, traceback = 'ename', 'evalue', []
+        if self.timer is None:
+            self.timer = CellTimer()
+        self._silent = silent
+        if silent:
+            stream = OutputStream(lambda text: None)
+            limit = None
+        else:
+            limit = self._output_limit(execution_count)
+            stream = OutputStream(limit.write, interval=self.stream_interval,
+                                  max_bytes=self.stream_max_bytes)
+        try:
+            if self.transport is None:
+                with self.timer.phase('connect'):
+                    self.connect()
+            if self.transport.capture is not None:
+                self.transport.capture.note('cell {}'.format(execution_count))
+            magic = split_magic(code)
+            if magic is not None:
+                self.run_magic(magic, stream)
+            else:
+                command = self._precompiled(code) if self.precompile else None
+                program = command or code
+                probe = None
+                if self.heap_usage:
+                    from mpkernel import heap
+                    program = heap.probe(program)
+                    probe = heap.HeapFilter(stream)
+                with self.timer.phase('transfer'):
+                    self.transport.exec_start(program)
+                with self.timer.phase('exec'):
+                    error = self.transport.follow(probe or stream,
+                                                  interval=self.stream_interval)
+                if probe is not None:
+                    probe.close()
+                    self._heap = probe.usage
+                    if probe.usage is not None:
+                        self.heap_trace.add(execution_count, probe.usage)
+                if error.strip():
+                    if command:
+                        error = mpy.fix_line_numbers(error)
+                    if probe is not None:
+                        error = fix_traceback(error)
+                    raise RemoteError(error)
+        except RemoteError as e:
+            status = 'error'
+            ename, evalue, traceback = split_exception(str(e))
+        except mpy.MpyCrossError as e:
+            status = 'error'
+            ename, evalue, traceback = split_exception(mpy.fix_line_numbers(str(e)))
+        except MagicError as e:
+            status = 'error'
+            ename, evalue, traceback = 'UsageError', str(e), ['UsageError: {}'.format(e)]
+        except KeyboardInterrupt:
+            # None if interrupted while the board was still being opened
+            if self.transport is not None:
+                self.transport.interrupt()
+            status = 'error'
+            ename, evalue = 'KeyboardInterrupt', ''
+            traceback = ['KeyboardInterrupt']
+        except (TransportError, OSError) as e:
+            # The connection is in an unknown state, reconnect on the next cell
+            if self.transport is not None:
+                self.transport.close()
+                self.transport = None
+            status = 'error'
+            ename, evalue = type(e).__name__, str(e)
+            traceback = ['{}: {}'.format(ename, evalue)]
+        stream.flush()
+        if limit is not None:
+            limit.close()
+        self.completions.invalidate()
+        return self._reply(status, execution_count, (ename, evalue, traceback), silent, stream)
+
+    def execute_broadcast(self, code, silent, store_history=True):
+        """Run a cell on all the boards in devices at once"""
+        shell = self.shell
+        execution_count = shell.execution_count
+        if store_history:
+            shell.history_manager.store_inputs(execution_count, code)
+            shell.execution_count += 1
+
+        status = 'ok'
+        ename, evalue, traceback = 'ename', 'evalue', []
+        if self.timer is None:
+            self.timer = CellTimer()
+        if silent:
+            stream = OutputStream(lambda text: None)
+            limit = None
+        else:
+            limit = self._output_limit(execution_count)
+            stream = OutputStream(limit.write, interval=self.stream_interval,
+                                  max_bytes=self.stream_max_bytes)
+        results = {}
+        start = time.time()
+        try:
+            from .broadcast import Broadcast, parse_devices
+            boards = parse_devices(self.devices)
+            job = self._broadcast_job(code, dict(boards), execution_count)
+            if self._broadcast is None:
+                self._broadcast = Broadcast([label for label, _ in boards])
+            with self.timer.phase('exec'):
+                results = self._broadcast.run(
+                    job, stream.write, stream.flush, self._interrupt_board,
+                    grouped=self.broadcast_output == 'grouped',
+                    interval=self.stream_interval)
+        except (MagicError, ValueError) as e:
+            status = 'error'
+            ename, evalue, traceback = 'UsageError', str(e), ['UsageError: {}'.format(e)]
+        if results:
+            ordered = [results[label] for label in self._broadcast.labels]
+            failed = [result for result in ordered if result.status != 'ok']
+            stream.write(u'--- {} boards in {:.2f} s (slowest {:.2f} s), {} failed\n'.format(
+                len(ordered), time.time() - start,
+                max(result.seconds for result in ordered), len(failed)))
+            for result in ordered:
+                stream.write(u'  {}\n'.format(result))
+            if failed:
+                status = 'error'
+                ename = 'BroadcastError'
+                evalue = '{} of {} boards failed'.format(len(failed), len(ordered))
+                traceback = [evalue]
+                for result in failed:
+                    traceback += ['', '[{}]'.format(result.label)] + result.traceback
+            self._board_results = dict((label, result.as_dict())
+                                       for label, result in results.items())
+        stream.flush()
+        if limit is not None:
+            limit.close()
+        return self._reply(status, execution_count, (ename, evalue, traceback), silent, stream)
+
+    def _reply(self, status, execution_count, error=None, silent=False, stream=None):
+        """Return the content of a cell's execute_reply, sending its error
+        unless the cell is silent, once its output has been flushed
+
+        :param str status: 'ok' or 'error'.
+        :param tuple error: The ename, evalue and traceback of an error.
+        :param stream: The cell's :class:`~mpkernel.repl.OutputStream`, whose
+          time relaying output goes into the cell's timings.
+        """
+        if stream is not None:
+            self.timer.add('relay', stream.send_seconds)
+        reply = {'status': status, 'execution_count': execution_count}
+        if status == 'error':
+            ename, evalue, traceback = error
+            err = {'ename': ename, 'evalue': evalue, 'traceback': traceback}
+            if not silent:
+                self.send_response(self.iopub_socket, 'error', err)
+            reply.update(err)
+        elif status == 'ok':
+            reply.update({'payload': [], 'user_expressions': {}})
+        else:
+            raise ValueError("Invalid status: %r" % status)
+        return reply
+
+    def _broadcast_job(self, code, boards, execution_count):
+        """Return the function running a cell on one board, from a pool thread"""
+        put = None
+        magic = split_magic(code)
+        if magic is not None:
+            name, line, body = magic
+            if name != 'put':
+                raise MagicError('%{} cannot be run on several boards'.format(name))
+            from . import files
+            put = self._put_args(line)
+
+        def job(label, write):
+            transport = self.transports.get(label)
+            if transport is None:
+                transport = self.transports[label] = self.open_board(boards[label])
+            if transport.capture is not None:
+                transport.capture.note('cell {}'.format(execution_count))
+            stream = OutputStream(write, interval=self.stream_interval,
+                                  max_bytes=self.stream_max_bytes)
+            try:
+                if put is not None:
+                    src, dest, options, shown = put
+                    transfer = files.put(transport, src, dest, **options)
+                    transfer.src = shown
+                    stream.write(str(transfer) + '\n')
+                else:
+                    transport.exec_start(code)
+                    error = transport.follow(stream, interval=self.stream_interval)
+                    if error.strip():
+                        raise RemoteError(error)
+            except (TransportError, OSError):
+                # The connection is in an unknown state, reconnect on the next cell
+                self.transports.pop(label, None)
+                transport.close()
+                raise
+            finally:
+                stream.flush()
+        return job
+
+    def _interrupt_board(self, label):
+        """Send Ctrl-C to a board; its thread collects the traceback"""
+        transport = self.transports.get(label)
+        if transport is not None:
+            transport.write(b'\x03', paced=False)
+
+    def run_magic(self, magic, stream):
+        """Run a ``%name`` cell with the ``magic_name`` method"""
+        name, line, body = magic
+        method = getattr(self, 'magic_' + name, None)
+        if method is None:
+            raise MagicError('Unknown magic %{}'.format(name))
+        method(line, body, stream)
+
+    def magic_put(self, line, body, stream):
+        """%put [-z] [-f] [-c] src [dest]: copy a local file to the board"""
+        from . import files
+        src, dest, options, shown = self._put_args(line)
+        transfer = files.put(self.transport, src, dest, **options)
+        transfer.src = shown
+        stream.write(str(transfer) + '\n')
+
+    def magic_telemetry(self, line, body, stream):
+        """%%telemetry [options] format: capture the records the cell writes
+        with telemetry.write(*values), packed with the struct format"""
+        from . import telemetry
+        parser = MagicParser('telemetry')
+        parser.add_argument('-n', '--name', default='records',
+                            help='notebook variable of the records, a NumPy memmap')
+        parser.add_argument('-o', '--output',
+                            help='.npy file of the records, by default in output_log_dir')
+        parser.add_argument('-f', '--fields', help='comma separated field names')
+        parser.add_argument('-t', '--seconds', type=float, help='stop after this long')
+        parser.add_argument('-r', '--records', type=int,
+                            help='stop after this many records')
+        parser.add_argument('-b', '--batch', type=int, default=32,
+                            help='records the board sends at a time')
+        parser.add_argument('-w', '--width', type=int, default=400,
+                            help='buckets of the live view')
+        parser.add_argument('format', help='struct format of a record, e.g. <Hf')
+        args = parser.parse(line)
+        if not body.strip():
+            raise MagicError('The cell body is the code writing the records')
+        try:
+            record_format = telemetry.RecordFormat(
+                args.format, args.fields.split(',') if args.fields else None)
+        except (ValueError, struct.error) as e:
+            raise MagicError(str(e))
+        path = args.output or os.path.join(self.output_log_dir, 'telemetry-{}-{}.npy'.format(
+            time.strftime('%Y%m%d-%H%M%S'), self.shell.execution_count))
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        writer = telemetry.NpyWriter(path, record_format)
+        view = telemetry.Decimator(record_format, args.width)
+        comm = Comm(target_name='mpkernel.telemetry',
+                    data={'path': path, 'fields': record_format.names})
+        display_id = uuid.uuid4().hex
+        start = time.time()
+        shown = []
+
+        def on_records(data):
+            writer.append(data)
+            view.add(data)
+
+        def on_tick():
+            stream.flush()
+            writer.sync()
+            rate = writer.count / max(time.time() - start, 1e-6)
+            summary = u'{} records, {:.0f} records/s, in {}'.format(writer.count, rate, path)
+            content = {'data': {'text/plain': summary, 'image/svg+xml': view.svg()},
+                       'metadata': {}, 'transient': {'display_id': display_id}}
+            self.send_response(self.iopub_socket,
+                               'update_display_data' if shown else 'display_data', content)
+            shown.append(True)
+            data = view.as_dict()
+            data['rate'] = rate
+            comm.send(data)
+
+        try:
+            telemetry.capture(self.transport, body, record_format, stream.write,
+                              on_records, on_tick, batch=args.batch,
+                              interval=max(self.stream_interval, 0.5),
+                              seconds=args.seconds, records=args.records)
+        finally:
+            writer.close()
+            comm.close()
+        seconds = time.time() - start
+        records = telemetry.load(path)
+        if records is not None:
+            self.shell.user_ns[args.name] = records
+        stream.write(u'{} records ({} bytes) in {:.2f} s, {:.0f} records/s, saved to {}{}\n'.format(
+            writer.count, writer.count * record_format.size, seconds,
+            writer.count / max(seconds, 1e-6), path,
+            u' and loaded as {}'.format(args.name) if records is not None else u''))
+
+    def magic_pull(self, line, body, stream):
+        """%pull [-n name] expression: copy a value from the board into the notebook"""
+        from . import variables
+        parser = MagicParser('pull')
+        parser.add_argument('-n', '--name',
+                            help='notebook variable to assign, by default the expression')
+        parser.add_argument('expression', nargs='+')
+        args = parser.parse(line)
+        expression = ' '.join(args.expression)
+        name = args.name or expression
+        if not name.isidentifier():
+            raise MagicError('Give the notebook variable to assign with -n')
+        value, transfer = variables.pull(self.transport, expression)
+        self.shell.user_ns[name] = value
+        transfer.dest = '{} {}'.format(name, transfer.dest)
+        stream.write(str(transfer) + '\n')
+
+    def magic_push(self, line, body, stream):
+        """%push [-n target] name: copy a notebook variable to the board"""
+        from . import variables
+        parser = MagicParser('push')
+        parser.add_argument('-n', '--name',
+                            help='what to assign on the board, by default the same name')
+        parser.add_argument('expression', nargs='+')
+        args = parser.parse(line)
+        expression = ' '.join(args.expression)
+        target = args.name or expression
+        try:
+            value = self.shell.ev(expression)
+        except Exception as e:
+            raise MagicError('{}: {}'.format(type(e).__name__, e))
+        try:
+            transfer = variables.push(self.transport, value, target,
+                                      chunk_size=self.transfer_chunk_size,
+                                      window=self.transfer_window)
+        except TypeError as e:
+            raise MagicError(str(e))
+        stream.write(str(transfer) + '\n')
+
+    def magic_memtrace(self, line, body, stream):
+        """%memtrace [on|off|clear] [-l bytes] [-f fraction]: plot the board's
+        heap over the session, flagging the cells that keep memory or leave
+        the heap fragmented"""
+        from mpkernel import heap
+        args = heap.memtrace_args(line)
+        if args.action == 'clear':
+            stream.write(u'Cleared the heap usage of {} cells\n'.format(len(self.heap_trace)))
+            self.heap_trace.clear()
+        elif args.action:
+            self.heap_usage = args.action == 'on'
+            stream.write(u'Heap usage is {} measured\n'.format(
+                'now' if self.heap_usage else 'no longer'))
+        elif not self._silent:
+            self.send_response(self.iopub_socket, 'display_data', {
+                'data': self.heap_trace.view(args.leak, args.fragmentation), 'metadata': {}})
+
+    def magic_mprof(self, line, body, stream):
+        """%%mprof [-f] [-s time|hits|line] [-n rows]: run the cell with a probe
+        before each line, or around each function, and show where the time
+        went on the board"""
+        from mpkernel import mprof
+        args = mprof.mprof_args(line)
+        if not body.strip():
+            raise MagicError('The cell body is the code to profile')
+        instrumented = mprof.Instrumented(body, functions=args.functions)
+        probe = RecordFilter(stream, mprof.MARKER, mprof.END)
+        with self.timer.phase('transfer'):
+            self.transport.exec_start(instrumented.program())
+        with self.timer.phase('exec'):
+            error = self.transport.follow(probe, interval=self.stream_interval)
+        probe.close()
+        profile = instrumented.profile(probe.record)
+        if profile is not None and not self._silent:
+            stream.flush()
+            self.send_response(self.iopub_socket, 'display_data', {
+                'data': {'text/plain': profile.table(args.rows, args.sort)},
+                'metadata': {'mprof': profile.as_dict()}})
+        if error.strip():
+            raise RemoteError(instrumented.fix_traceback(fix_traceback(error)))
+
+    def magic_timeit(self, line, body, stream):
+        """%timeit [-n loops] [-r repeat] [-t seconds] [-s file] statement, or
+        %%timeit [options] [setup] with the statement in the cell: time a
+        statement on the board"""
+        from mpkernel import timeit
+        timing = timeit.Timeit(line, body if body.strip() else None, target=self.device or u'')
+        probe = RecordFilter(stream, timeit.MARKER, timeit.END)
+        with self.timer.phase('transfer'):
+            self.transport.exec_start(timing.source)
+        with self.timer.phase('exec'):
+            error = self.transport.follow(probe, interval=self.stream_interval)
+        probe.close()
+        if error.strip():
+            raise RemoteError(timing.fix_traceback(error))
+        result = timing.result(probe.record)
+        if result is None:
+            raise RemoteError('The board sent no timings')
+        stream.write(str(result) + u'\n')
+        comparison = timing.save(result)
+        if comparison:
+            stream.write(comparison + u'\n')
+
+    def _put_args(self, line):
+        """Parse a %put line, compiling the file first for -c.
+
+        :return: The file to send, its destination on the board, the
+          options of :func:`files.put` and the file name to show.
+        """
+        parser = MagicParser('put')
+        parser.add_argument('-z', '--compress', action='store_true',
+                            help='compress the data sent to the board')
+        parser.add_argument('-c', '--mpy', action='store_true',
+                            help='compile a module to .mpy with mpy-cross first')
+        parser.add_argument('-f', '--force', action='store_true',
+                            help='copy even if the board has the same file')
+        parser.add_argument('src')
+        parser.add_argument('dest', nargs='?')
+        args = parser.parse(line)
+        if not os.path.isfile(args.src):
+            raise MagicError('No such file: {}'.format(args.src))
+        src, dest = args.src, args.dest or os.path.basename(args.src)
+        if args.mpy:
+            with io.open(src, encoding='utf-8') as f:
+                source = f.read()
+            try:
+                src = self.mpy_cache.compile(source, name=os.path.basename(args.src))
+            except OSError as e:
+                raise MagicError('Could not run {}: {}'.format(self.mpy_cross, e))
+            if not args.dest:
+                dest = os.path.splitext(dest)[0] + '.mpy'
+        options = dict(chunk_size=self.transfer_chunk_size, compress=args.compress,
+                       window=self.transfer_window, force=args.force)
+        return src, dest, options, args.src
+
+    def magic_sync(self, line, body, stream):
+        """%sync [options] src [dest]: copy the files of a local directory that
+        changed since the last sync to the board, and delete those removed"""
+        from . import sync
+        parser = MagicParser('sync')
+        parser.add_argument('-n', '--dry-run', action='store_true',
+                            help='only list what would be uploaded and deleted')
+        parser.add_argument('-r', '--reset', action='store_true',
+                            help='soft reset the board afterwards')
+        parser.add_argument('-z', '--compress', action='store_true',
+                            help='compress the data sent to the board')
+        parser.add_argument('-f', '--force', action='store_true',
+                            help="upload every file, ignoring the board's manifest")
+        parser.add_argument('-k', '--keep', action='store_true',
+                            help='keep the files on the board that were removed locally')
+        parser.add_argument('-x', '--exclude', action='append', default=[],
+                            help='also leave out files and directories matching '
+                            'this pattern')
+        parser.add_argument('src')
+        parser.add_argument('dest', nargs='?', default='')
+        args = parser.parse(line)
+        if not os.path.isdir(args.src):
+            raise MagicError('No such directory: {}'.format(args.src))
+        with self.timer.phase('transfer'):
+            result = sync.sync(self.transport, args.src, args.dest,
+                               exclude=sync.EXCLUDE + tuple(args.exclude),
+                               delete=not args.keep, force=args.force,
+                               dry_run=args.dry_run, compress=args.compress,
+                               chunk_size=self.transfer_chunk_size,
+                               window=self.transfer_window)
+        stream.write(str(result) + '\n')
+        if args.reset and not args.dry_run:
+            self.transport.enter_raw_repl(soft_reset=True)
+            self.completions.clear()
+            stream.write(u'Soft reset\n')
+
+    def magic_get(self, line, body, stream):
+        """%get [-f] src [dest]: copy a file from the board"""
+        from . import files
+        parser = MagicParser('get')
+        parser.add_argument('-f', '--force', action='store_true',
+                            help='copy even if the local file is the same')
+        parser.add_argument('src')
+        parser.add_argument('dest', nargs='?')
+        args = parser.parse(line)
+        dest = args.dest or os.path.basename(args.src)
+        if not os.path.isdir(os.path.dirname(os.path.abspath(dest))):
+            raise MagicError('No such directory: {}'.format(os.path.dirname(dest)))
+        transfer = files.get(self.transport, args.src, dest,
+                             chunk_size=self.transfer_chunk_size, force=args.force)
+        stream.write(str(transfer) + '\n')
@@ -0,0 +1,352 @@
+"""
+sync.py
+
+Keep a directory on the board in step with a project directory on the host
+
+The board keeps a manifest of the hash of every file it was last synced to,
+as a log to which each sync appends the files it uploaded and deleted and a
+token naming the result. The host caches the manifests it wrote by token, so
+reading the manifest is a single exchange in which the board only sends its
+token, unless the host does not know it. The local files' hashes are cached
+by size and modification time so that unchanged files are not read again.
+Then one program on the board deletes the files that were removed and
+receives every changed file, followed by the manifest's new lines, as
+acknowledged frames of ``chunk_size`` bytes, so the cost is that of the
+changed bytes rather than a round trip per file.
+"""
+import io
+import os
+import json
+import time
+import uuid
+import fnmatch
+import collections
+
+from mpkernel.repl import RemoteError
+from . import files
+
+MANIFEST = '.mpk_manifest'
+
+# Hidden files and directories, bytecode caches
+EXCLUDE = ('.*', '__pycache__', '*.pyc')
+
+# Hex digits of the SHA-256 kept for each file
+HASH_DIGITS = 16
+
+# Manifests cached on the host
+CACHED_MANIFESTS = 20
+
+# Prints the token ending the manifest and its number of lines if the host
+# knows it, or else the whole manifest
+READ_MANIFEST_PROGRAM = """\
+def _mpk_manifest(known):
+    try:
+        f = open({path!r})
+    except OSError:
+        return
+    t, n = None, 0
+    for l in f:
+        n += 1
+        if l[:2] == '# ':
+            t = l[2:].strip()
+    f.close()
+    if t in known:
+        print('#', t, n)
+        return
+    f = open({path!r})
+    for l in f:
+        print(l, end='')
+    f.close()
+_mpk_manifest({known!r})
+del _mpk_manifest
+"""
+
+PREPARE_PROGRAM = """\
+import os
+def _mpk_mkdirs(p):
+    d = ''
+    for part in p.split('/')[:-1]:
+        d += part
+        if d:
+            try:
+                os.mkdir(d)
+            except OSError:
+                pass
+        d += '/'
+for p in {remove!r}:
+    try:
+        os.remove(p)
+    except OSError:
+        pass
+for p in {dirs!r}:
+    try:
+        os.rmdir(p)
+    except OSError:
+        pass
+for p in {paths!r}:
+    _mpk_mkdirs(p)
+"""
+
+# Each file is acknowledged once it is closed, so that the frames of the
+# next can be sent in the same window
+SYNC_PROGRAM = PREPARE_PROGRAM + """\
+import sys, struct, micropython
+{decompress}
+micropython.kbd_intr(-1)
+try:
+    r = sys.stdin.buffer.read
+    w = sys.stdout.write
+    w('\\x06')
+    for p in {paths!r}:
+        f = open(p, 'ab' if {append!r} and p == {manifest!r} else 'wb')
+        while True:
+            n = struct.unpack('<I', r(4))[0]
+            if not n:
+                break
+            f.write({frame})
+            w('\\x06')
+        f.close()
+        w('\\x06')
+finally:
+    micropython.kbd_intr(3)
+"""
+
+
+def default_cache_path():
+    return os.path.join(os.path.expanduser('~'), '.cache', 'mpkernel', 'sync.json')
+
+
+class SyncCache(object):
+    """
+    The hashes of local files, kept on disk with their size and modification
+    time so that a file is only read again once it changes, and the last
+    manifests written to boards, by their token
+
+    :param path: The JSON file the cache is kept in.
+    """
+    def __init__(self, path=None):
+        self.path = path or default_cache_path()
+        self.hashes = {}
+        # Oldest first
+        self.manifests = collections.OrderedDict()
+        self.changed = False
+        try:
+            with io.open(self.path, encoding='utf-8') as f:
+                data = json.load(f)
+            self.hashes = data['hashes']
+            self.manifests.update(data['manifests'])
+        except (IOError, OSError, ValueError, KeyError, TypeError):
+            pass
+
+    def hash(self, path):
+        path = os.path.abspath(path)
+        st = os.stat(path)
+        stamp = [st.st_size, st.st_mtime_ns]
+        entry = self.hashes.get(path)
+        if entry is not None and entry[:2] == stamp:
+            return entry[2]
+        digest = files.local_hash(path)[:HASH_DIGITS]
+        self.hashes[path] = stamp + [digest]
+        self.changed = True
+        return digest
+
+    def add_manifest(self, token, manifest):
+        self.manifests[token] = manifest
+        while len(self.manifests) > CACHED_MANIFESTS:
+            self.manifests.popitem(last=False)
+        self.changed = True
+
+    def save(self):
+        if not self.changed:
+            return
+        directory = os.path.dirname(self.path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        tmp = '{}.{}.tmp'.format(self.path, os.getpid())
+        with io.open(tmp, 'w', encoding='utf-8') as f:
+            f.write(json.dumps({'hashes': self.hashes, 'manifests': self.manifests}))
+        os.rename(tmp, self.path)
+        self.changed = False
+
+
+def excluded(name, exclude):
+    return any(fnmatch.fnmatch(name, pattern) for pattern in exclude)
+
+
+def local_manifest(src, exclude=EXCLUDE, cache=None):
+    """Return the hash of each file under ``src`` by its path relative to
+    ``src``, with ``/`` separators"""
+    cache = cache or SyncCache()
+    manifest = {}
+    for root, dirs, names in os.walk(src):
+        dirs[:] = sorted(d for d in dirs if not excluded(d, exclude))
+        for name in names:
+            if excluded(name, exclude):
+                continue
+            path = os.path.join(root, name)
+            if os.path.isfile(path):
+                manifest[os.path.relpath(path, src).replace(os.sep, '/')] = cache.hash(path)
+    return manifest
+
+
+def parse_manifest(text):
+    """Return the hash of each file in a manifest by its path, the token that
+    ends it, and its number of lines"""
+    manifest = {}
+    token = None
+    lines = 0
+    for line in text.splitlines():
+        digest, _, path = line.strip().partition(' ')
+        if not path:
+            continue
+        lines += 1
+        if digest == '#':
+            token = path
+        elif digest == '-':
+            manifest.pop(path, None)
+        else:
+            manifest[path] = digest
+    return manifest, token, lines
+
+
+def format_manifest(manifest, token, removed=()):
+    """Return the lines of a manifest listing the files in ``manifest`` and
+    ``removed`` as deleted, ending with ``token``"""
+    lines = [u'- {}\n'.format(path) for path in sorted(removed)]
+    lines += [u'{} {}\n'.format(manifest[path], path) for path in sorted(manifest)]
+    return u''.join(lines) + u'# {}\n'.format(token)
+
+
+def board_path(dest, path):
+    """Return the path on the board of ``path`` relative to ``dest``"""
+    return '{}/{}'.format(dest.rstrip('/'), path) if dest else path
+
+
+def remote_manifest(transport, dest, cache, timeout=10):
+    """Return the manifest of ``dest`` on the board, empty if there is none,
+    with its token and number of lines"""
+    out = io.StringIO()
+    program = READ_MANIFEST_PROGRAM.format(path=board_path(dest, MANIFEST),
+                                           known=list(cache.manifests))
+    error = transport.exec_raw(program, out, timeout=timeout)
+    if error:
+        raise RemoteError(error)
+    text = out.getvalue().strip()
+    known = text.split()
+    if len(known) == 3 and known[0] == '#' and known[1] in cache.manifests:
+        return dict(cache.manifests[known[1]]), known[1], int(known[2])
+    return parse_manifest(text)
+
+
+class SyncResult(object):
+    """What a sync uploaded and deleted, or would have for a dry run"""
+    def __init__(self, src, dest, uploaded, deleted, unchanged, size=0,
+                 seconds=0.0, dry_run=False):
+        self.src = src
+        self.dest = dest
+        # Paths relative to src and dest
+        self.uploaded = uploaded
+        self.deleted = deleted
+        self.unchanged = unchanged
+        self.size = size
+        self.seconds = seconds
+        self.dry_run = dry_run
+
+    def __str__(self):
+        lines = [u'{} -> {}: {} {} ({:.1f} KB), {} {}, {} unchanged'.format(
+            self.src, self.dest or '.', len(self.uploaded),
+            'to upload' if self.dry_run else 'uploaded', self.size / 1024.0,
+            len(self.deleted), 'to delete' if self.dry_run else 'deleted', self.unchanged)]
+        if not self.dry_run:
+            lines[0] += u' in {:.2f} s'.format(self.seconds)
+        lines += [u'  + {}'.format(path) for path in self.uploaded]
+        lines += [u'  - {}'.format(path) for path in self.deleted]
+        return u'\n'.join(lines)
+
+
+def sync(transport, src, dest='', exclude=EXCLUDE, delete=True, force=False,
+         dry_run=False, compress=False, chunk_size=4096, window=2, cache=None,
+         timeout=10):
+    """Copy the files under local directory ``src`` that changed since the
+    last sync to ``dest`` on the board, and delete those that were removed.
+
+    :param bool delete: Delete the files synced before that are no longer
+      under ``src``; files the manifest does not list are never deleted.
+    :param bool force: Upload every file, whatever the manifest says.
+    :param bool dry_run: Only work out what would be uploaded and deleted.
+    :param cache: The :class:`SyncCache` of the local files and manifests.
+    :return: A :class:`SyncResult`.
+
+    See :func:`files.put` for the other parameters.
+    """
+    if not os.path.isdir(src):
+        raise OSError('No such directory: {}'.format(src))
+    start = time.time()
+    cache = cache or SyncCache()
+    local = local_manifest(src, exclude, cache)
+    cache.save()
+    remote, token, lines = remote_manifest(transport, dest, cache, timeout)
+    upload = sorted(path for path in local if force or remote.get(path) != local[path])
+    removed = sorted(path for path in remote if path not in local) if delete else []
+    size = sum(os.path.getsize(os.path.join(src, path)) for path in upload)
+    result = SyncResult(src, dest, upload, removed, len(local) - len(upload), size,
+                        dry_run=dry_run)
+    if dry_run or not (upload or removed):
+        result.seconds = time.time() - start
+        return result
+
+    manifest = dict((path, digest) for path, digest in remote.items() if path not in removed)
+    manifest.update(local)
+    sources = [os.path.join(src, path) for path in upload]
+    paths = [board_path(dest, path) for path in upload] + [board_path(dest, MANIFEST)]
+    remove = [board_path(dest, path) for path in removed]
+    # The directories left empty are removed, deepest first
+    dirs = set()
+    for path in removed:
+        parts = path.split('/')[:-1]
+        dirs.update('/'.join(parts[:i]) for i in range(1, len(parts) + 1))
+    dirs = [board_path(dest, d) for d in sorted(dirs, key=lambda d: -d.count('/'))]
+    # The changes are appended to the manifest until it is twice as long as
+    # the manifest written anew
+    new_token = uuid.uuid4().hex[:16]
+    append = (token is not None and not transport.binary_files and
+              lines + len(upload) + len(removed) + 1 <= 2 * (len(manifest) + 1))
+    if append:
+        data = format_manifest(dict((path, local[path]) for path in upload), new_token,
+                               removed)
+    else:
+        data = format_manifest(manifest, new_token)
+    data = data.encode('utf-8')
+
+    if transport.binary_files:
+        out = io.StringIO()
+        error = transport.exec_raw(PREPARE_PROGRAM.format(remove=remove, dirs=dirs, paths=paths),
+                                   out, timeout=timeout)
+        if error:
+            raise RemoteError(error)
+        for source, path in zip(sources, paths):
+            with open(source, 'rb') as f:
+                transport.put_file(f, path, os.path.getsize(source), chunk_size, timeout)
+        transport.put_file(io.BytesIO(data), paths[-1], len(data), chunk_size, timeout)
+    else:
+        program = SYNC_PROGRAM.format(remove=remove, dirs=dirs, paths=paths,
+                                      append=append, manifest=paths[-1],
+                                      decompress=files.DECOMPRESS if compress else '',
+                                      frame='unz(r(n))' if compress else 'r(n)')
+        transport.exec_start(program, timeout)
+        files.send_frames(transport, _frames(sources, data, chunk_size, compress),
+                          window, timeout)
+    cache.add_manifest(new_token, manifest)
+    cache.save()
+    result.seconds = time.time() - start
+    return result
+
+
+def _frames(sources, manifest, chunk_size, compress):
+    """Yield the frames of each file in turn, then of the manifest"""
+    for source in sources:
+        with open(source, 'rb') as f:
+            for frame in files.frames(f, chunk_size, compress):
+                yield frame
+    for frame in files.frames(io.BytesIO(manifest), chunk_size, compress):
+        yield frame
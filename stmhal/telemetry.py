@@ -0,0 +1,361 @@
+"""
+telemetry.py
+
+Capture fixed-size binary records from the board at the link's rate
+
+The cell's code calls ``telemetry.write(*values)`` on the board, which packs
+each record with ``struct`` into a batch and writes the batch as one frame:
+``\\x01``, its length as two little endian bytes, then the records. An empty
+frame ends the capture, and anything else the cell prints is passed on as
+text. The host appends the records to a ``.npy`` file, so they never go
+through Jupyter and can be opened with ``numpy.load(path, mmap_mode='r')``,
+while the notebook is sent a view of at most ``width`` buckets holding the
+minimum and maximum of each field, updated every ``interval`` seconds.
+"""
+import re
+import io
+import time
+import struct
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from mpkernel.repl import RemoteError, split_exception
+
+FRAME = b'\x01'
+
+CAPTURE_PROGRAM = """\
+import sys, struct
+class _MpkTelemetry:
+    def __init__(self, fmt, n):
+        self.fmt = fmt
+        self.size = struct.calcsize(fmt)
+        self.n = n
+        self.i = 0
+        self.buf = bytearray(3 + self.size * n)
+        self.buf[0] = 1
+        self.mv = memoryview(self.buf)
+        self.w = sys.stdout.buffer.write
+    def write(self, *values):
+        struct.pack_into(self.fmt, self.buf, 3 + self.i * self.size, *values)
+        self.i += 1
+        if self.i == self.n:
+            self.flush()
+    def flush(self):
+        if self.i:
+            n = self.i * self.size
+            struct.pack_into('<H', self.buf, 1, n)
+            self.w(self.mv[:3 + n])
+            self.i = 0
+telemetry = _MpkTelemetry({fmt!r}, {batch})
+try:
+    exec({body!r})
+finally:
+    telemetry.flush()
+    sys.stdout.buffer.write(b'\\x01\\0\\0')
+    del telemetry, _MpkTelemetry
+"""
+
+# NumPy type strings of the struct format characters, with standard sizes
+DTYPES = {
+    'b': 'i1', 'B': 'u1', '?': 'b1', 'h': 'i2', 'H': 'u2', 'i': 'i4', 'I': 'u4',
+    'l': 'i4', 'L': 'u4', 'q': 'i8', 'Q': 'u8', 'e': 'f2', 'f': 'f4', 'd': 'f8',
+}
+
+_FIELD = re.compile(r'(\d*)([a-zA-Z?])')
+
+
+class RecordFormat(object):
+    """
+    The layout of a record, from a ``struct`` format and field names
+
+    A format without a byte order is taken as little endian with standard
+    sizes, since native alignment differs between the board and the host.
+    """
+    def __init__(self, fmt, names=None):
+        fmt = fmt.replace(' ', '')
+        order = '<'
+        if fmt[:1] in '<>=!@':
+            order, fmt = fmt[0], fmt[1:]
+        order = {'@': '<', '=': '<', '!': '>'}.get(order, order)
+        self.fmt = order + fmt
+        self.size = struct.calcsize(self.fmt)
+        types = []
+        position = 0
+        for match in _FIELD.finditer(fmt):
+            if match.start() != position:
+                break
+            position = match.end()
+            count, code = int(match.group(1) or 1), match.group(2)
+            if code == 's':
+                types.append('|S{}'.format(count))
+            elif code in DTYPES:
+                dtype = DTYPES[code]
+                types += [('|' if dtype[1] == '1' else order) + dtype] * count
+            else:
+                raise ValueError('Unsupported format character {!r}'.format(code))
+        if position != len(fmt) or not types:
+            raise ValueError('Invalid record format {!r}'.format(self.fmt))
+        names = list(names or [])
+        if len(names) > len(types):
+            raise ValueError('{} names for {} fields'.format(len(names), len(types)))
+        self.names = names + ['f{}'.format(i) for i in range(len(names), len(types))]
+        self.types = types
+        # The fields that have a minimum and maximum
+        self.numeric = [i for i, t in enumerate(types) if t[1] != 'S']
+
+    @property
+    def descr(self):
+        """The NumPy dtype description of a record"""
+        return list(zip(self.names, self.types))
+
+
+class NpyWriter(object):
+    """
+    Append records to a ``.npy`` file whose header keeps track of their number
+
+    The header is written with room for any record count, so that it can be
+    updated in place while records are being appended.
+    """
+    MAGIC = b'\x93NUMPY\x01\x00'
+
+    def __init__(self, path, record_format):
+        self.path = path
+        self.format = record_format
+        self.count = 0
+        # Aligned to 64 bytes, with room for the longest count
+        longest = len(self.MAGIC) + 2 + len(self._dict(10 ** 20)) + 1
+        self._text_size = -(-longest // 64) * 64 - len(self.MAGIC) - 2
+        self.file = io.open(path, 'wb')
+        self.file.write(self._header(0))
+
+    def _dict(self, count):
+        return "{{'descr': {!r}, 'fortran_order': False, 'shape': ({},), }}".format(
+            self.format.descr, count)
+
+    def _header(self, count):
+        text = self._dict(count).ljust(self._text_size - 1) + '\n'
+        return self.MAGIC + struct.pack('<H', len(text)) + text.encode('latin1')
+
+    def append(self, data):
+        self.file.write(data)
+        self.count += len(data) // self.format.size
+
+    def sync(self):
+        """Update the header's record count and flush the file"""
+        self.file.seek(0)
+        self.file.write(self._header(self.count))
+        self.file.seek(0, io.SEEK_END)
+        self.file.flush()
+
+    def close(self):
+        self.sync()
+        self.file.close()
+
+
+class Decimator(object):
+    """
+    The minimum and maximum of each numeric field in at most ``width``
+    buckets of consecutive records
+
+    Each bucket starts as one record; once there are more than ``width``
+    buckets, neighbours are merged and each bucket covers twice as many, so
+    the view of a capture of any length costs the same to keep and send.
+    """
+    def __init__(self, record_format, width=400):
+        self.format = record_format
+        self.width = width
+        self.per_bucket = 1
+        self.count = 0
+        self.mins = [[] for _ in record_format.numeric]
+        self.maxs = [[] for _ in record_format.numeric]
+        self._filled = 0
+        self._low = None
+        self._high = None
+
+    def add(self, data):
+        records = list(struct.iter_unpack(self.format.fmt, data))
+        self.count += len(records)
+        if not records or not self.format.numeric:
+            return
+        columns = list(zip(*records))
+        columns = [columns[i] for i in self.format.numeric]
+        start = 0
+        while start < len(records):
+            end = min(len(records), start + self.per_bucket - self._filled)
+            low = [min(column[start:end]) for column in columns]
+            high = [max(column[start:end]) for column in columns]
+            if self._filled:
+                low = [min(a, b) for a, b in zip(low, self._low)]
+                high = [max(a, b) for a, b in zip(high, self._high)]
+            self._low, self._high = low, high
+            self._filled += end - start
+            start = end
+            if self._filled == self.per_bucket:
+                for mins, maxs, a, b in zip(self.mins, self.maxs, low, high):
+                    mins.append(a)
+                    maxs.append(b)
+                self._filled = 0
+                if len(self.mins[0]) > self.width:
+                    self._merge()
+
+    def _merge(self):
+        # Only called once a bucket is complete, so none is partly filled
+        odd = len(self.mins[0]) % 2
+        for values, pick in [(self.mins, min), (self.maxs, max)]:
+            for i, column in enumerate(values):
+                values[i] = [pick(column[j:j + 2]) for j in range(0, len(column), 2)]
+        if odd:
+            # The last bucket has half the records of the merged ones
+            self._low = [column.pop() for column in self.mins]
+            self._high = [column.pop() for column in self.maxs]
+            self._filled = self.per_bucket
+        self.per_bucket *= 2
+
+    def buckets(self):
+        """Return the minima and maxima of each numeric field, including the
+        bucket being filled"""
+        mins = [list(column) for column in self.mins]
+        maxs = [list(column) for column in self.maxs]
+        if self._filled:
+            for i in range(len(mins)):
+                mins[i].append(self._low[i])
+                maxs[i].append(self._high[i])
+        return mins, maxs
+
+    def as_dict(self):
+        mins, maxs = self.buckets()
+        return {
+            'count': self.count,
+            'per_bucket': self.per_bucket,
+            'fields': [self.format.names[i] for i in self.format.numeric],
+            'min': mins,
+            'max': maxs,
+        }
+
+    def svg(self, height=60):
+        """Return an SVG drawing of each field's envelope, one above the other"""
+        mins, maxs = self.buckets()
+        width = max(len(mins[0]) if mins else 0, 1)
+        rows = []
+        for row, (name, low, high) in enumerate(zip(
+                [self.format.names[i] for i in self.format.numeric], mins, maxs)):
+            top = row * (height + 20) + 16
+            if low:
+                bottom, peak = min(low), max(high)
+                scale = float(height) / ((peak - bottom) or 1)
+                path = ' '.join('M{} {:.1f}V{:.1f}'.format(
+                    x, top + height - (b - bottom) * scale,
+                    top + height - (a - bottom) * scale - 0.5)
+                    for x, (a, b) in enumerate(zip(high, low)))
+                label = u'{} [{:g}, {:g}]'.format(name, bottom, peak)
+            else:
+                path, label = '', name
+            rows.append(u'<text x="0" y="{}" font-size="12">{}</text>'
+                        u'<path d="{}" stroke="steelblue" fill="none"/>'.format(
+                            top - 4, label, path))
+        return (u'<svg xmlns="http://www.w3.org/2000/svg" width="{}" height="{}" '
+                u'viewBox="0 0 {} {}" preserveAspectRatio="none">{}</svg>'.format(
+                    max(width, 200), len(rows) * (height + 20), max(width, 200),
+                    len(rows) * (height + 20), u''.join(rows)))
+
+
+def load(path):
+    """Return the records of a capture file as a read-only NumPy memmap, or
+    None if NumPy is not installed"""
+    if numpy is None:
+        return None
+    return numpy.load(path, mmap_mode='r')
+
+
+class FrameReader(object):
+    """
+    Incrementally split the capture's output into text and records
+
+    :meth:`feed` returns the text and record data that are complete; once
+    the empty frame, or the end of the output if the program failed before
+    sending it, is reached ``done`` is set and ``rest`` holds what follows.
+    """
+    def __init__(self):
+        self.done = False
+        self.rest = b''
+        self._data = b''
+
+    def feed(self, data):
+        if self.done:
+            self.rest += data
+            return b'', b''
+        data = self._data + data
+        text = b''
+        records = []
+        while data and not self.done:
+            if data[:1] != FRAME:
+                end = min(i for i in (data.find(FRAME), data.find(b'\x04'), len(data)) if i >= 0)
+                text += data[:end]
+                data = data[end:]
+                if data[:1] == b'\x04':
+                    self.done = True
+                    self.rest = data
+                    data = b''
+            if len(data) < 3:
+                break
+            size = struct.unpack('<H', data[1:3])[0]
+            if not size:
+                self.done = True
+                self.rest = data[3:]
+                data = b''
+                break
+            if len(data) < 3 + size:
+                break
+            records.append(data[3:3 + size])
+            data = data[3 + size:]
+        self._data = data
+        return text, b''.join(records)
+
+
+def capture(transport, body, record_format, on_text, on_records, on_tick,
+            batch=32, interval=0.5, seconds=None, records=None):
+    """Run ``body`` on the board, passing its records to ``on_records`` and its
+    output to ``on_text`` until it ends, is interrupted, or ``seconds`` or
+    ``records`` is reached. ``on_tick`` is called every ``interval`` seconds.
+
+    :return: Whether the capture was stopped from the host, rather than
+      ending by itself.
+    """
+    program = CAPTURE_PROGRAM.format(fmt=record_format.fmt, batch=batch, body=body)
+    transport.exec_start(program)
+    reader = FrameReader()
+    start = last_tick = time.time()
+    received = 0
+    stopped = False
+    while not reader.done:
+        try:
+            data = transport.read(65536, 0.05)
+            text, data = reader.feed(data)
+            if text:
+                on_text(text.decode('utf-8', 'replace'))
+            if data:
+                received += len(data) // record_format.size
+                on_records(data)
+            now = time.time()
+            if now - last_tick >= interval:
+                last_tick = now
+                on_tick()
+            if not stopped and ((seconds is not None and now - start >= seconds) or
+                                (records is not None and received >= records)):
+                raise KeyboardInterrupt
+        except KeyboardInterrupt:
+            if not stopped:
+                stopped = True
+                transport.write(b'\x03', paced=False)
+    on_tick()
+    transport.unread(reader.rest)
+    output = io.StringIO()
+    error = transport.follow(output)
+    if output.getvalue():
+        on_text(output.getvalue())
+    if error.strip() and not (stopped and split_exception(error)[0] == 'KeyboardInterrupt'):
+        raise RemoteError(error)
+    return stopped
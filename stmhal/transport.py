@@ -0,0 +1,327 @@
+"""
+transport.py
+
+Raw REPL connection to a board running micropython
+
+A background thread copies everything the board sends into a ring buffer,
+so the board never stalls on a full USB CDC buffer while the kernel is busy
+relaying output, and commands are written in chunks paced for the board's
+receive buffer.
+"""
+import time
+import codecs
+import struct
+import threading
+
+from mpkernel.repl import RawReplReader
+
+
+class TransportError(Exception):
+    pass
+
+
+class RingBuffer(object):
+    """
+    Fixed size byte buffer filled by one thread and drained by another
+
+    A writer waits while the buffer is full, so a reader that falls behind
+    slows the board down instead of losing output.
+    """
+    def __init__(self, size=65536):
+        self._buf = bytearray(size)
+        self._start = 0
+        self._len = 0
+        self._cond = threading.Condition()
+        self.closed = False
+
+    def __len__(self):
+        return self._len
+
+    def write(self, data):
+        """Append ``data``, waiting for room while the buffer is full"""
+        data = memoryview(data)
+        size = len(self._buf)
+        with self._cond:
+            while len(data) and not self.closed:
+                if self._len == size:
+                    self._cond.wait()
+                    continue
+                end = (self._start + self._len) % size
+                n = min(len(data), size - self._len, size - end)
+                self._buf[end:end + n] = data[:n]
+                self._len += n
+                data = data[n:]
+                self._cond.notify_all()
+
+    def read(self, size, timeout=None):
+        """Return up to ``size`` bytes, waiting up to ``timeout`` seconds for any.
+
+        Returns ``b''`` on timeout, or once the buffer is closed and empty.
+        """
+        with self._cond:
+            if not self._len and not self.closed:
+                self._cond.wait(timeout)
+            data = b''
+            while self._len and len(data) < size:
+                n = min(size - len(data), self._len, len(self._buf) - self._start)
+                data += bytes(self._buf[self._start:self._start + n])
+                self._start = (self._start + n) % len(self._buf)
+                self._len -= n
+            self._cond.notify_all()
+            return data
+
+    def wake(self):
+        """Return from a read waiting for data, with what it has"""
+        with self._cond:
+            self._cond.notify_all()
+
+    def close(self):
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
+
+
+class Transport(object):
+    """
+    The raw REPL protocol over a byte stream read by a background thread
+
+    Subclasses implement ``_read_chunk``, which returns whatever bytes have
+    arrived (possibly none) after waiting briefly, and ``_write``.
+    """
+    raw_banner = b'raw REPL; CTRL-B to exit\r\n'
+    # Whether files are copied with put_file and get_file, a protocol of the
+    # link's own, rather than by a program run in the raw REPL
+    binary_files = False
+
+    def __init__(self, chunk_size=256, chunk_delay=0.01, buffer_size=65536, capture=None):
+        # Commands are written chunk_size bytes every chunk_delay seconds
+        # unless the board supports raw-paste mode, which has flow control
+        self.chunk_size = chunk_size
+        self.chunk_delay = chunk_delay
+        self.buffer = RingBuffer(buffer_size)
+        # Whether the board supports raw-paste mode, None until it is tried
+        self.raw_paste = None
+        self.error = None
+        self._pushback = b''
+        self._reader = threading.Thread(target=self._read_loop)
+        self._reader.daemon = True
+        # A :class:`~mpkernel.capture.Capture` of the bytes read and written
+        self.capture = capture
+        if capture is not None:
+            write = self._write
+
+            def recorded(data):
+                capture.write(data)
+                write(data)
+            self._write = recorded
+
+    def start(self):
+        self._reader.start()
+
+    def _read_loop(self):
+        while not self.buffer.closed:
+            try:
+                data = self._read_chunk()
+            except Exception as e:
+                self.error = e
+                break
+            if data:
+                if self.capture is not None:
+                    self.capture.read(data)
+                self.buffer.write(data)
+        self.buffer.close()
+
+    def close(self):
+        self.buffer.close()
+        if self.capture is not None:
+            self.capture.close()
+
+    def read(self, size=4096, timeout=None):
+        """Read up to ``size`` bytes, ``b''`` if none arrived within ``timeout``"""
+        if self._pushback:
+            data, self._pushback = self._pushback[:size], self._pushback[size:]
+            return data
+        data = self.buffer.read(size, timeout)
+        if not data and self.buffer.closed:
+            raise TransportError("Connection closed: {}".format(self.error))
+        return data
+
+    def read_until(self, marker, timeout=None):
+        """Read up to and including ``marker``, keeping what follows it"""
+        data = b''
+        deadline = None if timeout is None else time.time() + timeout
+        while marker not in data:
+            left = None if deadline is None else deadline - time.time()
+            if left is not None and left <= 0:
+                raise TransportError("Timed out waiting for {!r}, got {!r}"
+                                     .format(marker, data[-80:]))
+            data += self.read(4096, left)
+        end = data.index(marker) + len(marker)
+        self._pushback = data[end:] + self._pushback
+        return data[:end]
+
+    def read_exactly(self, size, timeout=None):
+        data = b''
+        while len(data) < size:
+            chunk = self.read(size - len(data), timeout)
+            if not chunk:
+                raise TransportError("Timed out reading {} bytes".format(size))
+            data += chunk
+        return data
+
+    def write(self, data, paced=True):
+        """Write ``data`` in chunks paced for the board's receive buffer.
+
+        :param bool paced: False to write ``data`` in one go, for when a
+          program on the board is reading it.
+        """
+        if not paced:
+            self._write(data)
+            return
+        for i in range(0, len(data), self.chunk_size):
+            self._write(data[i:i + self.chunk_size])
+            if self.chunk_delay and i + self.chunk_size < len(data):
+                time.sleep(self.chunk_delay)
+
+    def drain(self, timeout=0.05):
+        """Discard input until the board has been quiet for ``timeout`` seconds"""
+        self._pushback = b''
+        while self.read(4096, timeout):
+            pass
+
+    def enter_raw_repl(self, soft_reset=False, timeout=5):
+        """Interrupt any running program and switch to the raw REPL.
+
+        :param bool soft_reset: Also soft reset the board (Ctrl-D), which
+          clears its state.
+        """
+        self._write(b'\r\x03\x03')
+        self.drain()
+        self._write(b'\r\x01')
+        self.read_until(self.raw_banner + b'>', timeout)
+        if soft_reset:
+            self._write(b'\x04')
+            self.read_until(b'soft reboot\r\n', timeout)
+            self.read_until(self.raw_banner + b'>', timeout)
+
+    def exit_raw_repl(self):
+        self._write(b'\r\x02')
+
+    def interrupt(self, timeout=1):
+        """Interrupt the running command and wait for the raw REPL prompt"""
+        self._write(b'\x03')
+        try:
+            self.read_until(b'\x04>', timeout)
+        except TransportError:
+            pass
+        self.drain()
+
+    def _raw_paste_write(self, data, timeout):
+        """Send ``data`` in raw-paste mode, False if that is not supported"""
+        self._write(b'\x05A\x01')
+        reply = self.read_exactly(2, timeout)
+        if reply != b'R\x01':
+            if reply != b'R\x00':
+                # Taken as the start of a normal raw REPL command
+                self.read_until(self.raw_banner + b'>', timeout)
+            self.raw_paste = False
+            return False
+        self.raw_paste = True
+        window = struct.unpack('<H', self.read_exactly(2, timeout))[0]
+        remaining = window
+        i = 0
+        while i < len(data):
+            # The board sends \x01 each time it has room for another window
+            while remaining == 0 or (self._pushback or len(self.buffer)):
+                flow = self.read_exactly(1, timeout)
+                if flow == b'\x01':
+                    remaining += window
+                elif flow == b'\x04':
+                    # The board gave up on the command (e.g. a syntax error)
+                    self._write(b'\x04')
+                    return True
+                else:
+                    raise TransportError("Unexpected data during raw paste: %r" % flow)
+            chunk = data[i:i + remaining]
+            self._write(chunk)
+            remaining -= len(chunk)
+            i += len(chunk)
+        self._write(b'\x04')
+        self.read_until(b'\x04', timeout)
+        return True
+
+    def exec_raw(self, command, stream, timeout=None, interval=0.05,
+                 write_timeout=5):
+        """Run a command on the board in a single raw REPL exchange.
+
+        :param command: The source to run, text or utf-8 bytes.
+        :param stream: An object with ``write`` and ``flush`` methods, which
+          is given the command's output as text while it runs.
+        :param timeout: How long to wait without receiving any output, None
+          to wait indefinitely.
+        :param float interval: How long a single read waits for data before
+          ``stream`` is flushed.
+        :return: The exception message, an empty string if there was none.
+        """
+        self.exec_start(command, write_timeout)
+        return self.follow(stream, timeout, interval)
+
+    def exec_start(self, command, timeout=5):
+        """Send a command to the raw REPL and return once it has started.
+
+        The reply is left to be read, usually by :meth:`follow`.
+        """
+        if not isinstance(command, bytes):
+            command = command.encode('utf-8')
+        if self.raw_paste is False or not self._raw_paste_write(command, timeout):
+            self.write(command)
+            self._write(b'\x04')
+            reply = self.read_exactly(2, timeout)
+            if reply != b'OK':
+                raise TransportError("Could not exec command (response: %r)" % reply)
+
+    def unread(self, data):
+        """Return ``data`` to the front of the input"""
+        self._pushback = data + self._pushback
+
+    def follow(self, stream, timeout=None, interval=0.05):
+        """Relay the reply to a raw REPL command to ``stream``, see :meth:`exec_raw`"""
+        reader = RawReplReader(empty=b'')
+        decoder = codecs.getincrementaldecoder('utf-8')('replace')
+        last_read = time.time()
+        while not reader.done:
+            data = self.read(4096, interval)
+            if not data:
+                stream.flush()
+                if timeout is not None and time.time() - last_read > timeout:
+                    raise TransportError("No output from the board in %s seconds"
+                                         % timeout)
+                continue
+            last_read = time.time()
+            stream.write(decoder.decode(reader.feed(data)))
+        stream.write(decoder.decode(b'', True))
+        stream.flush()
+        return reader.error.decode('utf-8', 'replace')
+
+
+class SerialTransport(Transport):
+    """
+    Raw REPL connection over a serial port, usually the board's USB CDC device
+    """
+    def __init__(self, device, baudrate=115200, **kw):
+        super(SerialTransport, self).__init__(**kw)
+        import serial
+        self.device = device
+        self.serial = serial.Serial(device, baudrate=baudrate, timeout=0.05)
+        self.start()
+
+    def _read_chunk(self):
+        return self.serial.read(self.serial.in_waiting or 1)
+
+    def _write(self, data):
+        self.serial.write(data)
+
+    def close(self):
+        super(SerialTransport, self).close()
+        self._reader.join(1)
+        self.serial.close()
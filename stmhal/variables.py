@@ -0,0 +1,202 @@
+"""
+variables.py
+
+Copy variables between the notebook and the board as binary data
+
+``bytes``, ``bytearray``, ``array.array`` and lists of numbers are sent in
+their machine representation instead of being printed and parsed, so a
+buffer of floats costs four bytes an item on the link rather than its repr,
+and no text is formatted on the board or parsed on the host. Arrays and lists
+arrive on the host as NumPy arrays when NumPy is installed, otherwise as
+``array.array`` and lists. NumPy arrays, flattened, go back to the board as
+``array.array``.
+
+Both ends are assumed to be little endian, as are the boards micropython
+runs on.
+"""
+import io
+import time
+import array
+import struct
+import itertools
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from mpkernel.repl import RemoteError
+from .files import READY, Transfer, send_frames
+
+BYTES, BYTEARRAY, ARRAY, LIST = range(4)
+
+# Kind, typecode, item size and byte count of the value that follows
+HEADER = struct.Struct('<BBBI')
+
+# The value's type is checked on the board, where anything else would fail
+# with an unrelated error
+PULL_PROGRAM = """\
+import sys, struct, array
+def _mpk_pull(v):
+    t = type(v)
+    k = (0 if t is bytes else 1 if t is bytearray else 2 if t is array.array else
+         3 if t in (list, tuple) else -1)
+    if k < 0:
+        raise TypeError('Cannot pull a ' + t.__name__ + ', only bytes, bytearray, '
+                        'arrays and lists of numbers')
+    if k == 3:
+        v = array.array('d' if any(type(x) is float for x in v) else 'i', v)
+    c = 'B' if k < 2 else repr(v[:0])[7]
+    s = struct.calcsize(c)
+    w = sys.stdout.buffer.write
+    w(b'\\x06')
+    w(struct.pack('<BBBI', k, ord(c), s, len(v) * s))
+    w(v)
+try:
+    _mpk_pull({expression})
+finally:
+    del _mpk_pull
+"""
+
+# Ctrl-C is disabled while the frames are read, since they may contain \x03
+PUSH_PROGRAM = """\
+import sys, struct, micropython
+def _mpk_push():
+    b = bytearray({size})
+    m = memoryview(b)
+    r = sys.stdin.buffer.read
+    w = sys.stdout.write
+    i = 0
+    micropython.kbd_intr(-1)
+    try:
+        w('\\x06')
+        while True:
+            n = struct.unpack('<I', r(4))[0]
+            if not n:
+                break
+            m[i:i + n] = r(n)
+            i += n
+            w('\\x06')
+    finally:
+        micropython.kbd_intr(3)
+    {convert}
+{target} = _mpk_push()
+del _mpk_push
+"""
+
+CONVERT = {
+    BYTES: 'return bytes(b)',
+    BYTEARRAY: 'return b',
+    ARRAY: 'import array\n    return array.array({typecode!r}, b)',
+    LIST: 'import array\n    return list(array.array({typecode!r}, b))',
+}
+
+
+def typecode(kind, itemsize):
+    """Return the array typecode of items of a kind (``i``, ``u`` or ``f``) and size"""
+    codes = {'i': 'bhiq', 'u': 'BHIQ', 'f': '  fd'}[kind]
+    index = {1: 0, 2: 1, 4: 2, 8: 3}.get(itemsize)
+    if index is None or codes[index] == ' ':
+        raise TypeError('No array typecode for {}{} items'.format(kind, itemsize * 8))
+    return codes[index]
+
+
+def item_kind(code):
+    """Return the kind, ``i``, ``u`` or ``f``, of an array typecode's items"""
+    if code in 'fd':
+        return 'f'
+    return 'u' if code.isupper() else 'i'
+
+
+def encode(value):
+    """Return the kind, board typecode and little endian data of a value.
+
+    :raises TypeError: If the value cannot be sent.
+    """
+    if isinstance(value, bytes):
+        return BYTES, 'B', value
+    if isinstance(value, bytearray):
+        return BYTEARRAY, 'B', bytes(value)
+    if numpy is not None and isinstance(value, numpy.ndarray):
+        if value.dtype.kind not in 'iuf':
+            raise TypeError('Cannot send an array of {}'.format(value.dtype))
+        dtype = value.dtype.newbyteorder('<')
+        code = typecode(dtype.kind, dtype.itemsize)
+        return ARRAY, code, numpy.ascontiguousarray(value, dtype=dtype).tobytes()
+    if isinstance(value, array.array):
+        if value.typecode in ('u', 'w'):
+            raise TypeError('Cannot send an array of characters')
+        code = typecode(item_kind(value.typecode), value.itemsize)
+        if struct.pack('=H', 1) != struct.pack('<H', 1):
+            value = array.array(value.typecode, value)
+            value.byteswap()
+        return ARRAY, code, value.tobytes()
+    if isinstance(value, (list, tuple)):
+        if not all(isinstance(x, (int, float)) for x in value):
+            raise TypeError('Only lists of numbers can be sent')
+        if any(isinstance(x, float) for x in value):
+            code = 'd'
+        elif all(-2 ** 31 <= x < 2 ** 31 for x in value):
+            code = 'i'
+        else:
+            code = 'q'
+        return LIST, code, struct.pack('<{}{}'.format(len(value), code), *value)
+    raise TypeError('Cannot send a {}, only bytes, bytearray, arrays and lists '
+                    'of numbers'.format(type(value).__name__))
+
+
+def decode(kind, code, itemsize, data):
+    """Return the host value of data received from the board"""
+    if kind == BYTES:
+        return data
+    if kind == BYTEARRAY:
+        return bytearray(data)
+    item = item_kind(code)
+    if numpy is not None:
+        return numpy.frombuffer(data, dtype='<{}{}'.format(item, itemsize)).copy()
+    values = array.array(typecode(item, itemsize), data)
+    if struct.pack('=H', 1) != struct.pack('<H', 1):
+        values.byteswap()
+    return values.tolist() if kind == LIST else values
+
+
+def describe(value):
+    """Return the type and length of a value, e.g. ``float32[1000]``"""
+    if numpy is not None and isinstance(value, numpy.ndarray):
+        return '{}[{}]'.format(value.dtype, value.size)
+    if isinstance(value, array.array):
+        return "array('{}')[{}]".format(value.typecode, len(value))
+    return '{}[{}]'.format(type(value).__name__, len(value))
+
+
+def pull(transport, expression, timeout=10):
+    """Return the value of an expression on the board and the :class:`Transfer`"""
+    start = time.time()
+    transport.exec_start(PULL_PROGRAM.format(expression=expression), timeout)
+    ready = transport.read_exactly(1, timeout)
+    if ready != READY:
+        transport.unread(ready)
+        raise RemoteError(transport.follow(io.StringIO(), timeout))
+    kind, code, itemsize, size = HEADER.unpack(transport.read_exactly(HEADER.size, timeout))
+    data = transport.read_exactly(size, timeout) if size else b''
+    error = transport.follow(io.StringIO(), timeout)
+    if error:
+        raise RemoteError(error)
+    value = decode(kind, chr(code), itemsize, data)
+    return value, Transfer(expression, describe(value), size, time.time() - start)
+
+
+def push(transport, value, target, chunk_size=4096, window=2, timeout=10):
+    """Assign a host value to ``target`` on the board.
+
+    :return: A :class:`Transfer`.
+    """
+    kind, code, data = encode(value)
+    start = time.time()
+    program = PUSH_PROGRAM.format(size=len(data), target=target,
+                                  convert=CONVERT[kind].format(typecode=code))
+    transport.exec_start(program, timeout)
+    chunks = (data[i:i + chunk_size] for i in range(0, len(data), chunk_size))
+    frames = (struct.pack('<I', len(chunk)) + chunk for chunk in chunks)
+    send_frames(transport, itertools.chain(frames, [struct.pack('<I', 0)]), window, timeout)
+    return Transfer(describe(value), target, len(data), time.time() - start)
@@ -0,0 +1,344 @@
+"""
+webrepl.py
+
+Raw REPL connection to a board over its WebREPL
+
+The WebREPL is a websocket on the board: text frames carry the REPL, as the
+serial link would, and binary frames carry its own file transfer protocol.
+The connection is opened and logged into once and kept for as long as the
+kernel runs, so a cell costs one exchange on an open socket as it does over
+USB, rather than a TCP connection and a password prompt.
+"""
+import os
+import base64
+import socket
+import struct
+import hashlib
+import threading
+
+from urllib.parse import urlsplit
+
+from mpkernel.repl import RemoteError
+from .transport import RingBuffer, Transport, TransportError
+
+CONTINUATION, TEXT, BINARY, CLOSE, PING, PONG = 0, 1, 2, 8, 9, 10
+
+GUID = b'258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+REQUEST = ('GET {path} HTTP/1.1\r\n'
+           'Host: {host}:{port}\r\n'
+           'Upgrade: websocket\r\n'
+           'Connection: Upgrade\r\n'
+           'Sec-WebSocket-Key: {key}\r\n'
+           'Sec-WebSocket-Version: 13\r\n'
+           '\r\n')
+
+# Signature, operation, flags, offset, size, name length and name of a file
+# transfer request, and the signature and status of the board's replies
+FILE_REQUEST = struct.Struct('<2sBBQLH64s')
+FILE_REPLY = struct.Struct('<2sH')
+PUT_FILE, GET_FILE = 1, 2
+
+
+def accept_key(key):
+    """Return the Sec-WebSocket-Accept of a Sec-WebSocket-Key"""
+    if not isinstance(key, bytes):
+        key = key.encode('ascii')
+    return base64.b64encode(hashlib.sha1(key + GUID).digest())
+
+
+def encode_frame(opcode, payload, mask=True):
+    """Return a single frame, masked as a client must send it"""
+    size = len(payload)
+    masked = 0x80 if mask else 0
+    if size < 126:
+        header = struct.pack('!BB', 0x80 | opcode, masked | size)
+    elif size < 65536:
+        header = struct.pack('!BBH', 0x80 | opcode, masked | 126, size)
+    else:
+        header = struct.pack('!BBQ', 0x80 | opcode, masked | 127, size)
+    if not mask:
+        return header + bytes(payload)
+    key = os.urandom(4)
+    return header + key + _mask(key, payload)
+
+
+def _mask(key, payload):
+    size = len(payload)
+    if not size:
+        return b''
+    key = (key * (size // 4 + 1))[:size]
+    return (int.from_bytes(bytes(payload), 'little') ^
+            int.from_bytes(key, 'little')).to_bytes(size, 'little')
+
+
+class FrameParser(object):
+    """
+    Split the bytes received on a websocket into frames
+
+    :meth:`feed` returns the ``(opcode, payload)`` of each complete frame,
+    continuations of a fragmented message taking the opcode of its first.
+    """
+    def __init__(self):
+        self._data = b''
+        self._opcode = TEXT
+
+    def feed(self, data):
+        data = self._data + data
+        frames = []
+        while len(data) >= 2:
+            first, second = bytearray(data[:2])
+            size, start = second & 0x7f, 2
+            if size == 126:
+                if len(data) < 4:
+                    break
+                size, start = struct.unpack('!H', data[2:4])[0], 4
+            elif size == 127:
+                if len(data) < 10:
+                    break
+                size, start = struct.unpack('!Q', data[2:10])[0], 10
+            key = None
+            if second & 0x80:
+                key, start = data[start:start + 4], start + 4
+            if len(data) < start + size:
+                break
+            payload = data[start:start + size]
+            if key is not None:
+                payload = _mask(key, payload)
+            data = data[start + size:]
+            opcode = first & 0x0f
+            if opcode == CONTINUATION:
+                opcode = self._opcode
+            elif opcode < CLOSE:
+                self._opcode = opcode
+            frames.append((opcode, payload))
+        self._data = data
+        return frames
+
+
+def parse_url(url):
+    """Return the host, port, path and password of a ``ws://`` URL, the
+    password being empty unless given as in ``ws://:password@host``"""
+    parts = urlsplit(url)
+    if parts.scheme != 'ws' or not parts.hostname:
+        raise ValueError('Not a ws:// URL: {}'.format(url))
+    return (parts.hostname, parts.port or 8266, parts.path or '/',
+            parts.password or '')
+
+
+class WebReplTransport(Transport):
+    """
+    Raw REPL connection to a board's WebREPL, e.g.
+    ``WebReplTransport('ws://192.168.4.1:8266', 'secret')``
+
+    If the connection drops, the command running fails with a
+    :class:`TransportError`, and the next command reconnects, logs in and
+    enters the raw REPL again before it is sent, so the board's state is
+    kept across a lost connection.
+
+    :param str url: The WebREPL's ``ws://`` URL.
+    :param str password: The WebREPL password, if the URL has none.
+    :param float timeout: Seconds allowed to connect and log in.
+    """
+    binary_files = True
+
+    def __init__(self, url, password='', timeout=5, **kw):
+        super(WebReplTransport, self).__init__(**kw)
+        self.url = url
+        self.host, self.port, self.path, url_password = parse_url(url)
+        self.password = url_password or password
+        self.timeout = timeout
+        # The payloads of the binary frames, the replies to file transfers
+        self.files = RingBuffer()
+        self.reconnects = 0
+        self.sock = None
+        self._frames = None
+        self._send_lock = threading.Lock()
+        self._connected = threading.Event()
+        self.connect()
+        self.start()
+
+    @property
+    def connected(self):
+        return self._connected.is_set()
+
+    def connect(self):
+        """Open the websocket and log in"""
+        try:
+            sock = socket.create_connection((self.host, self.port), self.timeout)
+        except (socket.error, OSError) as e:
+            raise TransportError('Could not connect to {}: {}'.format(self.url, e))
+        try:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            frames = self._login(sock, self._handshake(sock))
+        except (socket.error, OSError) as e:
+            sock.close()
+            raise TransportError('Could not connect to {}: {}'.format(self.url, e))
+        except TransportError:
+            sock.close()
+            raise
+        sock.settimeout(0.05)
+        self.sock = sock
+        self._frames = frames
+        self.error = None
+        self._connected.set()
+
+    def _handshake(self, sock):
+        key = base64.b64encode(os.urandom(16)).decode('ascii')
+        sock.sendall(REQUEST.format(path=self.path, host=self.host, port=self.port,
+                                    key=key).encode('ascii'))
+        response = b''
+        while b'\r\n\r\n' not in response:
+            data = sock.recv(4096)
+            if not data:
+                raise TransportError('{} closed the connection'.format(self.url))
+            response += data
+        head, rest = response.split(b'\r\n\r\n', 1)
+        status = head.split(b'\r\n')[0]
+        if status.split(b' ')[1:2] != [b'101'] or accept_key(key) not in head:
+            raise TransportError('{} is not a websocket: {!r}'.format(self.url, status))
+        return rest
+
+    def _login(self, sock, data):
+        """Answer the password prompt, returning the parser of the frames
+        that follow"""
+        frames = FrameParser()
+        text = b''
+        password_sent = False
+        while True:
+            for opcode, payload in frames.feed(data):
+                if opcode == CLOSE:
+                    raise TransportError('{} closed the connection'.format(self.url))
+                if opcode == TEXT:
+                    text += payload
+            if not password_sent and b'Password:' in text:
+                sock.sendall(encode_frame(TEXT, self.password.encode('utf-8') + b'\r'))
+                password_sent = True
+                text = b''
+            elif b'WebREPL connected' in text:
+                return frames
+            elif b'Access denied' in text:
+                raise TransportError('The WebREPL password of {} was refused'.format(self.url))
+            data = sock.recv(4096)
+            if not data:
+                raise TransportError('{} closed the connection'.format(self.url))
+
+    def _lost(self, reason):
+        if self.connected:
+            self.error = reason
+            self._connected.clear()
+            self.sock.close()
+
+    def _read_chunk(self):
+        if not self._connected.wait(0.05):
+            return b''
+        try:
+            data = self.sock.recv(65536)
+        except socket.timeout:
+            return b''
+        except (socket.error, OSError) as e:
+            self._lost(e)
+            return b''
+        if not data:
+            self._lost('closed by the board')
+            return b''
+        text = []
+        for opcode, payload in self._frames.feed(data):
+            if opcode == TEXT:
+                text.append(payload)
+            elif opcode == BINARY:
+                self.files.write(payload)
+            elif opcode == PING:
+                self._send(payload, PONG)
+            elif opcode == CLOSE:
+                self._lost('closed by the board')
+        return b''.join(text)
+
+    def _send(self, payload, opcode):
+        with self._send_lock:
+            if not self.connected:
+                raise TransportError('Connection to {} lost: {}'.format(self.url, self.error))
+            try:
+                self.sock.sendall(encode_frame(opcode, payload))
+            except (socket.error, OSError) as e:
+                self._lost(e)
+                raise TransportError('Connection to {} lost: {}'.format(self.url, e))
+
+    def _write(self, data):
+        self._send(data, TEXT)
+
+    def read(self, size=4096, timeout=None):
+        if not self.connected and not self._pushback and not len(self.buffer):
+            raise TransportError('Connection to {} lost: {}'.format(self.url, self.error))
+        return super(WebReplTransport, self).read(size, timeout)
+
+    def enter_raw_repl(self, soft_reset=False, timeout=5):
+        if not self.connected:
+            self.connect()
+            self.reconnects += 1
+        super(WebReplTransport, self).enter_raw_repl(soft_reset, timeout)
+
+    def exit_raw_repl(self):
+        if self.connected:
+            super(WebReplTransport, self).exit_raw_repl()
+
+    def exec_start(self, command, timeout=5):
+        if not self.connected:
+            self.enter_raw_repl(timeout=timeout)
+        super(WebReplTransport, self).exec_start(command, timeout)
+
+    def _file_request(self, operation, path, size, timeout):
+        if not self.connected:
+            self.enter_raw_repl(timeout=timeout)
+        name = path.encode('utf-8')
+        if len(name) > 64:
+            raise TransportError('WebREPL file names are at most 64 bytes: {}'.format(path))
+        self._send(FILE_REQUEST.pack(b'WA', operation, 0, 0, size, len(name), name), BINARY)
+        self._file_reply(path, timeout)
+
+    def _file_reply(self, path, timeout):
+        signature, status = FILE_REPLY.unpack(self._read_file(FILE_REPLY.size, timeout))
+        if signature != b'WB':
+            raise TransportError('Unexpected WebREPL file reply {!r}'.format(signature))
+        if status:
+            raise RemoteError('OSError: [Errno {}] {}'.format(status, path))
+
+    def _read_file(self, size, timeout):
+        data = b''
+        while len(data) < size:
+            chunk = self.files.read(size - len(data), timeout)
+            if not chunk:
+                raise TransportError('Timed out reading a WebREPL file reply')
+            data += chunk
+        return data
+
+    def put_file(self, f, path, size, chunk_size=1024, timeout=10):
+        """Write ``size`` bytes of file ``f`` to ``path`` on the board in
+        binary frames"""
+        self._file_request(PUT_FILE, path, size, timeout)
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            self._send(chunk, BINARY)
+        self._file_reply(path, timeout)
+
+    def get_file(self, path, f, timeout=10):
+        """Write the file at ``path`` on the board to file ``f``, returning
+        its size"""
+        self._file_request(GET_FILE, path, 0, timeout)
+        size = 0
+        while True:
+            self._send(b'\0', BINARY)
+            n = struct.unpack('<H', self._read_file(2, timeout))[0]
+            if not n:
+                break
+            f.write(self._read_file(n, timeout))
+            size += n
+        self._file_reply(path, timeout)
+        return size
+
+    def close(self):
+        super(WebReplTransport, self).close()
+        self.files.close()
+        self._reader.join(1)
+        if self.sock is not None:
+            self.sock.close()
+        self._connected.clear()
@@ -0,0 +1,413 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+fake_micropython
+----------------------------------
+
+A stand-in for the micropython REPL, for the tests and benchmarks to run
+without a micropython build or a board. It speaks the normal ``>>> `` prompt,
+the raw REPL (Ctrl-A) and its raw-paste mode, runs what it is sent with
+CPython, and can add latency to every reply and limit the link to a baud
+rate. Ctrl-C interrupts a running command and ``micropython.kbd_intr``
+changes or disables the interrupt character, as on a real port. The heap
+that ``gc.mem_alloc``, ``gc.mem_free`` and ``micropython.mem_info`` report
+is what CPython has allocated, traced from their first call, out of
+``HEAP_BYTES`` or the size given with ``-X heapsize``, and ``time`` has the
+``ticks_*`` functions of the ports.
+
+    $ python tests/fake_micropython.py --latency 0.001
+"""
+import gc
+import os
+import sys
+import time
+import tty
+import types
+import codeop
+import signal
+import struct
+import argparse
+import threading
+import traceback
+import tracemalloc
+
+RAW_BANNER = b'raw REPL; CTRL-B to exit\r\n>'
+UNIX_BANNER = (b'MicroPython v1.99 on 2026-01-01; fake unix port with CPython\r\n'
+               b'Use Ctrl-D to exit, Ctrl-E for paste mode\r\n')
+BOARD_BANNER = (b'MicroPython v1.99 on 2026-01-01; fake pyboard with CPython\r\n'
+                b'Type "help()" for more information.\r\n')
+
+HEAP_BYTES = 64 * 1024 * 1024
+
+# time.ticks_ms and ticks_us wrap around at 2**30, as on the ports
+TICKS_MASK = (1 << 30) - 1
+
+
+def ticks_diff(end, start):
+    return ((end - start + (1 << 29)) & TICKS_MASK) - (1 << 29)
+
+
+class _Stdout(object):
+    """``sys.stdout`` of the commands run, in a terminal's line endings"""
+    def __init__(self, repl):
+        self.repl = repl
+        self.buffer = _StdoutBuffer(repl)
+
+    def write(self, text):
+        self.repl.send(text.replace('\n', '\r\n').encode('utf-8', 'surrogateescape'))
+        return len(text)
+
+    def flush(self):
+        pass
+
+
+class _StdoutBuffer(object):
+    def __init__(self, repl):
+        self.repl = repl
+
+    def write(self, data):
+        self.repl.send(bytes(data))
+        return len(data)
+
+
+class _Stdin(object):
+    """``sys.stdin`` of the commands run, reading the bytes received"""
+    def __init__(self, repl):
+        self.repl = repl
+        self.buffer = self
+
+    def read(self, n=1):
+        return self.repl.recv(n)
+
+    def readinto(self, buf):
+        data = self.repl.recv(len(buf))
+        buf[:len(data)] = data
+        return len(data)
+
+
+class FakeRepl(object):
+    """
+    The REPL of a micropython unix port or board, run by CPython
+
+    The received bytes are collected by a background thread, which also
+    picks out the interrupt character while a command runs; commands run on
+    the main thread, which must call :meth:`run`.
+
+    :param read: Returns the next bytes received, or ``b''`` at the end.
+    :param write: Sends bytes.
+    :param float latency: Seconds added before each reply.
+    :param int baudrate: Bits per second the link is limited to in each
+      direction, 0 for no limit.
+    :param bool board: Behave like a board, where Ctrl-D at the prompt soft
+      reboots, rather than the unix port, where it exits.
+    :param bool raw: Support the raw REPL; without it Ctrl-A is ignored.
+    :param bool raw_paste: Support raw-paste mode.
+    :param int window: Raw-paste flow control window in bytes.
+    :param int heap_bytes: Size of the heap reported.
+    """
+    def __init__(self, read, write, latency=0.0, baudrate=0, board=False,
+                 raw=True, raw_paste=True, window=128, heap_bytes=HEAP_BYTES):
+        self._read = read
+        self._write = write
+        self.latency = latency
+        self.baudrate = baudrate
+        self.board = board
+        self.raw = raw
+        self.raw_paste = raw_paste
+        self.window = window
+        self.heap_bytes = heap_bytes
+        self.intr_char = 3
+        self.running = False
+        self._input = bytearray()
+        self._eof = False
+        self._cond = threading.Condition()
+        self.main = types.ModuleType('__main__')
+        self.micropython = types.ModuleType('micropython')
+        self.micropython.kbd_intr = self.kbd_intr
+        self.micropython.const = lambda value: value
+        self.micropython.mem_info = self.mem_info
+        self.gc = types.ModuleType('gc')
+        self.gc.__dict__.update(gc.__dict__)
+        self.gc.mem_alloc = self.mem_alloc
+        self.gc.mem_free = lambda: self.heap_bytes - self.mem_alloc()
+        self.time = types.ModuleType('time')
+        self.time.__dict__.update(time.__dict__)
+        self.time.ticks_us = lambda: int(time.perf_counter() * 1e6) & TICKS_MASK
+        self.time.ticks_ms = lambda: int(time.perf_counter() * 1e3) & TICKS_MASK
+        self.time.ticks_diff = ticks_diff
+        self.time.sleep_ms = lambda ms: time.sleep(ms / 1e3)
+        self.time.sleep_us = lambda us: time.sleep(us / 1e6)
+
+    def mem_alloc(self):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        return tracemalloc.get_traced_memory()[0]
+
+    def mem_info(self):
+        used = self.mem_alloc()
+        print('GC: total: {}, used: {}, free: {}'.format(
+            self.heap_bytes, used, self.heap_bytes - used))
+        # In blocks of four words, with no fragmentation
+        print(' No. of 1-blocks: 0, 2-blocks: 0, max blk sz: 0, max free sz: {}'.format(
+            (self.heap_bytes - used) // (4 * struct.calcsize('P'))))
+
+    def kbd_intr(self, char):
+        self.intr_char = char
+
+    def send(self, data):
+        """Send bytes at the link's rate"""
+        step = max(self.baudrate // 640, 1) if self.baudrate else len(data) or 1
+        for i in range(0, len(data), step):
+            chunk = data[i:i + step]
+            if self.baudrate:
+                time.sleep(len(chunk) * 10.0 / self.baudrate)
+            while chunk:
+                chunk = chunk[self._write(chunk):]
+
+    def recv(self, n):
+        """Return the next ``n`` bytes received, fewer at the end"""
+        with self._cond:
+            while len(self._input) < n and not self._eof:
+                self._cond.wait(0.1)
+            data = bytes(self._input[:n])
+            del self._input[:n]
+            return data
+
+    def getc(self):
+        """Return the next byte received, or None at the end"""
+        data = self.recv(1)
+        return data[0:1] or None
+
+    def _receive(self):
+        while True:
+            try:
+                data = self._read()
+            except OSError:
+                data = b''
+            if self.baudrate and data:
+                time.sleep(len(data) * 10.0 / self.baudrate)
+            with self._cond:
+                self._eof = not data
+                intr = bytearray([self.intr_char]) if self.intr_char >= 0 else None
+                if self.running and intr and intr in data:
+                    data = data.replace(intr, b'')
+                    os.kill(os.getpid(), signal.SIGINT)
+                self._input += data
+                self._cond.notify_all()
+                if self._eof:
+                    return
+
+    def _sigint(self, signum, frame):
+        # A late interrupt, once the command finished, is dropped
+        if self.running:
+            raise KeyboardInterrupt()
+
+    def _exec(self, source, mode='exec', ack=b''):
+        """Run a command, returning its traceback or ''.
+
+        :param ack: Sent once an interrupt would stop the command.
+        """
+        saved = sys.stdout, sys.stdin
+        sys.stdout, sys.stdin = _Stdout(self), _Stdin(self)
+        try:
+            try:
+                self.running = True
+                self.send(ack)
+                exec(compile(source, '<stdin>', mode), self.main.__dict__)
+            finally:
+                self.running = False
+                sys.stdout, sys.stdin = saved
+        except SystemExit:
+            if not self.board:
+                raise
+            return ''
+        except BaseException:
+            etype, value, tb = sys.exc_info()
+            lines = traceback.format_exception(etype, value, tb.tb_next)
+            return ''.join(lines)
+        return ''
+
+    def soft_reboot(self):
+        self.main.__dict__.clear()
+        self.main.__dict__['__name__'] = '__main__'
+        self.intr_char = 3
+
+    def run(self):
+        """Serve the REPL until the input ends, or the unix port exits"""
+        sys.modules['__main__'] = self.main
+        sys.modules['micropython'] = self.micropython
+        sys.modules['gc'] = self.gc
+        sys.modules['time'] = self.time
+        signal.signal(signal.SIGINT, self._sigint)
+        reader = threading.Thread(target=self._receive)
+        reader.daemon = True
+        reader.start()
+        self.soft_reboot()
+        try:
+            self.friendly_repl()
+        except SystemExit:
+            pass
+
+    def friendly_repl(self):
+        self.send((BOARD_BANNER if self.board else UNIX_BANNER) + b'>>> ')
+        source = line = b''
+        last = None
+        while True:
+            c = self.getc()
+            if c is None:
+                return
+            if c == b'\n' and last == b'\r':
+                last = None
+                continue
+            last = c
+            if c == b'\x01' and self.raw:
+                if not self.raw_repl():
+                    return
+                self.send((BOARD_BANNER if self.board else UNIX_BANNER) + b'>>> ')
+                source = line = b''
+            elif c == b'\x02':
+                self.send(b'\r\n' + (BOARD_BANNER if self.board else UNIX_BANNER) + b'>>> ')
+            elif c == b'\x03':
+                source = line = b''
+                self.send(b'\r\n>>> ')
+            elif c == b'\x04' and not source and not line:
+                self.send(b'\r\n')
+                if not self.board:
+                    return
+                self.soft_reboot()
+                self.send(b'MPY: soft reboot\r\n' + BOARD_BANNER + b'>>> ')
+            elif c in b'\r\n':
+                self.send(b'\r\n')
+                source += line + b'\n'
+                line = b''
+                text = source.decode('utf-8', 'surrogateescape')
+                try:
+                    incomplete = codeop.compile_command(text, '<stdin>', 'single') is None
+                except SyntaxError:
+                    incomplete = False
+                if incomplete and text.strip():
+                    self.send(b'... ')
+                    continue
+                if text.strip():
+                    time.sleep(self.latency)
+                    self.send(self._exec(text, 'single').replace('\n', '\r\n').encode('utf-8'))
+                source = b''
+                self.send(b'>>> ')
+            elif c in (b'\x08', b'\x7f'):
+                if line:
+                    line = line[:-1]
+                    self.send(b'\x08 \x08')
+            elif c >= b' ' or c == b'\t':
+                line += c
+                self.send(c)
+
+    def raw_repl(self):
+        """Serve the raw REPL until Ctrl-B, return False at the end of the input"""
+        self.send(RAW_BANNER)
+        command = bytearray()
+        while True:
+            c = self.getc()
+            if c is None:
+                return False
+            if c == b'\x01':
+                command = bytearray()
+                self.send(b'\r\n' + RAW_BANNER)
+            elif c == b'\x02':
+                self.send(b'\r\n')
+                return True
+            elif c == b'\x03':
+                command = bytearray()
+            elif c == b'\x05' and not command and self.raw_paste:
+                if self.recv(2) != b'A\x01':
+                    continue
+                self.send(b'R\x01' + struct.pack('<H', self.window))
+                source = self.paste()
+                if source is None:
+                    return False
+                time.sleep(self.latency)
+                self.reply(source, b'\x04')
+            elif c == b'\x04':
+                if not command:
+                    self.soft_reboot()
+                    self.send(b'OK\r\nMPY: soft reboot\r\n' + RAW_BANNER)
+                    continue
+                time.sleep(self.latency)
+                self.reply(bytes(command), b'OK')
+                command = bytearray()
+            else:
+                command += c
+
+    def paste(self):
+        """Read a raw-paste command up to its Ctrl-D, acknowledging each window"""
+        source = bytearray()
+        received = 0
+        while True:
+            c = self.getc()
+            if c is None:
+                return None
+            if c == b'\x04':
+                return bytes(source)
+            source += c
+            received += 1
+            if received == self.window:
+                received = 0
+                self.send(b'\x01')
+
+    def reply(self, source, ack):
+        error = self._exec(source.decode('utf-8', 'surrogateescape'), ack=ack)
+        self.send(b'\x04' + error.replace('\n', '\r\n').encode('utf-8') + b'\x04>')
+
+
+def command(latency=0.0, baudrate=0, raw=True, raw_paste=True):
+    """Return the command line starting this stand-in, e.g. as the unix
+    kernel's ``micropython_exe``"""
+    args = [sys.executable, os.path.abspath(__file__).replace('.pyc', '.py')]
+    if latency:
+        args += ['--latency', repr(latency)]
+    if baudrate:
+        args += ['--baudrate', str(baudrate)]
+    if not raw:
+        args.append('--no-raw')
+    if not raw_paste:
+        args.append('--no-raw-paste')
+    return ' '.join(args)
+
+
+def parser(description):
+    p = argparse.ArgumentParser(description=description)
+    p.add_argument('--latency', type=float, default=0.0,
+                   help='seconds added before each reply')
+    p.add_argument('--baudrate', type=int, default=0,
+                   help='bits per second the link is limited to, 0 for no limit')
+    p.add_argument('--no-raw', dest='raw', action='store_false',
+                   help='no raw REPL, as in old micropython versions')
+    p.add_argument('--no-raw-paste', dest='raw_paste', action='store_false',
+                   help='no raw-paste mode')
+    p.add_argument('-X', dest='options', action='append', default=[],
+                   help='implementation options, of which heapsize=<n>[K|M] is used')
+    return p
+
+
+def heap_bytes(options):
+    """Return the heap size given by ``-X heapsize``, as micropython parses it"""
+    for option in options:
+        name, _, value = option.partition('=')
+        if name == 'heapsize':
+            scale = {'k': 1024, 'm': 1024 * 1024}.get(value[-1:].lower(), 1)
+            return int(value.rstrip('kKmM')) * scale
+    return HEAP_BYTES
+
+
+def main():
+    args = parser('A stand-in for the micropython unix port REPL').parse_args()
+    if os.isatty(0):
+        tty.setraw(0)
+    repl = FakeRepl(lambda: os.read(0, 4096), lambda data: os.write(1, data),
+                    latency=args.latency, baudrate=args.baudrate,
+                    raw=args.raw, raw_paste=args.raw_paste, heap_bytes=heap_bytes(args.options))
+    repl.run()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+fake_pyboard
+----------------------------------
+
+A fake pyboard on a pseudo terminal, for the tests and benchmarks of the
+serial transport. It prints the device path to open, then runs the
+:class:`~fake_micropython.FakeRepl` of a board on it until it is killed.
+
+    $ python tests/fake_pyboard.py --baudrate 115200 --latency 0.002
+    /dev/pts/3
+"""
+from __future__ import print_function
+import os
+import sys
+import pty
+import tty
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_micropython import FakeRepl, parser  # noqa: E402
+
+
+class FakePyboard(object):
+    """
+    Run a fake pyboard in a subprocess, e.g.
+    ``with FakePyboard(baudrate=115200) as board: SerialTransport(board.device)``
+
+    :param float latency: Seconds added before each reply.
+    :param int baudrate: Bits per second the link is limited to, 0 for no
+      limit; the pseudo terminal ignores the rate set on it.
+    """
+    def __init__(self, latency=0.0, baudrate=0, raw_paste=True):
+        self.latency = latency
+        self.baudrate = baudrate
+        self.raw_paste = raw_paste
+        self.process = None
+        self.device = None
+
+    def start(self):
+        args = [sys.executable, os.path.abspath(__file__).replace('.pyc', '.py'),
+                '--latency', repr(self.latency), '--baudrate', str(self.baudrate)]
+        if not self.raw_paste:
+            args.append('--no-raw-paste')
+        self.process = subprocess.Popen(args, stdout=subprocess.PIPE)
+        self.device = self.process.stdout.readline().decode('ascii').strip()
+        if not self.device:
+            self.stop()
+            raise RuntimeError('The fake pyboard did not start')
+        return self
+
+    def stop(self):
+        if self.process is not None:
+            self.process.kill()
+            self.process.wait()
+            self.process.stdout.close()
+            self.process = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def main():
+    args = parser('A fake pyboard on a pseudo terminal').parse_args()
+    master, slave = pty.openpty()
+    tty.setraw(slave)
+    # The slave end is kept open so that reads do not fail once the host
+    # closes the device, which it may open again later
+    print(os.ttyname(slave))
+    sys.stdout.flush()
+    repl = FakeRepl(lambda: os.read(master, 4096), lambda data: os.write(master, data),
+                    latency=args.latency, baudrate=args.baudrate, board=True,
+                    raw=args.raw, raw_paste=args.raw_paste)
+    repl.run()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,251 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+fake_webrepl
+----------------------------------
+
+A fake board's WebREPL on a local port, for the tests and benchmarks of the
+WebREPL transport. It prints the URL to connect to, then runs the
+:class:`~fake_micropython.FakeRepl` of a board for whichever client last
+logged in, until it is killed. The REPL outlives its clients, so a client
+that reconnects finds the board as it left it. File transfers in binary
+frames are served from the working directory.
+
+    $ python tests/fake_webrepl.py --password secret --latency 0.002
+    ws://127.0.0.1:40123/
+"""
+from __future__ import print_function
+import os
+import sys
+import socket
+import struct
+import threading
+import subprocess
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, os.pardir))
+
+from fake_micropython import FakeRepl, parser  # noqa: E402
+from stmhal.webrepl import (  # noqa: E402
+    BINARY, CLOSE, FILE_REPLY, FILE_REQUEST, GET_FILE, PING, PONG, PUT_FILE, TEXT,
+    FrameParser, accept_key, encode_frame)
+
+
+class FakeWebRepl(object):
+    """
+    Run a fake WebREPL in a subprocess, e.g.
+    ``with FakeWebRepl(password='secret') as board: WebReplTransport(board.url, 'secret')``
+
+    :param float latency: Seconds added before each reply.
+    :param int baudrate: Bits per second the REPL's output is limited to, 0
+      for no limit.
+    """
+    def __init__(self, password='', latency=0.0, baudrate=0):
+        self.password = password
+        self.latency = latency
+        self.baudrate = baudrate
+        self.process = None
+        self.url = None
+
+    def start(self):
+        args = [sys.executable, os.path.abspath(__file__).replace('.pyc', '.py'),
+                '--password', self.password, '--latency', repr(self.latency),
+                '--baudrate', str(self.baudrate)]
+        self.process = subprocess.Popen(args, stdout=subprocess.PIPE)
+        self.url = self.process.stdout.readline().decode('ascii').strip()
+        if not self.url:
+            self.stop()
+            raise RuntimeError('The fake WebREPL did not start')
+        return self
+
+    def stop(self):
+        if self.process is not None:
+            self.process.kill()
+            self.process.wait()
+            self.process.stdout.close()
+            self.process = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+class Client(object):
+    """A logged in connection, and the file transfer it is making"""
+    def __init__(self, sock, frames):
+        self.sock = sock
+        self.frames = frames
+        self.lock = threading.Lock()
+        self.pending = b''
+        self.file = None
+        self.operation = None
+        self.remaining = 0
+
+    def send(self, payload, opcode=TEXT):
+        with self.lock:
+            try:
+                self.sock.sendall(encode_frame(opcode, payload, mask=False))
+            except (socket.error, OSError):
+                pass
+
+    def reply(self, status):
+        self.send(FILE_REPLY.pack(b'WB', status), BINARY)
+
+    def transfer(self, payload):
+        """Serve the file transfer protocol of the binary frames"""
+        self.pending += payload
+        while True:
+            if self.operation == PUT_FILE:
+                data = self.pending[:self.remaining]
+                self.pending = self.pending[len(data):]
+                self.file.write(data)
+                self.remaining -= len(data)
+                if self.remaining:
+                    return
+                self.file.close()
+                self.operation = None
+                self.reply(0)
+            elif self.operation == GET_FILE:
+                if not self.pending:
+                    return
+                self.pending = self.pending[1:]
+                data = self.file.read(1024)
+                self.send(struct.pack('<H', len(data)) + data, BINARY)
+                if not data:
+                    self.file.close()
+                    self.operation = None
+                    self.reply(0)
+            elif len(self.pending) >= FILE_REQUEST.size:
+                request = FILE_REQUEST.unpack(self.pending[:FILE_REQUEST.size])
+                self.pending = self.pending[FILE_REQUEST.size:]
+                _, operation, _, _, size, length, name = request
+                try:
+                    self.file = open(name[:length].decode('utf-8'),
+                                     'wb' if operation == PUT_FILE else 'rb')
+                except (IOError, OSError) as e:
+                    self.reply(e.errno or 1)
+                    continue
+                self.operation, self.remaining = operation, size
+                self.reply(0)
+            else:
+                return
+
+
+class WebReplServer(object):
+    """
+    Serve a REPL to one logged in websocket client at a time
+
+    :meth:`read` and :meth:`write` are the REPL's link, the text frames of
+    the current client; a client that logs in replaces the previous one.
+    """
+    def __init__(self, sock, password):
+        self.sock = sock
+        self.password = password.encode('utf-8')
+        self.client = None
+        self._cond = threading.Condition()
+
+    def serve(self):
+        while True:
+            conn, _ = self.sock.accept()
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            threading.Thread(target=self._login, args=(conn,)).start()
+
+    def _login(self, conn):
+        try:
+            request = b''
+            while b'\r\n\r\n' not in request:
+                data = conn.recv(4096)
+                if not data:
+                    conn.close()
+                    return
+                request += data
+            key = [line.split(b':', 1)[1].strip() for line in request.split(b'\r\n')
+                   if line.lower().startswith(b'sec-websocket-key:')][0]
+            conn.sendall(b'HTTP/1.1 101 Switching Protocols\r\n'
+                         b'Upgrade: websocket\r\nConnection: Upgrade\r\n'
+                         b'Sec-WebSocket-Accept: ' + accept_key(key) + b'\r\n\r\n')
+            conn.sendall(encode_frame(TEXT, b'Password: ', mask=False))
+            frames = FrameParser()
+            password = b''
+            while not password.endswith(b'\r'):
+                data = conn.recv(4096)
+                if not data:
+                    conn.close()
+                    return
+                password += b''.join(p for _, p in frames.feed(data))
+            if password[:-1] != self.password:
+                conn.sendall(encode_frame(TEXT, b'\r\nAccess denied\r\n', mask=False))
+                conn.close()
+                return
+            conn.sendall(encode_frame(TEXT, b'\r\nWebREPL connected\r\n>>> ', mask=False))
+        except (socket.error, OSError):
+            conn.close()
+            return
+        with self._cond:
+            if self.client is not None:
+                self.client.sock.close()
+            self.client = Client(conn, frames)
+            self._cond.notify_all()
+
+    def read(self):
+        while True:
+            with self._cond:
+                while self.client is None:
+                    self._cond.wait()
+                client = self.client
+            try:
+                data = client.sock.recv(65536)
+            except (socket.error, OSError):
+                data = b''
+            text = []
+            for opcode, payload in client.frames.feed(data):
+                if opcode == TEXT:
+                    text.append(payload)
+                elif opcode == BINARY:
+                    client.transfer(payload)
+                elif opcode == PING:
+                    client.send(payload, PONG)
+                elif opcode == CLOSE:
+                    data = b''
+            if not data:
+                with self._cond:
+                    if self.client is client:
+                        self.client = None
+                client.sock.close()
+            if text:
+                return b''.join(text)
+
+    def write(self, data):
+        client = self.client
+        if client is not None:
+            client.send(data)
+        return len(data)
+
+
+def main():
+    p = parser('A fake board WebREPL on a local port')
+    p.add_argument('--password', default='', help='the WebREPL password')
+    p.add_argument('--port', type=int, default=0, help='port to listen on, 0 for any')
+    args = p.parse_args()
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(('127.0.0.1', args.port))
+    sock.listen(4)
+    print('ws://127.0.0.1:{}/'.format(sock.getsockname()[1]))
+    sys.stdout.flush()
+    server = WebReplServer(sock, args.password)
+    thread = threading.Thread(target=server.serve)
+    thread.daemon = True
+    thread.start()
+    repl = FakeRepl(server.read, server.write, latency=args.latency,
+                    baudrate=args.baudrate, board=True, raw=args.raw,
+                    raw_paste=args.raw_paste)
+    repl.run()
+
+
+if __name__ == '__main__':
+    main()
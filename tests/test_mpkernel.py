@@ -0,0 +1,767 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_mpkernel
+----------------------------------
+
+Tests for `mpkernel` module.
+"""
+
+import io
+import os
+import struct
+import binascii
+import sys
+import contextlib
+import shutil
+import tempfile
+import time
+import types
+import unittest
+
+from datetime import datetime, timedelta
+
+from mpkernel import capture, heap, mprof, mpy, parallel, timeit
+from mpkernel.complete import NamespaceCache, token_before
+from mpkernel.metrics import CellTimer, Histogram, Metrics, seconds_since
+from mpkernel.parallel import ParallelRun, parallel_args, parse_inputs
+from mpkernel.pipeline import CellReader, Pipeline
+from mpkernel.magics import MagicError, MagicParser, split_magic
+from mpkernel.repl import (OutputLimit, OutputStream, RawReplReader, fix_traceback,
+                           split_exception)
+from mpkernel.replay import CellLog
+from mpkernel.startup import background
+
+
+class TestRawReplReader(unittest.TestCase):
+
+    def setUp(self):
+        self.reader = RawReplReader()
+
+    def test_output_and_error(self):
+        out = self.reader.feed(u'hi\r\n\x04Traceback\r\nNameError\x04>')
+        self.assertEqual(out, u'hi\r\n')
+        self.assertEqual(self.reader.error, u'Traceback\r\nNameError')
+        self.assertTrue(self.reader.done)
+
+    def test_split_reads(self):
+        out = u''
+        for chunk in (u'a', u'b\x04', u'\x04', u'>'):
+            self.assertFalse(self.reader.done)
+            out += self.reader.feed(chunk)
+        self.assertEqual(out, u'ab')
+        self.assertEqual(self.reader.error, u'')
+        self.assertTrue(self.reader.done)
+
+    def test_bytes(self):
+        reader = RawReplReader(empty=b'')
+        self.assertEqual(reader.feed(b'x\x04E\x04>'), b'x')
+        self.assertEqual(reader.error, b'E')
+        self.assertTrue(reader.done)
+
+
+class TestSplitException(unittest.TestCase):
+
+    def test_split(self):
+        ename, evalue, traceback = split_exception(
+            u'Traceback (most recent call last):\r\n  File "<stdin>", line 1\r\n'
+            u'NameError: name \'x\' isn\'t defined\r\n')
+        self.assertEqual(ename, u'NameError')
+        self.assertEqual(evalue, u"name 'x' isn't defined")
+        self.assertEqual(len(traceback), 3)
+
+
+class TestOutputStream(unittest.TestCase):
+
+    def setUp(self):
+        self.sent = []
+
+    def test_coalesces_until_flush(self):
+        stream = OutputStream(self.sent.append, interval=60, max_bytes=100)
+        stream.write(u'a')
+        stream.write(u'b')
+        self.assertEqual(self.sent, [])
+        stream.flush()
+        self.assertEqual(self.sent, [u'ab'])
+
+    def test_size_budget(self):
+        stream = OutputStream(self.sent.append, interval=60, max_bytes=4)
+        stream.write(u'ab')
+        stream.write(u'cd')
+        stream.write(u'e')
+        self.assertEqual(self.sent, [u'abcd'])
+
+    def test_time_budget(self):
+        stream = OutputStream(self.sent.append, interval=0, max_bytes=100)
+        stream.write(u'a')
+        self.assertEqual(self.sent, [u'a'])
+
+
+class TestOutputLimit(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.path = os.path.join(self.tmp, 'logs', 'cell.log')
+        self.sent = []
+        self.displays = []
+
+    def limit(self, **kwargs):
+        return OutputLimit(self.sent.append,
+                           lambda bundle, update: self.displays.append((bundle, update)),
+                           self.path, **kwargs)
+
+    def test_under_the_limit(self):
+        limit = self.limit(head_bytes=10)
+        limit.write(u'abc')
+        limit.write(u'defghij')
+        limit.close()
+        self.assertEqual(self.sent, [u'abc', u'defghij'])
+        self.assertEqual(self.displays, [])
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_spills_to_log(self):
+        limit = self.limit(head_bytes=4, tail_bytes=6, interval=60)
+        limit.write(u'1\n2\n3\n')
+        limit.write(u'4\n5\n6\n7\n')
+        limit.close()
+        self.assertEqual(self.sent, [u'1\n2\n'])
+        with open(self.path) as f:
+            self.assertEqual(f.read(), u'1\n2\n3\n4\n5\n6\n7\n')
+        # Shown on overflow, then updated with the final tail
+        self.assertEqual([update for _, update in self.displays], [False, True])
+        bundle = self.displays[-1][0]
+        self.assertTrue(bundle['text/plain'].startswith(
+            u'[4 characters not shown, the full output is in {}]\n'.format(self.path)))
+        self.assertTrue(bundle['text/plain'].endswith(u'\n5\n6\n7\n'))
+        self.assertIn(u'<a href=', bundle['text/html'])
+
+    def test_not_live(self):
+        limit = self.limit(head_bytes=4, tail_bytes=4, live=False)
+        limit.write(u'ab')
+        limit.write(u'cdefgh')
+        self.assertEqual((self.sent, self.displays), ([], []))
+        limit.close()
+        self.assertEqual(self.sent, [u'abcd'])
+        self.assertEqual(len(self.displays), 1)
+
+    def test_no_limit(self):
+        limit = self.limit(head_bytes=0)
+        limit.write(u'x' * 100000)
+        limit.close()
+        self.assertEqual(len(self.sent[0]), 100000)
+
+
+class TestMagics(unittest.TestCase):
+
+    def test_line_magic(self):
+        self.assertEqual(split_magic(u'  %put -z a.py\n'), (u'put', u'-z a.py', u''))
+
+    def test_cell_magic(self):
+        self.assertEqual(split_magic(u'%%time  \nx = 1\ny = 2'),
+                         (u'time', u'', u'x = 1\ny = 2'))
+
+    def test_not_magic(self):
+        self.assertIsNone(split_magic(u'x = 1 % 2'))
+        self.assertRaises(MagicError, split_magic, u'%put a\nx = 1')
+
+    def test_parser_raises(self):
+        parser = MagicParser('get')
+        parser.add_argument('src')
+        self.assertEqual(parser.parse(u'"a b.txt"').src, u'a b.txt')
+        self.assertRaises(MagicError, parser.parse, u'')
+
+
+# Stands in for mpy-cross: copies the source after checking its syntax
+FAKE_MPY_CROSS = """\
+import sys, shutil
+args = sys.argv[1:]
+try:
+    compile(open(args[-1]).read(), args[-1], 'exec')
+except SyntaxError as e:
+    print('  File "%s", line %d' % (args[-1], e.lineno))
+    print('SyntaxError: invalid syntax')
+    sys.exit(1)
+shutil.copy(args[-1], args[args.index('-o') + 1])
+"""
+
+
+class TestMpyCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        script = os.path.join(self.tmp, 'mpy_cross.py')
+        with open(script, 'w') as f:
+            f.write(FAKE_MPY_CROSS)
+        self.cache = mpy.MpyCache(os.path.join(self.tmp, 'cache'), max_bytes=100,
+                                  mpy_cross='{} {}'.format(sys.executable, script))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_hit(self):
+        path = self.cache.compile(u'x = 1\n')
+        self.assertEqual(self.cache.compile(u'x = 1\n'), path)
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+        self.assertTrue(os.path.basename(path).startswith('mpk_'))
+        self.assertEqual(os.listdir(self.cache.directory), [os.path.basename(path)])
+
+    def test_evicts_least_recently_used(self):
+        first = self.cache.compile(u'a = "{}"\n'.format('a' * 30))
+        second = self.cache.compile(u'b = "{}"\n'.format('b' * 30))
+        os.utime(first, (0, 0))
+        os.utime(second, (1, 1))
+        self.cache.compile(u'a = "{}"\n'.format('a' * 30))
+        third = self.cache.compile(u'c = "{}"\n'.format('c' * 30))
+        self.assertTrue(os.path.exists(first))
+        self.assertFalse(os.path.exists(second))
+        self.assertTrue(os.path.exists(third))
+
+    def test_syntax_error(self):
+        with self.assertRaises(mpy.MpyCrossError) as cm:
+            self.cache.compile(mpy.cell_source(u'x = 1\ndef f(:\n'))
+        error = mpy.fix_line_numbers(str(cm.exception))
+        self.assertIn(u'File "cell", line 2', error)
+
+    def test_loader(self):
+        path = self.cache.compile(mpy.cell_source(u'y = 2\n'))
+        module = os.path.basename(path)[:-4]
+        with open(os.path.join(self.tmp, module + '.py'), 'w') as f:
+            f.write('y = 2\n')
+        namespace = {'__name__': '__main__'}
+        exec(mpy.loader(self.tmp, module), namespace)
+        self.assertEqual(namespace['y'], 2)
+        self.assertEqual(namespace['__name__'], '__main__')
+        self.assertNotIn(module, sys.modules)
+        sys.path.remove(self.tmp)
+
+    def test_ram_loader(self):
+        path = self.cache.compile(mpy.cell_source(u'y = 2\n'))
+        module = os.path.basename(path)[:-4]
+        with open(path, 'rb') as f:
+            data = f.read()
+        point = os.path.join(self.tmp, 'ram')
+        mounted = []
+
+        def mount(fs, path):
+            self.assertEqual(fs.stat('/' + module + '.mpy')[6], len(data))
+            self.assertRaises(OSError, fs.stat, '/' + module + '.py')
+            f = fs.open('/' + module + '.mpy', 'rb')
+            buf = bytearray(len(data) + 8)
+            read = f.readinto(buf)
+            self.assertEqual((bytes(buf[:read]), f.readinto(buf)), (data, 0))
+            # CPython imports from a directory, given what the board would read
+            os.makedirs(path)
+            with open(os.path.join(path, module + '.py'), 'wb') as out:
+                out.write(buf[:read])
+            mounted.append(path)
+
+        def umount(path):
+            if path not in mounted:
+                raise OSError(22, 'Not mounted')
+            mounted.remove(path)
+            shutil.rmtree(path)
+        sys.modules['vfs'] = types.SimpleNamespace(mount=mount, umount=umount)
+        self.addCleanup(sys.modules.pop, 'vfs')
+        namespace = {'__name__': '__main__'}
+        exec(mpy.ram_loader(data, module, point), namespace)
+        self.assertEqual(namespace['y'], 2)
+        self.assertNotIn('_mpk_load', namespace)
+        self.assertNotIn(module, sys.modules)
+        self.assertNotIn(point, sys.path)
+        self.assertEqual(mounted, [])
+
+
+class TestMetrics(unittest.TestCase):
+
+    def test_histogram_is_cumulative(self):
+        hist = Histogram(buckets=(1, 2, 4))
+        for value in (0.5, 1.5, 3, 10):
+            hist.observe(value)
+        self.assertEqual(hist.counts, [1, 2, 3])
+        self.assertEqual((hist.count, hist.sum), (4, 15.0))
+
+    def test_timer(self):
+        timer = CellTimer(queue=0.002)
+        with timer.phase('exec'):
+            pass
+        timer.add('exec', 0.5)
+        timings = timer.as_dict()
+        self.assertEqual(timings['queue'], 2.0)
+        self.assertGreaterEqual(timings['exec'], 500.0)
+        self.assertIn('total', timings)
+
+    def test_render(self):
+        metrics = Metrics({'kernel': 'unix'})
+        timer = CellTimer()
+        timer.add('exec', 0.003)
+        metrics.record(timer, 'ok')
+        text = metrics.render()
+        self.assertIn('# TYPE mpkernel_cell_phase_seconds histogram', text)
+        self.assertIn(
+            'mpkernel_cell_phase_seconds_bucket{kernel="unix",le="0.0025",phase="exec"} 0', text)
+        self.assertIn('mpkernel_cell_phase_seconds_bucket{kernel="unix",le="0.005",phase="exec"} 1',
+                      text)
+        self.assertIn('mpkernel_cell_phase_seconds_count{kernel="unix",phase="total"} 1', text)
+        self.assertIn('mpkernel_cells_total{kernel="unix",status="ok"} 1', text)
+        self.assertNotIn('mpkernel_restart_seconds', text)
+        metrics.observe('restart', 0.02, how='soft_reset')
+        metrics.observe('restart', 0.3, how='respawn')
+        text = metrics.render()
+        self.assertIn('# TYPE mpkernel_restart_seconds histogram', text)
+        self.assertIn(
+            'mpkernel_restart_seconds_bucket{how="soft_reset",kernel="unix",le="0.025"} 1', text)
+        self.assertIn('mpkernel_restart_seconds_count{how="respawn",kernel="unix"} 1', text)
+        metrics.observe('interrupt', 0.004)
+        self.assertIn('mpkernel_interrupt_seconds_bucket{kernel="unix",le="0.005"} 1',
+                      metrics.render())
+        self.assertRaises(ValueError, metrics.observe, 'unknown', 1.0)
+
+    def test_seconds_since(self):
+        self.assertIsNone(seconds_since(None))
+        ago = seconds_since(datetime.utcnow() - timedelta(seconds=2))
+        self.assertAlmostEqual(ago, 2, places=1)
+
+
+class TestNamespaceCache(unittest.TestCase):
+    """The queries run with CPython in ``self.ns``, standing in for the device"""
+
+    def setUp(self):
+        self.ns = {'__name__': '__main__'}
+        self.cache = NamespaceCache(self.query)
+
+    def query(self, program):
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            try:
+                exec(program, self.ns)
+            except NameError:
+                return ''
+        return out.getvalue()
+
+    def test_token_before(self):
+        self.assertEqual(token_before('x = os.pa', 9), 'os.pa')
+        self.assertEqual(token_before('print(', 6), '')
+        self.assertIsNone(token_before('x[0].ap', 7))
+        self.assertIsNone(token_before('"abc".up', 8))
+
+    def test_one_query_fills_modules(self):
+        exec('import os\nvalue = 1', self.ns)
+        self.assertEqual(self.cache.complete('val', 3), (['value'], 0))
+        self.assertIn('print', self.cache.complete('pri', 3)[0])
+        self.assertIn('while', self.cache.complete('whi', 3)[0])
+        matches, start = self.cache.complete('x = os.pa', 9)
+        self.assertIn('path', matches)
+        self.assertEqual(start, 7)
+        self.assertEqual(self.cache.queries, 1)
+        self.assertNotIn('_mpk_query', self.cache.complete('_', 1)[0])
+
+    def test_generation(self):
+        self.cache.complete('val', 3)
+        exec('value = 1\nimport os', self.ns)
+        self.assertEqual(self.cache.complete('val', 3)[0], [])
+        self.cache.invalidate()
+        self.assertEqual(self.cache.complete('val', 3)[0], ['value'])
+        self.assertEqual(self.cache.queries, 2)
+        # Module names are kept, and not sent again
+        self.cache.invalidate()
+        self.cache.complete('val', 3)
+        self.assertIn('path', self.cache.complete('os.', 3)[0])
+        self.assertEqual(self.cache.queries, 3)
+
+    def test_stale_while_busy(self):
+        exec('value = 1', self.ns)
+        self.cache.complete('val', 3)
+        self.cache.invalidate()
+        self.assertEqual(self.cache.complete('val', 3, query=False)[0], ['value'])
+        self.assertEqual(self.cache.queries, 1)
+
+    def test_lru(self):
+        cache = NamespaceCache(self.query, max_entries=2)
+        exec('class A:\n    x = 1\na = b = c = A()', self.ns)
+        for name in 'abcb':
+            self.assertEqual(cache.complete(name + '.', 2)[0], ['x'])
+        self.assertEqual(len(cache.entries), 2)
+        self.assertEqual(cache.queries, 3)
+        cache.complete('a.', 2)
+        self.assertEqual(cache.queries, 4)
+
+    def test_defines_query_again(self):
+        exec('value = 1', self.ns)
+        self.cache.complete('val', 3)
+        del self.ns['_mpk_query']
+        self.cache.invalidate()
+        self.assertEqual(self.cache.complete('val', 3)[0], ['value'])
+
+    def test_inspect(self):
+        exec('def f():\n    "Does f"', self.ns)
+        text = self.cache.inspect('f()', 1)
+        self.assertTrue(text.startswith('Type:        function\n'))
+        self.assertTrue(text.endswith('Docstring:   Does f'))
+        self.assertIsNone(self.cache.inspect('missing', 3))
+
+
+class TestCellLog(unittest.TestCase):
+
+    def replay(self, log, ns):
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            exec(log.program(), ns)
+        return log.replayed(output.getvalue())
+
+    def test_replay(self):
+        log = CellLog()
+        for code in ['x = 1', '  ', 'def f():\n    return x + 1\n', 'print(f())', '1/0', 'y = f()']:
+            log.record(code)
+        self.assertEqual(len(log), 5)
+        ns = {}
+        restored = self.replay(log, ns)
+        self.assertEqual((ns['x'], ns['y']), (1, 2))
+        self.assertNotIn('_mpk_cell', ns)
+        self.assertEqual(restored.cells,
+                         ['x = 1', 'def f():\n    return x + 1', 'print(f())', 'y = f()'])
+
+    def test_unfinished(self):
+        log = CellLog()
+        log.record('x = 1')
+        self.assertIsNone(log.replayed('Traceback (most recent call last):\nMemoryError:\n'))
+
+    def test_truncated(self):
+        log = CellLog(max_bytes=10)
+        for code in ['x = 1', 'y = 22', 'z = 3']:
+            log.record(code)
+        self.assertTrue(log.truncated)
+        self.assertEqual(log.cells, ['x = 1'])
+        other = CellLog()
+        other.extend(log)
+        self.assertTrue(other.truncated)
+        self.assertTrue(self.replay(log, {}).truncated)
+
+
+class TestPipeline(unittest.TestCase):
+
+    def test_program(self):
+        pipeline = Pipeline([('a', 'x = 1\nprint(x)'), ('b', 'print(x + 1)'), ('c', 'x = 3')])
+        output = io.StringIO()
+        ns = {}
+        with contextlib.redirect_stdout(output):
+            exec(pipeline.program(), ns)
+        self.assertEqual(output.getvalue().split(pipeline.marker), ['1\n', '2\n', ''])
+        self.assertEqual(ns['x'], 3)
+        self.assertNotIn('_mpk_cell', ns)
+
+    def test_readers(self):
+        pipeline = Pipeline([('a', ''), ('b', ''), ('c', '')])
+        self.assertEqual(pipeline.next_id, 'a')
+        reply = u'one' + pipeline.marker + u'two' + pipeline.marker + u'three\x04\x04>'
+        outputs = []
+        while pipeline.next_id is not None:
+            reader = pipeline.reader()
+            out = u''
+            for i in range(0, len(reply), 3):
+                out += reader.feed(reply[i:i + 3])
+                if reader.done:
+                    reply = getattr(reader, 'rest', u'') + reply[i + 3:]
+                    break
+            outputs.append(out)
+        self.assertEqual(outputs, [u'one', u'two', u'three'])
+
+    def test_held_back(self):
+        reader = CellReader(u'\x1e_mpk_1\x1e')
+        self.assertEqual(reader.feed(u'ab\x1e_mp'), u'ab')
+        self.assertEqual(reader.feed(u'x'), u'\x1e_mpx')
+
+    def test_error_ends_the_pipeline(self):
+        reader = CellReader(u'\x1e_mpk_1\x1e')
+        self.assertEqual(reader.feed(u'out\x04Traceback\r\n'), u'out')
+        reader.feed(u'ZeroDivisionError\r\n\x04>')
+        self.assertTrue(reader.done and reader.ended)
+        self.assertEqual(reader.error, u'Traceback\r\nZeroDivisionError\r\n')
+
+    def test_fix_traceback(self):
+        error = (u'Traceback (most recent call last):\r\n'
+                 u'  File "<stdin>", line 2, in <module>\r\n'
+                 u'  File "<string>", line 3, in <module>\r\n'
+                 u'ZeroDivisionError: divide by zero\r\n')
+        self.assertEqual(fix_traceback(error), u'Traceback (most recent call last):\r\n'
+                         u'  File "<stdin>", line 3, in <module>\r\n'
+                         u'ZeroDivisionError: divide by zero\r\n')
+
+    def test_fix_traceback_of_nested_wrappers(self):
+        error = (u'Traceback (most recent call last):\r\n'
+                 u'  File "<stdin>", line 2, in <module>\r\n'
+                 u'  File "<string>", line 5, in <module>\r\n'
+                 u'  File "<string>", line 1, in <module>\r\n'
+                 u'NameError: name \'y\' is not defined\r\n')
+        self.assertEqual(fix_traceback(error, 2), u'Traceback (most recent call last):\r\n'
+                         u'  File "<stdin>", line 1, in <module>\r\n'
+                         u'NameError: name \'y\' is not defined\r\n')
+
+
+class TestParallel(unittest.TestCase):
+
+    def test_args(self):
+        target, expression, args = parallel_args('-n 3 -X heapsize=4M i, x in enumerate(xs)')
+        self.assertEqual((target, expression), ('i, x', 'enumerate(xs)'))
+        self.assertEqual((args.workers, args.options, args.output), (3, ['heapsize=4M'], 'results'))
+        target, expression, args = parallel_args('-o out')
+        self.assertEqual((target, expression, args.output), (None, None, 'out'))
+        self.assertRaises(MagicError, parallel_args, '-n -1')
+        self.assertRaises(MagicError, parallel_args, '--nope x in y')
+
+    def test_inputs(self):
+        self.assertEqual(parse_inputs(u"1\r\n'a b'\r\n\r\n(2, 3)\r\n"), [u'1', u"'a b'", u'(2, 3)'])
+
+    def test_order(self):
+        run = ParallelRun('x', ['1', '2', '3'])
+        self.assertEqual([run.take(), run.take()], [0, 1])
+        run.finish(1, u'b\r\n' + parallel.MARKER + u'4')
+        self.assertEqual(run.ready(), u'')
+        run.finish(0, u'a\r\n' + parallel.MARKER)
+        self.assertEqual(run.ready(), u'a\r\nb\r\n')
+        self.assertEqual(run.take(), 2)
+        self.assertIsNone(run.take())
+        run.finish(2, u'c\r\n' + parallel.MARKER + u"'x'")
+        self.assertEqual(run.ready(), u'c\r\n')
+        self.assertIsNone(run.error)
+        self.assertEqual(run.results_program('out'), "out = [None, 4, 'x']\n")
+        self.assertEqual(run.program(0), parallel.RUN.format(target='x', value='1',
+                                                             marker=parallel.MARKER))
+
+    def test_error(self):
+        run = ParallelRun('x', ['1', '2', '3', '4'])
+        for _ in range(3):
+            run.take()
+        run.finish(2, u'c\r\n', u'Traceback\r\nZeroDivisionError\r\n')
+        self.assertIsNone(run.take())
+        run.finish(1, u'b\r\n', u'Traceback\r\nNameError\r\n')
+        run.finish(0, u'a\r\n' + parallel.MARKER)
+        self.assertEqual(run.ready(), u'a\r\nb\r\n')
+        self.assertEqual(run.ready(), u'')
+        self.assertEqual(run.error, (1, u'Traceback\r\nNameError\r\n'))
+        self.assertIsNone(run.results_program('results'))
+
+
+class TestHeap(unittest.TestCase):
+
+    RECORD = (u' 32 1000 9000 5000 5000 1200 8800\r\n'
+              u'GC: total: 10000, used: 1200, free: 8800\r\n'
+              u' No. of 1-blocks: 3, 2-blocks: 1, max blk sz: 8, max free sz: 100\r\n')
+
+    def test_parse(self):
+        usage = heap.HeapUsage.parse(self.RECORD)
+        self.assertEqual((usage.kept, usage.garbage, usage.largest_free), (200, 3800, 3200))
+        self.assertAlmostEqual(usage.fragmentation, 1 - 3200 / 8800.0)
+        self.assertIsNone(heap.HeapUsage.parse(u' 32 1000\r\n'))
+        self.assertIsNone(heap.HeapUsage.parse(u' 32 1 2 3 4 5 6').fragmentation)
+
+    def test_filter(self):
+        output = io.StringIO()
+        probe = heap.HeapFilter(output)
+        text = u'out\r\n' + heap.MARKER + self.RECORD + heap.END
+        for i in range(0, len(text), 4):
+            probe.write(text[i:i + 4])
+        probe.write(u'\x1e')
+        probe.close()
+        self.assertEqual(output.getvalue(), u'out\r\n\x1e')
+        self.assertEqual(probe.usage.alloc, 1200)
+
+    def test_trace(self):
+        trace = heap.HeapTrace(size=3)
+        self.assertIn(u'No cells traced', trace.report())
+        for count, (before, after) in enumerate([(1000, 1100), (1100, 5000), (5000, 5000),
+                                                 (5000, 5100)], 1):
+            trace.add(count, heap.HeapUsage(before, 9000, after, 0, after, 10000 - after, 1000))
+        self.assertEqual(len(trace), 3)
+        flagged = dict(trace.flagged(leak_bytes=1024, fragmentation=0.75))
+        self.assertEqual(flagged[2], [u'kept 3.8 KB', u'80% fragmented, largest free block '
+                                      u'1000 B of 4.9 KB'])
+        self.assertEqual(sorted(flagged), [2, 3, 4])
+        self.assertTrue(trace.report(1024, 0.9).endswith(u'\n  [2] kept 3.8 KB'))
+        self.assertIn(u'image/svg+xml', trace.view())
+
+
+class TestMprof(unittest.TestCase):
+
+    CELL = (u'import micropython\n'
+            u'def f(x):\n'
+            u'    if x: return 1\n'
+            u'    return 2\n'
+            u'def g():\n'
+            u'    yield 1\n'
+            u'@micropython.viper\n'
+            u'def h(x: int) -> int:\n'
+            u'    return x\n')
+
+    def test_lines(self):
+        instrumented = mprof.Instrumented(self.CELL)
+        self.assertEqual(instrumented.probes,
+                         [(1, u'import micropython'), (2, u'def f(x):'), (3, u'if x: return 1'),
+                          (4, u'return 2'), (5, u'def g():'), (6, u'yield 1'),
+                          (8, u'def h(x: int) -> int:')])
+        source = instrumented.source
+        # f is wrapped, the generator and the viper function are not
+        self.assertEqual(source.count('_mpk_e' + instrumented.run), 1)
+        self.assertIn('    return x\n', source)
+        lines = source.splitlines()
+        number = next(i for i, line in enumerate(lines, 1) if line.strip() == 'return 2')
+        self.assertEqual(instrumented.line_map[number], 4)
+        self.assertEqual(instrumented.fix_traceback(
+            u'  File "<stdin>", line {}, in f\r\n'.format(number)),
+            u'  File "<stdin>", line 4, in f\r\n')
+
+    def test_functions(self):
+        instrumented = mprof.Instrumented(u'class A:\n    def f(self):\n        pass\n', True)
+        self.assertEqual(instrumented.probes, [(2, u'A.f')])
+        self.assertNotIn('_mpk_m', instrumented.source)
+        self.assertRaises(MagicError, mprof.Instrumented, u'def (:')
+
+    def test_profile(self):
+        instrumented = mprof.Instrumented(u'x = 1\nfor i in range(3):\n    x += i\n')
+        data = struct.pack('<8I', 1, 1, 3, 200, 10, 5, 30, 900)
+        record = u' 100 400 200 {}\r\n'.format(binascii.b2a_base64(data).decode())
+        profile = instrumented.profile(record)
+        self.assertEqual(profile.rows(), [(3, u'x += i', 3, 30), (1, u'x = 1', 1, 10),
+                                          (2, u'for i in range(3):', 1, 5)])
+        self.assertEqual(profile.probe_us, 2.0)
+        table = profile.table(rows=1).splitlines()
+        self.assertEqual(table[1].split(),
+                         [u'3', u'3', u'0.030', u'10.0', u'30.0%', u'x', u'+=', u'i'])
+        self.assertEqual(table[2].split(), [u'...', u'2', u'more'])
+        self.assertTrue(table[3].startswith(u'Ran in 0.100 ms; 5 line probes of 2.0 us'))
+        self.assertIsNone(instrumented.profile(None))
+        self.assertIsNone(instrumented.profile(u'1 2 3 !!'))
+
+
+class TestTimeit(unittest.TestCase):
+
+    def test_args(self):
+        args, rest = timeit.timeit_args(u'-n 10 -r3 --save=t.json -total')
+        self.assertEqual((args.loops, args.repeat, args.save, rest), (10, 3, u't.json', u'-total'))
+        self.assertEqual(timeit.timeit_args(u'x -n 1')[1], u'x -n 1')
+        self.assertRaises(MagicError, timeit.timeit_args, u'-r 0 x')
+        self.assertRaises(MagicError, timeit.Timeit, u'-n 5')
+        with self.assertRaises(MagicError) as e:
+            timeit.Timeit(u'x = 1', u'y = (\n1 +')
+        self.assertIn(u'(line 2)', str(e.exception))
+
+    def test_result(self):
+        result = timeit.Timeit(u'x = 1').result(u' 100 1000 1200 1100 3000 ')
+        self.assertEqual(result.per_loop, [10.0, 11.0, 12.0, 30.0])
+        self.assertEqual(result.mean, 15.75)
+        self.assertAlmostEqual(result.stdev, 9.535, places=3)
+        self.assertEqual(result.percentile(50), 11.5)
+        self.assertAlmostEqual(result.percentile(90), 24.6)
+        self.assertEqual(str(result).splitlines(), [
+            u'15.8 us \xb1 9.54 us per loop (mean \xb1 std. dev. of 4 runs, 100 loops each)',
+            u'min 10 us, median 11.5 us, p90 24.6 us, max 30 us'])
+        self.assertEqual(timeit.format_time(0.25), u'250 ns')
+        self.assertIsNone(timeit.Timeit(u'x = 1').result(u'100'))
+
+    def test_fix_traceback(self):
+        timing = timeit.Timeit(u'-n 5 a = 1', u'b = 2\n1/0\n')
+        lines = timing.source.splitlines()
+        number = lines.index(u'        1/0') + 1
+        error = (u'Traceback (most recent call last):\r\n'
+                 u'  File "<stdin>", line 24, in <module>\r\n'
+                 u'  File "<stdin>", line 20, in _mpk_timeit\r\n'
+                 u'  File "<stdin>", line {}, in _mpk_inner\r\n'
+                 u'ZeroDivisionError: division by zero\r\n').format(number)
+        self.assertEqual(timing.fix_traceback(error), u'Traceback (most recent call last):\r\n'
+                         u'  File "<stdin>", line 3, in <module>\r\n'
+                         u'ZeroDivisionError: division by zero\r\n')
+
+    def test_save(self):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        path = os.path.join(tmp, 'timings', 'runs.json')
+        timing = timeit.Timeit(u'-s {} x = 1'.format(path), target=u'a')
+        self.assertIsNone(timing.save(timing.result(u'1000 2000 2000')))
+        timeit.save(path, timeit.TimeitResult(10, [1], u'x = 1', target=u'b'))
+        timing = timeit.Timeit(u'-s {} x = 1'.format(path), target=u'a')
+        self.assertEqual(timing.loops, 1000)
+        self.assertIn(u'_mpk_timeit(1000, 7, 200000)', timing.source)
+        comparison = timing.save(timing.result(u'1000 2200 2200'))
+        self.assertTrue(comparison.startswith(
+            u'median +10.0% (2 us -> 2.2 us) against the run saved'))
+        self.assertEqual([r['target'] for r in timeit.load(path)], [u'a', u'b', u'a'])
+        self.assertEqual(timeit.last_saved(path, u'x = 1', target=u'b')['loops'], 10)
+
+
+class TestCapture(unittest.TestCase):
+
+    def test_round_trip(self):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        path = capture.capture_path(os.path.join(tmp, 'captures'), '/dev/ttyACM0')
+        self.assertTrue(os.path.basename(path).startswith('dev_ttyACM0-'))
+        recorder = capture.Capture(path, u'open /dev/ttyACM0')
+        recorder.writes.write(u'\x05A\x01')
+        recorder.reads.write(u'R\x01\udc80')
+        recorder.note(u'cell 1')
+        recorder.write(b'x = 1\x04')
+        recorder.close()
+        recorder.read(b'lost')
+        records = capture.load(path)
+        self.assertEqual([(r.kind, r.data) for r in records], [
+            (capture.NOTE, b'open /dev/ttyACM0'), (capture.WRITE, b'\x05A\x01'),
+            (capture.READ, b'R\x01\x80'), (capture.NOTE, b'cell 1'),
+            (capture.WRITE, b'x = 1\x04')])
+        self.assertEqual(sorted(r.time for r in records), [r.time for r in records])
+        with open(path, 'ab') as f:
+            f.write(capture.HEADER.pack(capture.READ, 5, 100) + b'cut short')
+        self.assertEqual(len(capture.load(path)), 5)
+        with open(path, 'r+b') as f:
+            f.write(b'X')
+        self.assertRaises(ValueError, capture.load, path)
+
+    def test_summary(self):
+        R, W, N = capture.READ, capture.WRITE, capture.NOTE
+        records = [capture.Record(*r) for r in [
+            (W, 0.0, b'\x01'), (R, 0.01, b'raw REPL'), (N, 0.02, b'cell 1'),
+            (W, 0.05, b'print(1)'), (W, 0.06, b'\x04'), (R, 0.36, b'OK'), (R, 0.38, b'1\r\n'),
+            (W, 0.4, b'\x03')]]
+        sections = capture.summary(records)
+        self.assertEqual([s.name for s in sections], [u'(connect)', u'cell 1', u'total'])
+        cell = sections[1]
+        self.assertAlmostEqual(cell.host, 0.04 + 0.02)
+        self.assertAlmostEqual(cell.sending, 0.01)
+        self.assertAlmostEqual(cell.waiting, 0.3)
+        self.assertAlmostEqual(cell.running, 0.02)
+        self.assertEqual((cell.written, cell.read, cell.exchanges), (10, 5, 2))
+        self.assertAlmostEqual(sections[-1].total, 0.4)
+        self.assertEqual(len(capture.format_summary(sections).splitlines()), 4)
+
+    def test_replayer(self):
+        records = [capture.Record(*r) for r in [
+            (capture.WRITE, 0.0, b'ab'), (capture.READ, 0.2, b'one'),
+            (capture.NOTE, 0.2, b'cell 1'), (capture.WRITE, 1.0, b'c'),
+            (capture.READ, 1.1, b'two')]]
+        sent = []
+        received = [b'a', b'bc']
+        replayer = capture.Replayer(records, lambda: received.pop(0) if received else b'',
+                                    lambda data: sent.append((data, time.monotonic())),
+                                    speed=2.0)
+        start = time.monotonic()
+        self.assertTrue(replayer.run())
+        self.assertEqual([data for data, _ in sent], [b'one', b'two'])
+        self.assertAlmostEqual(sent[0][1] - start, 0.1, delta=0.05)
+        self.assertAlmostEqual(sent[1][1] - sent[0][1], 0.05, delta=0.05)
+        self.assertEqual(replayer.mismatches, 0)
+        log = io.StringIO()
+        replayer = capture.Replayer(records, iter([b'xb', b'']).__next__, sent.append,
+                                    speed=100, log=log)
+        self.assertFalse(replayer.run())
+        self.assertEqual(replayer.mismatches, 1)
+        self.assertIn(u"Expected b'ab'", log.getvalue())
+
+
+class TestBackground(unittest.TestCase):
+
+    def test_result(self):
+        self.assertEqual(background(sorted, [2, 1]).result(timeout=5), [1, 2])
+
+    def test_exception(self):
+        future = background(int, 'x')
+        self.assertRaises(ValueError, future.result, 5)
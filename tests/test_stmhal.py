@@ -8,9 +8,36 @@ test_stmhal
 Tests for `stmhal` module.
 """
 
+import io
+import os
+import sys
+import ast
+import shutil
+import array
+import zlib
+import socket
+import struct
+import subprocess
+import tempfile
+import time
+import threading
 import unittest
 
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
 import stmhal
+from mpkernel import capture
+from mpkernel.repl import RemoteError
+from stmhal import files, sync, telemetry, variables
+from stmhal.broadcast import Broadcast, LabelledLines, parse_devices
+from stmhal import broker, webrepl
+from stmhal.transport import RingBuffer, Transport, TransportError, SerialTransport
+from stmhal.webrepl import WebReplTransport
+from tests.fake_pyboard import FakePyboard
+from tests.fake_webrepl import FakeWebRepl
 
 
 class TestStmhal(unittest.TestCase):
@@ -23,3 +50,670 @@ class TestStmhal(unittest.TestCase):
 
     def tearDown(self):
         pass
+
+
+class TestRingBuffer(unittest.TestCase):
+
+    def test_wraps_around(self):
+        ring = RingBuffer(8)
+        ring.write(b'abcdef')
+        self.assertEqual(ring.read(4), b'abcd')
+        ring.write(b'ghijk')
+        self.assertEqual(len(ring), 7)
+        self.assertEqual(ring.read(100), b'efghijk')
+
+    def test_read_timeout(self):
+        self.assertEqual(RingBuffer(8).read(4, timeout=0.01), b'')
+
+    def test_writer_waits_for_reader(self):
+        ring = RingBuffer(4)
+        writer = threading.Thread(target=ring.write, args=(b'0123456789',))
+        writer.start()
+        data = b''
+        while len(data) < 10:
+            data += ring.read(3, timeout=1)
+        writer.join(1)
+        self.assertEqual(data, b'0123456789')
+
+    def test_close(self):
+        ring = RingBuffer(4)
+        ring.write(b'ab')
+        ring.close()
+        self.assertEqual(ring.read(4), b'ab')
+        self.assertEqual(ring.read(4), b'')
+
+
+class FakeBoard(Transport):
+    """A transport talking to a board that only has a raw REPL"""
+    window = 16
+
+    def __init__(self, raw_paste=True, **kw):
+        super(FakeBoard, self).__init__(chunk_delay=0, **kw)
+        self.supports_raw_paste = raw_paste
+        self.replies = queue.Queue()
+        self.received = b''
+        self.commands = []
+        self.start()
+
+    def _read_chunk(self):
+        try:
+            return self.replies.get(timeout=0.01)
+        except queue.Empty:
+            return b''
+
+    def _write(self, data):
+        self.received += data
+        if self.received.endswith(b'\r\x01'):
+            self.received = b''
+            self.replies.put(b'raw REPL; CTRL-B to exit\r\n>')
+        elif self.received == b'\x05A\x01':
+            if not self.supports_raw_paste:
+                self.received = b''
+                self.replies.put(b'R\x00')
+                return
+            self.replies.put(b'R\x01' + struct.pack('<H', self.window))
+        elif self.received.startswith(b'\x05A\x01'):
+            body = self.received[3:]
+            if body.endswith(b'\x04'):
+                self.received = b''
+                self.replies.put(b'\x04')
+                self.run(body[:-1])
+            elif len(body) % self.window == 0:
+                self.replies.put(b'\x01')
+        elif self.received.endswith(b'\x04'):
+            body, self.received = self.received[:-1], b''
+            self.replies.put(b'OK')
+            self.run(body)
+        elif self.received.endswith(b'\x03'):
+            self.received = b''
+
+    def run(self, command):
+        self.commands.append(command)
+        if command.startswith(b'raise'):
+            self.replies.put(b'\x04Traceback (most recent call last):\r\n'
+                             b'  File "<stdin>", line 1, in <module>\r\n'
+                             b'ValueError: bad\r\n\x04>')
+        else:
+            self.replies.put(b'out: ')
+            self.replies.put(command + b'\r\n\x04\x04>')
+
+
+class TestTransport(unittest.TestCase):
+
+    def exec_raw(self, board, command):
+        board.enter_raw_repl()
+        stream = io.StringIO()
+        error = board.exec_raw(command, stream)
+        board.close()
+        return stream.getvalue(), error
+
+    def test_raw_paste(self):
+        board = FakeBoard()
+        command = u'x = """é"""\n' * 10
+        output, error = self.exec_raw(board, command)
+        self.assertTrue(board.raw_paste)
+        self.assertEqual(board.commands, [command.encode('utf-8')])
+        self.assertEqual(output, u'out: ' + command + u'\r\n')
+        self.assertEqual(error, u'')
+
+    def test_without_raw_paste(self):
+        board = FakeBoard(raw_paste=False, chunk_size=4)
+        output, error = self.exec_raw(board, u'print(1)')
+        self.assertFalse(board.raw_paste)
+        self.assertEqual(board.commands, [b'print(1)'])
+        self.assertEqual(output, u'out: print(1)\r\n')
+
+    def test_error(self):
+        output, error = self.exec_raw(FakeBoard(), u'raise ValueError')
+        self.assertEqual(output, u'')
+        self.assertTrue(error.endswith(u'ValueError: bad\r\n'))
+
+    def test_read_until_keeps_the_rest(self):
+        board = FakeBoard()
+        board.replies.put(b'abc>def')
+        self.assertEqual(board.read_until(b'>', timeout=1), b'abc>')
+        self.assertEqual(board.read(10), b'def')
+        self.assertRaises(TransportError, board.read_until, b'>', timeout=0.05)
+        board.close()
+
+
+class TestFiles(unittest.TestCase):
+
+    def test_frames(self):
+        data = b'\x00\x03\x04' * 100
+        framed = b''.join(files.frames(io.BytesIO(data), 128))
+        chunks = []
+        while True:
+            n = struct.unpack('<I', framed[:4])[0]
+            if not n:
+                break
+            chunks.append(framed[4:4 + n])
+            framed = framed[4 + n:]
+        self.assertEqual([len(c) for c in chunks], [128, 128, 44])
+        self.assertEqual(b''.join(chunks), data)
+
+    def test_compressed_frames(self):
+        data = b'hello ' * 1000
+        frame = next(files.frames(io.BytesIO(data), 8192, compress=True))
+        self.assertLess(len(frame), len(data))
+        self.assertEqual(zlib.decompress(frame[4:]), data)
+
+    def test_local_hash(self):
+        fd, path = tempfile.mkstemp()
+        os.write(fd, b'abc')
+        os.close(fd)
+        try:
+            self.assertEqual(files.local_hash(path)[:8], 'ba7816bf')
+        finally:
+            os.remove(path)
+        self.assertEqual(files.local_hash(path), '')
+
+    def test_transfer_str(self):
+        transfer = files.Transfer('a', 'b', size=2048, seconds=0.5)
+        self.assertEqual(str(transfer), 'a -> b: 2048 bytes in 0.50 s (4.0 KB/s)')
+        self.assertIn('skipped', str(files.Transfer('a', 'b', skipped=True)))
+
+
+def write_tree(root, tree):
+    """Write ``{relative path: bytes}`` under ``root``"""
+    for path, data in tree.items():
+        path = os.path.join(root, *path.split('/'))
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as f:
+            f.write(data)
+
+
+class TestSync(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.src = os.path.join(self.tmp, 'src')
+        write_tree(self.src, {'main.py': b'1', 'lib/a.py': b'2', 'lib/__pycache__/a.pyc': b'',
+                              '.git/HEAD': b'', 'notes.txt': b'3'})
+
+    def test_local_manifest(self):
+        cache = sync.SyncCache(os.path.join(self.tmp, 'cache.json'))
+        exclude = sync.EXCLUDE + ('*.txt',)
+        manifest = sync.local_manifest(self.src, exclude, cache)
+        self.assertEqual(sorted(manifest), ['lib/a.py', 'main.py'])
+        self.assertEqual(manifest['main.py'],
+                         files.local_hash(os.path.join(self.src, 'main.py'))[:16])
+        cache.save()
+        cache = sync.SyncCache(cache.path)
+        self.assertEqual(sync.local_manifest(self.src, exclude, cache), manifest)
+        self.assertFalse(cache.changed)
+
+    def test_manifest_text(self):
+        manifest = {'main.py': 'ab12', 'lib/a b.py': 'cd34'}
+        text = sync.format_manifest(manifest, 't1')
+        self.assertEqual(text, u'cd34 lib/a b.py\nab12 main.py\n# t1\n')
+        self.assertEqual(sync.parse_manifest(text + u'\n'), (manifest, 't1', 3))
+        text += sync.format_manifest({'main.py': 'ef56'}, 't2', ['lib/a b.py'])
+        self.assertEqual(sync.parse_manifest(text), ({'main.py': 'ef56'}, 't2', 6))
+
+    def test_board_path(self):
+        self.assertEqual(sync.board_path('', 'lib/a.py'), 'lib/a.py')
+        self.assertEqual(sync.board_path('/flash/', 'lib/a.py'), '/flash/lib/a.py')
+
+
+class TestWebRepl(unittest.TestCase):
+
+    def test_frames(self):
+        payloads = [b'', b'x' * 125, b'\x00\xff' * 200, b'y' * 70000]
+        data = b''.join(webrepl.encode_frame(webrepl.BINARY, p) for p in payloads)
+        data += webrepl.encode_frame(webrepl.TEXT, b'hi', mask=False)
+        parser = webrepl.FrameParser()
+        frames = []
+        for i in range(0, len(data), 1000):
+            frames += parser.feed(data[i:i + 1000])
+        self.assertEqual(frames, [(webrepl.BINARY, p) for p in payloads] + [(webrepl.TEXT, b'hi')])
+
+    def test_continuation(self):
+        data = (b'\x02\x01a' + b'\x89\x00' + b'\x80\x01b')
+        self.assertEqual(webrepl.FrameParser().feed(data),
+                         [(webrepl.BINARY, b'a'), (webrepl.PING, b''), (webrepl.BINARY, b'b')])
+
+    def test_accept_key(self):
+        # The example of RFC 6455
+        self.assertEqual(webrepl.accept_key('dGhlIHNhbXBsZSBub25jZQ=='),
+                         b's3pPLMBiTxaQ9kYGzzhZRbK+xOo=')
+
+    def test_parse_url(self):
+        self.assertEqual(webrepl.parse_url('ws://192.168.4.1'),
+                         ('192.168.4.1', 8266, '/', ''))
+        self.assertEqual(webrepl.parse_url('ws://:secret@board.local:8000/repl'),
+                         ('board.local', 8000, '/repl', 'secret'))
+        self.assertRaises(ValueError, webrepl.parse_url, '/dev/ttyACM0')
+
+
+class TestBroadcast(unittest.TestCase):
+
+    def setUp(self):
+        self.broadcast = Broadcast(['a', 'b', 'c'])
+        self.output = []
+
+    def job(self, label, write):
+        write(u'{} one\n{} '.format(label, label))
+        time.sleep(0.2)
+        write(u'two\n')
+        if label == 'b':
+            raise RemoteError(
+                u'Traceback (most recent call last):\r\nValueError: bad\r\n')
+
+    def run_job(self, grouped=False):
+        return self.broadcast.run(self.job, self.output.append, lambda: None,
+                                  lambda label: None, grouped=grouped)
+
+    def tearDown(self):
+        self.broadcast.close()
+
+    def test_parse_devices(self):
+        self.assertEqual(parse_devices(['/dev/ttyACM0', 'left=/dev/ttyACM1']),
+                         [('ttyACM0', '/dev/ttyACM0'), ('left', '/dev/ttyACM1')])
+        self.assertRaises(ValueError, parse_devices, ['a=/dev/ttyACM0', 'a=/dev/ttyACM1'])
+
+    def test_labelled_lines(self):
+        lines = LabelledLines('a')
+        self.assertEqual(lines.feed(u'1\n2'), u'[a] 1\n')
+        self.assertEqual(lines.feed(u'3\n'), u'[a] 23\n')
+        self.assertEqual(lines.feed(u'4'), u'')
+        self.assertEqual(lines.close(), u'[a] 4\n')
+
+    def test_concurrent(self):
+        start = time.time()
+        results = self.run_job()
+        self.assertLess(time.time() - start, 0.5)
+        self.assertEqual(results['a'].status, 'ok')
+        self.assertEqual((results['b'].status, results['b'].ename, results['b'].evalue),
+                         ('error', 'ValueError', 'bad'))
+
+    def test_interleaved(self):
+        self.run_job()
+        lines = u''.join(self.output).splitlines()
+        self.assertEqual(sorted(lines), [u'[{0}] {0} {1}'.format(label, n)
+                                         for label in 'abc' for n in ('one', 'two')])
+
+    def test_grouped(self):
+        self.run_job(grouped=True)
+        self.assertEqual(len(self.output), 3)
+        for text in self.output:
+            self.assertTrue(text.startswith(u'=== '))
+            label = text[4]
+            self.assertTrue(text.endswith(u'\n{0} one\n{0} two\n'.format(label)))
+
+
+class TestVariables(unittest.TestCase):
+
+    def round_trip(self, value):
+        kind, code, data = variables.encode(value)
+        return variables.decode(kind, code, array.array(code).itemsize, data)
+
+    def test_bytes(self):
+        self.assertEqual(self.round_trip(b'\x00\x03'), b'\x00\x03')
+        self.assertEqual(self.round_trip(bytearray(b'ab')), bytearray(b'ab'))
+
+    def test_encode(self):
+        self.assertEqual(variables.encode(array.array('h', [1, -2])),
+                         (variables.ARRAY, 'h', b'\x01\x00\xfe\xff'))
+        self.assertEqual(variables.encode([1, 2 ** 40])[1], 'q')
+        self.assertEqual(variables.encode([1, 2.5])[:2], (variables.LIST, 'd'))
+        self.assertRaises(TypeError, variables.encode, ['a'])
+        self.assertRaises(TypeError, variables.encode, {})
+
+    @unittest.skipIf(variables.numpy is not None, 'NumPy is installed')
+    def test_without_numpy(self):
+        self.assertEqual(self.round_trip(array.array('f', [1.5, 2])), array.array('f', [1.5, 2]))
+        self.assertEqual(self.round_trip([1, 2.5]), [1.0, 2.5])
+
+    @unittest.skipIf(variables.numpy is None, 'NumPy is not installed')
+    def test_numpy(self):
+        numpy = variables.numpy
+        value = numpy.arange(6, dtype='>i2').reshape(2, 3)
+        result = self.round_trip(value)
+        self.assertEqual(result.dtype, numpy.dtype('<i2'))
+        self.assertEqual(result.tolist(), list(range(6)))
+        self.assertEqual(self.round_trip([1, 2.5]).tolist(), [1.0, 2.5])
+
+
+class TestTelemetry(unittest.TestCase):
+
+    def setUp(self):
+        self.format = telemetry.RecordFormat('Hh', ['a'])
+
+    def test_record_format(self):
+        self.assertEqual(self.format.fmt, '<Hh')
+        self.assertEqual(self.format.descr, [('a', '<u2'), ('f1', '<i2')])
+        record_format = telemetry.RecordFormat('>2B4sf')
+        self.assertEqual(record_format.types, ['|u1', '|u1', '|S4', '>f4'])
+        self.assertEqual(record_format.numeric, [0, 1, 3])
+        self.assertRaises(ValueError, telemetry.RecordFormat, 'Hx')
+        self.assertRaises(ValueError, telemetry.RecordFormat, 'H', ['a', 'b'])
+
+    def test_decimator(self):
+        view = telemetry.Decimator(self.format, width=8)
+        values = [(i * 7 % 100, -i) for i in range(1001)]
+        data = b''.join(struct.pack('<Hh', *v) for v in values)
+        for i in range(0, len(data), 4 * 37):
+            view.add(data[i:i + 4 * 37])
+        mins, maxs = view.buckets()
+        self.assertEqual(view.per_bucket, 128)
+        self.assertEqual(len(mins[0]), 8)
+        for k in range(8):
+            bucket = values[k * 128:(k + 1) * 128]
+            self.assertEqual(mins[0][k], min(a for a, b in bucket))
+            self.assertEqual(maxs[0][k], max(a for a, b in bucket))
+            self.assertEqual(mins[1][k], min(b for a, b in bucket))
+        self.assertIn('<path d="M0 ', view.svg())
+
+    def test_frame_reader(self):
+        reader = telemetry.FrameReader()
+        output = b'one\r\n\x01\x04\x00\x04\x01\x02\x03two\x01\x00\x00\x04\x04>'
+        pieces = [reader.feed(output[i:i + 1]) for i in range(len(output))]
+        self.assertEqual(b''.join(text for text, _ in pieces), b'one\r\ntwo')
+        self.assertEqual(b''.join(data for _, data in pieces), b'\x04\x01\x02\x03')
+        self.assertTrue(reader.done)
+        self.assertEqual(reader.rest, b'\x04\x04>')
+        reader = telemetry.FrameReader()
+        self.assertEqual(reader.feed(b'x\x04Error\x04>'), (b'x', b''))
+        self.assertEqual(reader.rest, b'\x04Error\x04>')
+
+    def test_npy_writer(self):
+        path = os.path.join(tempfile.mkdtemp(), 'records.npy')
+        writer = telemetry.NpyWriter(path, self.format)
+        writer.append(struct.pack('<HhHh', 1, -1, 2, -2))
+        writer.close()
+        with open(path, 'rb') as f:
+            data = f.read()
+        self.assertTrue(data.startswith(b'\x93NUMPY\x01\x00'))
+        size = 10 + struct.unpack('<H', data[8:10])[0]
+        self.assertEqual(size % 64, 0)
+        header = ast.literal_eval(data[10:size].decode('latin1'))
+        self.assertEqual(header['shape'], (2,))
+        self.assertEqual(data[size:], struct.pack('<HhHh', 1, -1, 2, -2))
+
+
+class TestSerialTransport(unittest.TestCase):
+    """The serial transport against a fake pyboard on a pseudo terminal"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.board = FakePyboard(baudrate=1000000).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.board.stop()
+
+    def setUp(self):
+        self.transport = SerialTransport(self.board.device, 1000000, chunk_delay=0)
+        self.addCleanup(self.transport.close)
+        self.transport.enter_raw_repl(soft_reset=True)
+
+    def test_exec_raw(self):
+        stream = io.StringIO()
+        error = self.transport.exec_raw(u'x = 6\nprint(x * 7)', stream, timeout=5)
+        self.assertEqual((stream.getvalue(), error), (u'42\r\n', u''))
+        error = self.transport.exec_raw(u'y', io.StringIO(), timeout=5)
+        self.assertTrue(error.endswith(u"NameError: name 'y' is not defined\r\n"))
+
+    def test_interrupt(self):
+        self.transport.exec_start(u'while True:\n    pass\n')
+        self.transport.interrupt()
+        stream = io.StringIO()
+        self.transport.exec_raw(u'print(1)', stream, timeout=5)
+        self.assertEqual(stream.getvalue(), u'1\r\n')
+
+    def test_capture_replay(self):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        path = os.path.join(tmp, 'board.mpkcap')
+        # Only the recorded connection may read the board
+        self.transport.close()
+        transport = SerialTransport(self.board.device, 1000000, chunk_delay=0,
+                                    capture=capture.Capture(path))
+        transport.enter_raw_repl(soft_reset=True)
+        stream = io.StringIO()
+        transport.exec_raw(u'import time\ntime.sleep_ms(200)\nprint(7)', stream, timeout=5)
+        transport.close()
+        self.assertEqual(stream.getvalue(), u'7\r\n')
+
+        replay = subprocess.Popen([sys.executable, '-m', 'mpkernel.capture', 'replay', '--pty',
+                                   path], stdout=subprocess.PIPE, universal_newlines=True)
+        self.addCleanup(replay.wait)
+        self.addCleanup(replay.kill)
+        transport = SerialTransport(replay.stdout.readline().strip(), 1000000, chunk_delay=0)
+        self.addCleanup(transport.close)
+        transport.enter_raw_repl(soft_reset=True)
+        start = time.time()
+        stream = io.StringIO()
+        error = transport.exec_raw(u'import time\ntime.sleep_ms(200)\nprint(7)', stream,
+                                   timeout=5)
+        self.assertEqual((stream.getvalue(), error), (u'7\r\n', u''))
+        self.assertGreaterEqual(time.time() - start, 0.2)
+
+    def test_put_and_get(self):
+        tmp = tempfile.mkdtemp()
+        src, dest, back = [os.path.join(tmp, name) for name in ('src', 'dest', 'back')]
+        with open(src, 'wb') as f:
+            f.write(bytes(bytearray(range(256))) * 20)
+        self.assertEqual(files.put(self.transport, src, dest, chunk_size=1024,
+                                   compress=True).size, 5120)
+        self.assertTrue(files.put(self.transport, src, dest).skipped)
+        self.assertEqual(files.get(self.transport, dest, back).size, 5120)
+        with open(src, 'rb') as a, open(back, 'rb') as b:
+            self.assertEqual(a.read(), b.read())
+
+    def test_sync(self):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        src, dest = os.path.join(tmp, 'src'), os.path.join(tmp, 'board')
+        cache = sync.SyncCache(os.path.join(tmp, 'cache.json'))
+        write_tree(src, dict(('m{}.py'.format(i), b'x' * 3000 * i) for i in range(5)))
+        write_tree(src, {'lib/deep/a.py': b'a', 'lib/b.py': b'b'})
+        result = sync.sync(self.transport, src, dest, cache=cache, chunk_size=1024, compress=True)
+        self.assertEqual((len(result.uploaded), result.unchanged), (7, 0))
+        write_tree(dest, {'board_only.py': b''})
+        os.remove(os.path.join(src, 'lib', 'deep', 'a.py'))
+        write_tree(src, {'m2.py': b'changed', 'new.py': b'new'})
+        self.assertEqual(sync.sync(self.transport, src, dest, cache=cache,
+                                   dry_run=True).uploaded, ['m2.py', 'new.py'])
+        result = sync.sync(self.transport, src, dest, cache=cache, chunk_size=1024)
+        self.assertEqual((result.uploaded, result.deleted, result.unchanged),
+                         (['m2.py', 'new.py'], ['lib/deep/a.py'], 5))
+        for path in ['m4.py', 'm2.py', 'lib/b.py', 'new.py']:
+            self.assertEqual(files.local_hash(os.path.join(src, path)),
+                             files.local_hash(os.path.join(dest, path)))
+        self.assertFalse(os.path.exists(os.path.join(dest, 'lib', 'deep')))
+        self.assertTrue(os.path.exists(os.path.join(dest, 'board_only.py')))
+        result = sync.sync(self.transport, src, dest, cache=cache)
+        self.assertEqual((result.uploaded, result.deleted, result.unchanged), ([], [], 7))
+        # The second sync appended to the manifest, which reads the same
+        # without the cached copy
+        with open(os.path.join(dest, sync.MANIFEST)) as f:
+            manifest, token, lines = sync.parse_manifest(f.read())
+        self.assertEqual(lines, 8 + 4)
+        self.assertEqual(manifest, cache.manifests[token])
+        self.assertEqual(sync.remote_manifest(self.transport, dest, sync.SyncCache(
+            os.path.join(tmp, 'other.json')))[0], manifest)
+
+    def test_push_and_pull(self):
+        values = array.array('f', range(5000))
+        variables.push(self.transport, values, 'v', chunk_size=1024)
+        value, transfer = variables.pull(self.transport, 'v')
+        self.assertEqual(transfer.size, 20000)
+        self.assertEqual(list(value), list(values))
+        value, _ = variables.pull(self.transport, 'bytes(range(256))')
+        self.assertEqual(value, bytes(bytearray(range(256))))
+        self.assertRaises(RemoteError, variables.pull, self.transport, 'missing')
+        with self.assertRaises(RemoteError) as cm:
+            variables.pull(self.transport, 'v[0] + 1')
+        self.assertIn(u'TypeError: Cannot pull a float, only bytes', str(cm.exception))
+        stream = io.StringIO()
+        self.transport.exec_raw(u"print(len(v), '_mpk_pull' in globals())", stream, timeout=5)
+        self.assertEqual(stream.getvalue(), u'5000 False\r\n')
+
+    def test_telemetry(self):
+        record_format = telemetry.RecordFormat('<Hf')
+        received, text = [], []
+        stopped = telemetry.capture(
+            self.transport,
+            u'print(1)\ni = 0\nwhile True:\n    telemetry.write(i, i / 2)\n    i += 1\n',
+            record_format, text.append, received.append, lambda: None, records=1000)
+        self.assertTrue(stopped)
+        records = list(struct.iter_unpack('<Hf', b''.join(received)))
+        self.assertGreaterEqual(len(records), 1000)
+        self.assertEqual(records[:3], [(0, 0.0), (1, 0.5), (2, 1.0)])
+        self.assertEqual(u''.join(text), u'1\r\n')
+        stream = io.StringIO()
+        self.transport.exec_raw(u'print(i > 0)', stream, timeout=5)
+        self.assertEqual(stream.getvalue(), u'True\r\n')
+
+
+class TestBroker(unittest.TestCase):
+    """Kernels sharing a fake pyboard through a broker"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.board = FakePyboard(baudrate=1000000).start()
+        cls.tmp = tempfile.mkdtemp()
+        cls.broker = broker.Broker(os.path.join(cls.tmp, 'broker.sock'), idle_timeout=0)
+        cls.broker.listen()
+        thread = threading.Thread(target=cls.broker.serve)
+        thread.daemon = True
+        thread.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.broker.close()
+        cls.board.stop()
+        shutil.rmtree(cls.tmp)
+
+    def connect(self):
+        transport = broker.BrokerTransport(self.board.device, 1000000, self.broker.path,
+                                           chunk_delay=0)
+        self.addCleanup(transport.close)
+        return transport
+
+    def run_code(self, transport, code):
+        stream = io.StringIO()
+        error = transport.exec_raw(code, stream, timeout=5)
+        self.assertEqual(error, u'')
+        return stream.getvalue()
+
+    def test_messages(self):
+        data = broker.encode_message(broker.DATA, b'\x04>') + broker.encode_message(
+            broker.ACQUIRE, {'seq': 1, 'op': 'enter'})
+        parser = broker.MessageParser()
+        self.assertEqual(parser.feed(data[:7]), [(broker.DATA, b'\x04>')])
+        self.assertEqual(parser.feed(data[7:]), [(broker.ACQUIRE, b'{"seq": 1, "op": "enter"}')])
+
+    def test_shared_board(self):
+        a, b = self.connect(), self.connect()
+        self.run_code(a, u'shared = 42')
+        self.assertEqual(self.run_code(b, u'print(shared)'), u'42\r\n')
+        b.enter_raw_repl(soft_reset=True)
+        self.assertTrue(a.exec_raw(u'shared', io.StringIO(), timeout=5))
+
+    def test_turns(self):
+        a, b = self.connect(), self.connect()
+        self.run_code(a, u'turns = []')
+        a.exec_start(u'import time\ntime.sleep(0.3)\nturns.append("a")')
+        waiting = threading.Thread(target=self.run_code, args=(b, u'turns.append("b")'))
+        waiting.start()
+        time.sleep(0.1)
+        a.follow(io.StringIO())
+        # b asked first, so it runs before a's next exchange
+        self.run_code(a, u'turns.append("a")')
+        waiting.join()
+        self.assertEqual(self.run_code(a, u'print(turns)'), u"['a', 'b', 'a']\r\n")
+
+    def test_kernel_gone(self):
+        a, b = self.connect(), self.connect()
+        a.exec_start(u'while True:\n    pass\n')
+        time.sleep(0.1)
+        a.close()
+        self.assertEqual(self.run_code(b, u'print(1)'), u'1\r\n')
+
+    def test_interrupt(self):
+        transport = self.connect()
+        transport.exec_start(u'while True:\n    pass\n')
+        transport.interrupt()
+        self.assertFalse(transport.holding)
+        self.assertEqual(self.run_code(transport, u'print(2)'), u'2\r\n')
+
+    def test_put_and_get(self):
+        transport = self.connect()
+        src, dest, back = [os.path.join(self.tmp, name) for name in ('src', 'dest', 'back')]
+        with open(src, 'wb') as f:
+            f.write(bytes(bytearray(range(256))) * 20)
+        self.assertEqual(files.put(transport, src, dest, chunk_size=1024).size, 5120)
+        self.assertEqual(files.get(transport, dest, back).size, 5120)
+        with open(src, 'rb') as a, open(back, 'rb') as b:
+            self.assertEqual(a.read(), b.read())
+
+    def test_no_device(self):
+        self.assertRaises(TransportError, broker.BrokerTransport, '/dev/missing', 115200,
+                          self.broker.path)
+
+
+class TestWebReplTransport(unittest.TestCase):
+    """The WebREPL transport against a fake WebREPL on a local port"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.board = FakeWebRepl(password='secret').start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.board.stop()
+
+    def setUp(self):
+        self.transport = WebReplTransport(self.board.url, 'secret', chunk_delay=0)
+        self.addCleanup(self.transport.close)
+        self.transport.enter_raw_repl(soft_reset=True)
+
+    def test_exec_raw(self):
+        stream = io.StringIO()
+        error = self.transport.exec_raw(u'x = 6\nprint(x * 7)', stream, timeout=5)
+        self.assertEqual((stream.getvalue(), error), (u'42\r\n', u''))
+
+    def test_wrong_password(self):
+        self.assertRaises(TransportError, WebReplTransport, self.board.url, 'wrong')
+
+    def test_reconnect(self):
+        self.transport.exec_raw(u'x = 1', io.StringIO(), timeout=5)
+        self.transport.sock.shutdown(socket.SHUT_RDWR)
+        deadline = time.time() + 5
+        while self.transport.connected and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertFalse(self.transport.connected)
+        stream = io.StringIO()
+        self.transport.exec_raw(u'print(x)', stream, timeout=5)
+        self.assertEqual(stream.getvalue(), u'1\r\n')
+        self.assertEqual(self.transport.reconnects, 1)
+
+    def test_put_and_get(self):
+        tmp = tempfile.mkdtemp()
+        src, dest, back = [os.path.join(tmp, name) for name in ('src', 'dest', 'back')]
+        with open(src, 'wb') as f:
+            f.write(bytes(bytearray(range(256))) * 20)
+        self.assertEqual(files.put(self.transport, src, dest).size, 5120)
+        self.assertTrue(files.put(self.transport, src, dest).skipped)
+        self.assertEqual(files.get(self.transport, dest, back).size, 5120)
+        with open(src, 'rb') as a, open(back, 'rb') as b:
+            self.assertEqual(a.read(), b.read())
+        self.assertRaises(RemoteError, files.get, self.transport,
+                          os.path.join(tmp, 'missing'), back, force=True)
+
+    def test_sync(self):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        src, dest = os.path.join(tmp, 'src'), os.path.join(tmp, 'board')
+        cache = sync.SyncCache(os.path.join(tmp, 'cache.json'))
+        write_tree(src, {'main.py': b'1' * 3000, 'lib/a.py': b'2'})
+        self.assertEqual(len(sync.sync(self.transport, src, dest, cache=cache).uploaded), 2)
+        os.remove(os.path.join(src, 'lib', 'a.py'))
+        result = sync.sync(self.transport, src, dest, cache=cache)
+        self.assertEqual((result.uploaded, result.deleted), ([], ['lib/a.py']))
+        self.assertEqual(sorted(os.listdir(dest)), [sync.MANIFEST, 'main.py'])
@@ -8,9 +8,29 @@ test_unix
 Tests for `unix` module.
 """
 
+import io
+import os
+import sys
+import json
+import shutil
+import tempfile
+import subprocess
+import time
+import logging
 import unittest
 
+from jupyter_client import KernelManager
+from jupyter_client.kernelspec import KernelSpecManager
+from pexpect import spawn, EOF
+from tornado.ioloop import IOLoop
+
 import unix
+from mpkernel import capture, heap, mprof, parallel, timeit
+from mpkernel.pipeline import Pipeline
+from mpkernel.repl import RawReplReader, RecordFilter, fix_traceback
+from unix.unix import (PromptReader, InterpreterPool, MPKernelUnix, MPUnixInterpreter,
+                       magic_name)
+from tests import fake_micropython
 
 
 class TestUnix(unittest.TestCase):
@@ -23,3 +43,414 @@ class TestUnix(unittest.TestCase):
 
     def tearDown(self):
         pass
+
+
+class TestMagicName(unittest.TestCase):
+
+    def test_whole_name(self):
+        self.assertEqual(magic_name(u'  %timeit -n 5 x = 1'), u'%timeit')
+        self.assertEqual(magic_name(u'%%timeit\nx = 1'), u'%%timeit')
+        self.assertEqual(magic_name(u'%timeitfoo x'), u'%timeitfoo')
+        self.assertEqual(magic_name(u'%%timeit_x\nx = 1'), u'%%timeit_x')
+        self.assertEqual(magic_name(u'%memtrace\nbody'), u'%memtrace')
+        self.assertIsNone(magic_name(u'x = 1'))
+
+
+class TestPromptReader(unittest.TestCase):
+
+    def setUp(self):
+        self.reader = PromptReader('>>> ', '... ', echo='exec(c)\r\n')
+
+    def test_echo_and_prompt_removed(self):
+        out = self.reader.feed(u'exec(c)\r\nhello\r\n>>> ')
+        self.assertEqual(out, u'hello\r\n')
+        self.assertTrue(self.reader.done)
+        self.assertFalse(self.reader.incomplete)
+
+    def test_split_reads(self):
+        out = u''
+        for chunk in (u'exe', u'c(c)\r', u'\nab', u'c\r\n>', u'>> '):
+            out += self.reader.feed(chunk)
+        self.assertEqual(out, u'abc\r\n')
+        self.assertTrue(self.reader.done)
+
+    def test_prompt_inside_line_is_output(self):
+        out = self.reader.feed(u'exec(c)\r\nx >>> ')
+        self.assertFalse(self.reader.done)
+        out += self.reader.feed(u'y\r\n>>> ')
+        self.assertEqual(out, u'x >>> y\r\n')
+
+    def test_continuation(self):
+        self.reader.feed(u'exec(c)\r\n... ')
+        self.assertTrue(self.reader.done)
+        self.assertTrue(self.reader.incomplete)
+
+
+class FakeChild(object):
+
+    def __init__(self, alive=True):
+        self.alive = alive
+        self.closed = False
+
+    def isalive(self):
+        return self.alive
+
+    def close(self, force=False):
+        self.closed = True
+
+
+class FakeInterpreter(object):
+
+    def __init__(self, alive=True):
+        self.child = FakeChild(alive)
+
+
+class TestInterpreterPool(unittest.TestCase):
+
+    def wait_for(self, pool, count):
+        deadline = time.time() + 5
+        while len(pool._ready) < count and time.time() < deadline:
+            time.sleep(0.01)
+
+    def test_fill_and_get(self):
+        pool = InterpreterPool(FakeInterpreter, size=2)
+        pool.fill()
+        self.wait_for(pool, 2)
+        self.assertIsInstance(pool.get(), FakeInterpreter)
+        # The pool is refilled in the background
+        self.wait_for(pool, 2)
+        self.assertEqual(len(pool._ready), 2)
+
+    def test_dead_spares_are_skipped(self):
+        dead = FakeInterpreter(alive=False)
+        pool = InterpreterPool(FakeInterpreter, size=0)
+        pool._ready.append(dead)
+        self.assertIsNone(pool.get())
+        self.assertTrue(dead.child.closed)
+
+    def test_close(self):
+        pool = InterpreterPool(FakeInterpreter, size=1)
+        pool.fill()
+        self.wait_for(pool, 1)
+        spare = pool._ready[0]
+        pool.close()
+        self.assertTrue(spare.child.closed)
+        self.assertIsNone(pool.get())
+
+
+class TestRestart(unittest.TestCase):
+    """MPKernelUnix.restart_interpreter against the stand-in"""
+
+    def kernel(self, **options):
+        kernel = MPKernelUnix(micropython_exe=fake_micropython.command(**options),
+                              pool_size=0, log=logging.getLogger(__name__))
+        self.addCleanup(kernel.do_shutdown, False)
+        kernel.cell_log.record(u'x = [1]')
+        return kernel
+
+    def test_soft_reset_at_the_normal_prompt_keeps_the_log(self):
+        kernel = self.kernel(raw=False)
+        kernel.interpreter.run_command(u'x = [1]')
+        how = kernel.restart_interpreter()
+        self.assertTrue(how.startswith(u'soft reset'))
+        self.assertNotIn(u'%restore', how)
+        self.assertEqual((len(kernel.cell_log), len(kernel.lost_cells)), (1, 0))
+        self.assertIn(u'[1]', kernel.interpreter.run_command(u'print(x)'))
+
+    def test_soft_reboot_in_the_raw_repl_loses_the_log(self):
+        kernel = self.kernel()
+        how = kernel.restart_interpreter()
+        self.assertTrue(how.startswith(u'soft reset'))
+        self.assertIn(u'run %restore to replay 1 cells', how)
+        self.assertEqual((len(kernel.cell_log), len(kernel.lost_cells)), (0, 1))
+
+    def test_raw_repl_probed_once(self):
+        kernel = self.kernel(raw=False)
+        self.assertFalse(kernel.interpreter.raw)
+        kernel.interpreter.child.close(force=True)
+        start = time.time()
+        how = kernel.restart_interpreter()
+        self.assertTrue(how.startswith(u'started a new interpreter'))
+        self.assertLess(time.time() - start, 0.9)
+        self.assertFalse(kernel.interpreter.raw)
+        self.assertIn(u'42', kernel.interpreter.run_command(u'6 * 7'))
+
+
+class TestFollowAsync(unittest.TestCase):
+
+    def interpreter(self, script):
+        # Only the child is needed to follow output
+        interp = MPUnixInterpreter.__new__(MPUnixInterpreter)
+        interp.child = spawn(sys.executable, ['-c', script], echo=False,
+                             encoding='utf-8')
+        interp._pushback = u''
+        self.addCleanup(interp.child.close, True)
+        return interp
+
+    def test_reply(self):
+        interp = self.interpreter(
+            "import time, sys\n"
+            "print('a', flush=True)\n"
+            "time.sleep(0.2)\n"
+            "sys.stdout.write('b\\x04err\\x04>')\n"
+            "time.sleep(1)")
+        reader = RawReplReader()
+        stream = io.StringIO()
+        ticks = []
+        IOLoop.current().call_later(0.1, lambda: ticks.append(stream.getvalue()))
+        IOLoop.current().run_sync(lambda: interp.follow_async(reader, stream), timeout=5)
+        self.assertEqual(ticks, [u'a\r\n'])
+        self.assertEqual(stream.getvalue(), u'a\r\nb')
+        self.assertEqual(reader.error, u'err')
+
+    def test_exit(self):
+        interp = self.interpreter("print('a')")
+        with self.assertRaises(EOF):
+            IOLoop.current().run_sync(
+                lambda: interp.follow_async(RawReplReader(), io.StringIO()), timeout=5)
+
+
+class TestFakeMicropython(unittest.TestCase):
+    """The interpreter against the stand-in micropython REPL"""
+
+    def interpreter(self, **options):
+        interp = MPUnixInterpreter(fake_micropython.command(**options))
+        self.addCleanup(interp.child.close, True)
+        return interp
+
+    def test_raw_repl(self):
+        interp = self.interpreter()
+        self.assertTrue(interp.enter_raw_repl())
+        stream = io.StringIO()
+        self.assertEqual(interp.exec_raw('x = 6\nprint(x * 7)', stream), u'')
+        self.assertEqual(stream.getvalue(), u'42\r\n')
+        self.assertTrue(interp.raw_paste)
+        self.assertTrue(interp.soft_reset())
+        error = interp.exec_raw('x', io.StringIO())
+        self.assertTrue(error.endswith(u"NameError: name 'x' is not defined\r\n"))
+
+    def test_normal_prompt(self):
+        interp = self.interpreter(raw=False)
+        self.assertFalse(interp.enter_raw_repl())
+        self.assertEqual(interp.run_command('6 * 7').splitlines()[-1], u'42')
+
+    def test_interrupt(self):
+        interp = self.interpreter()
+        interp.enter_raw_repl()
+        interp.send_raw('while True:\n    pass\n', timeout=5)
+        reader = RawReplReader()
+        IOLoop.current().call_later(0.1, interp.child.sendintr)
+        IOLoop.current().run_sync(lambda: interp.follow_async(reader, io.StringIO()), timeout=5)
+        self.assertIn(u'KeyboardInterrupt', reader.error)
+
+    def test_pipeline(self):
+        interp = self.interpreter()
+        interp.enter_raw_repl()
+        pipeline = Pipeline([('a', 'x = 6\nprint(x)'), ('b', 'print(x * 7)'),
+                             ('c', '1/0'), ('d', 'print("not run")')])
+        interp.send_raw(pipeline.program(), timeout=5)
+        outputs, reader = [], None
+        while reader is None or not reader.error:
+            reader = pipeline.reader()
+            stream = io.StringIO()
+            IOLoop.current().run_sync(lambda: interp.follow_async(reader, stream), timeout=5)
+            if not getattr(reader, 'ended', True):
+                interp.unread(reader.rest)
+            outputs.append(stream.getvalue())
+        self.assertEqual(outputs, [u'6\r\n', u'42\r\n', u''])
+        error = fix_traceback(reader.error)
+        self.assertNotIn(u'<string>', error)
+        self.assertTrue(error.endswith(u'ZeroDivisionError: division by zero\r\n'))
+        stream = io.StringIO()
+        interp.exec_raw('print(x)', stream)
+        self.assertEqual(stream.getvalue(), u'6\r\n')
+
+    def test_heap_probe(self):
+        interp = self.interpreter()
+        interp.enter_raw_repl()
+        probe = heap.HeapFilter(io.StringIO())
+        interp.send_raw(heap.probe('x = bytearray(100000)\nprint(len(x))'), timeout=5)
+        IOLoop.current().run_sync(lambda: interp.follow_async(RawReplReader(), probe), timeout=5)
+        probe.close()
+        self.assertEqual(probe.stream.getvalue(), u'100000\r\n')
+        self.assertGreaterEqual(probe.usage.kept, 100000)
+        self.assertIsNotNone(probe.usage.fragmentation)
+        error = fix_traceback(interp.exec_raw(heap.probe('1/0'), io.StringIO()))
+        self.assertNotIn(u'<string>', error)
+        self.assertTrue(error.endswith(u'ZeroDivisionError: division by zero\r\n'))
+
+    def test_parallel_worker(self):
+        interp = MPUnixInterpreter(fake_micropython.command() + ' -X heapsize=1M')
+        self.addCleanup(interp.child.close, True)
+        interp.enter_raw_repl()
+        stream = io.StringIO()
+        self.assertEqual(interp.exec_raw('import micropython\nmicropython.mem_info()', stream), u'')
+        self.assertIn(u'total: 1048576,', stream.getvalue())
+        stream = io.StringIO()
+        self.assertEqual(
+            interp.exec_raw(parallel.INPUTS.format(expression='range(3)'), stream), u'')
+        run = parallel.ParallelRun('x', parallel.parse_inputs(stream.getvalue()))
+        interp.exec_raw(parallel.SETUP.format(cell='print(x)\nresult = x * x'), io.StringIO())
+        for index in iter(run.take, None):
+            stream = io.StringIO()
+            error = interp.exec_raw(run.program(index), stream)
+            run.finish(index, stream.getvalue(), error)
+        self.assertEqual(run.ready(), u'0\r\n1\r\n2\r\n')
+        self.assertEqual(run.results_program('r'), 'r = [0, 1, 4]\n')
+
+    def test_mprof(self):
+        interp = self.interpreter()
+        interp.enter_raw_repl()
+        instrumented = mprof.Instrumented(u'def sq(x):\n    return x * x\n'
+                                          u'for i in range(50):\n    sq(i)\nprint(sq(3))\n1/0\n')
+        probe = RecordFilter(io.StringIO(), mprof.MARKER, mprof.END)
+        error = interp.exec_raw(instrumented.program(), probe)
+        probe.close()
+        self.assertEqual(probe.stream.getvalue(), u'9\r\n')
+        hits = dict((lineno, hits) for lineno, _, hits, _ in
+                    instrumented.profile(probe.record).rows('line'))
+        self.assertEqual(hits, {1: 1, 2: 51, 3: 1, 4: 50, 5: 1, 6: 1})
+        error = instrumented.fix_traceback(fix_traceback(error))
+        self.assertIn(u'File "<stdin>", line 6, in <module>', error)
+        stream = io.StringIO()
+        self.assertEqual(interp.exec_raw('print(sq(4))', stream), u'')
+        self.assertEqual(stream.getvalue(), u'16\r\n')
+
+    def test_timeit(self):
+        interp = self.interpreter()
+        interp.enter_raw_repl()
+        timing = timeit.Timeit(u'-r 3 -t 0.01 l = [3, 1, 2]', u'l.sort()\n')
+        probe = RecordFilter(io.StringIO(), timeit.MARKER, timeit.END)
+        self.assertEqual(interp.exec_raw(timing.source, probe), u'')
+        probe.close()
+        self.assertEqual(probe.stream.getvalue(), u'')
+        result = timing.result(probe.record)
+        self.assertEqual(len(result.timings), 3)
+        self.assertGreaterEqual(result.loops, 2)
+        timing = timeit.Timeit(u'-n 1 -r 1 x = 1', u'\nx / 0')
+        error = timing.fix_traceback(interp.exec_raw(timing.source, io.StringIO()))
+        self.assertIn(u'File "<stdin>", line 3, in <module>', error)
+        self.assertIsNone(timing.result(probe.stream.getvalue()))
+
+    def test_capture_replay(self):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        path = os.path.join(tmp, 'unix.mpkcap')
+        recorder = capture.Capture(path, u'spawn fake')
+        interp = MPUnixInterpreter(fake_micropython.command(), capture=recorder)
+        self.addCleanup(interp.child.close, True)
+        interp.enter_raw_repl()
+        recorder.note(u'cell 1')
+        outputs = []
+        for code in ('import time\ntime.sleep_ms(300)\nprint(1)', 'print(2)'):
+            stream = io.StringIO()
+            self.assertEqual(interp.exec_raw(code, stream), u'')
+            outputs.append(stream.getvalue())
+        interp.child.close(True)
+        records = capture.load(path)
+        self.assertIn(capture.READ, [r.kind for r in records])
+        cell = capture.summary(records)[-2]
+        self.assertEqual(cell.name, u'cell 1')
+        self.assertGreaterEqual(cell.waiting + cell.running, 0.3)
+
+        replay = MPUnixInterpreter('{} -m mpkernel.capture replay {}'.format(sys.executable, path))
+        self.addCleanup(replay.child.close, True)
+        self.assertTrue(replay.enter_raw_repl())
+        start = time.time()
+        stream = io.StringIO()
+        self.assertEqual(replay.exec_raw('import time\ntime.sleep_ms(300)\nprint(1)', stream), u'')
+        self.assertGreaterEqual(time.time() - start, 0.3)
+        self.assertEqual(stream.getvalue(), outputs[0])
+        stream = io.StringIO()
+        self.assertEqual(replay.exec_raw('print(2)', stream), u'')
+        self.assertEqual(stream.getvalue(), outputs[1])
+
+
+class TestKernel(unittest.TestCase):
+    """MPKernelUnix run through jupyter_client against the stand-in"""
+
+    def kernel(self, *options, **fake):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        os.makedirs(os.path.join(tmp, 'mpkernel-test'))
+        argv = [sys.executable, '-m', 'unix', '-f', '{connection_file}',
+                '--MPKernelUnix.micropython_exe=' + fake_micropython.command(**fake),
+                '--MPKernelUnix.output_log_dir=' + os.path.join(tmp, 'output')]
+        with open(os.path.join(tmp, 'mpkernel-test', 'kernel.json'), 'w') as f:
+            json.dump({'argv': argv + list(options), 'display_name': 'mpkernel-test',
+                       'language': 'python', 'interrupt_mode': 'message'}, f)
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        km = KernelManager(kernel_name='mpkernel-test',
+                           kernel_spec_manager=KernelSpecManager(kernel_dirs=[tmp]))
+        km.start_kernel(cwd=root, env=dict(os.environ, PYTHONPATH=root),
+                        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        self.addCleanup(km.shutdown_kernel, now=True)
+        kc = km.client()
+        kc.start_channels()
+        self.addCleanup(kc.stop_channels)
+        kc.wait_for_ready(timeout=60)
+        return km, kc
+
+    def run_cell(self, kc, code, **options):
+        """Return the reply content and the stdout of a cell"""
+        out = []
+
+        def output(msg):
+            if msg['msg_type'] == 'stream':
+                out.append(msg['content']['text'])
+        reply = kc.execute_interactive(code, output_hook=output, timeout=30, **options)
+        return reply['content'], u''.join(out)
+
+    def reply(self, kc, msg_id, channel='shell', timeout=10):
+        while True:
+            reply = getattr(kc, 'get_{}_msg'.format(channel))(timeout=timeout)
+            if reply['parent_header'].get('msg_id') == msg_id:
+                return reply['content']
+
+    def test_requests_while_a_cell_runs(self):
+        km, kc = self.kernel()
+        self.run_cell(kc, u'value = 1')
+        # Completions come from the names cached before the cell started
+        self.assertIn(u'value', self.reply(kc, kc.complete(u'val', 3))['matches'])
+        # The cells that follow an error are otherwise aborted for a moment
+        running = kc.execute(u'while True:\n    pass', stop_on_error=False)
+        time.sleep(0.5)
+        start = time.time()
+        content = self.reply(kc, kc.complete(u'val', 3))
+        self.assertLess(time.time() - start, 5)
+        self.assertEqual(content['status'], u'ok')
+        self.assertIn(u'value', content['matches'])
+        msg = kc.session.msg('interrupt_request', {})
+        kc.control_channel.send(msg)
+        self.assertEqual(self.reply(kc, msg['header']['msg_id'], 'control')['status'], u'ok')
+        content = self.reply(kc, running)
+        self.assertEqual(content['status'], u'error')
+        self.assertEqual(content['ename'], u'KeyboardInterrupt')
+        self.assertEqual(self.run_cell(kc, u'print(value + 1)')[1], u'2\r\n')
+
+    def test_queued_cells_are_pipelined(self):
+        km, kc = self.kernel('--MPKernelUnix.pipeline_cells=8')
+        ids = [kc.execute(u'print({})'.format(i)) for i in range(4)]
+        for msg_id in ids:
+            self.assertEqual(self.reply(kc, msg_id)['status'], u'ok')
+        self.assertEqual(self.run_cell(kc, u'print(5)'), (
+            {'status': 'ok', 'execution_count': 5, 'payload': [], 'user_expressions': {}},
+            u'5\r\n'))
+
+    def test_restore_after_a_restart(self):
+        for raw in (True, False):
+            with self.subTest(raw=raw):
+                km, kc = self.kernel(raw=raw)
+                self.run_cell(kc, u'x = []')
+                self.run_cell(kc, u'x.append(1)')
+                content, out = self.run_cell(kc, u'1/0', stop_on_error=False)
+                # At the normal prompt the traceback is part of the output
+                self.assertIn(u'ZeroDivisionError', content['ename'] if raw else out)
+                content, out = self.run_cell(kc, u'import sys\nsys.exit()', stop_on_error=False)
+                self.assertEqual(content['status'], u'error')
+                self.assertIn(u'run %restore to replay 2 cells', out)
+                content, out = self.run_cell(kc, u'%restore')
+                self.assertEqual(content['status'], u'ok')
+                self.assertIn(u'Restored 2 of 2 cells', out)
+                self.assertNotIn(u'failed', out)
+                self.assertEqual(self.run_cell(kc, u'print(x)')[1], u'[1]\r\n')
@@ -1,30 +1,154 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 from __future__ import print_function
+import io
 import os
 import sys
+import time
+import uuid
+import struct
 import signal
-from tornado.ioloop import IOLoop
+import asyncio
+import inspect
+import contextvars
+import threading
+import collections
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop, PeriodicCallback
 from ipykernel.kernelbase import Kernel
-from pexpect import replwrap, EOF
+from pexpect import replwrap, spawn, EOF, TIMEOUT
+from mpkernel import mpy
+from mpkernel.complete import NamespaceCache
+from mpkernel.magics import MagicError, split_magic
+from mpkernel.metrics import CellTimer, Metrics, seconds_since
+from mpkernel.repl import (OutputLimit, OutputStream, RawReplReader, RecordFilter,
+                           fix_traceback, split_exception)
+from mpkernel.replay import CellLog
+from mpkernel.startup import background
+# The modules of optional features (capture, heap, mprof, parallel,
+# pipeline, timeit) are imported when they are first used
 
 __version__ = '0.2'
 
 try:
-    from traitlets import Unicode
+    from traitlets import Unicode, Bool, Float, Integer
 except ImportError:
-    from IPython.utils.traitlets import Unicode
+    from IPython.utils.traitlets import Unicode, Bool, Float, Integer
+
+# ipykernel 7 runs each shell message through shell_main, under a lock held
+# while a cell runs, and can dispatch one alongside it. Otherwise requests
+# wait for the running cell as usual.
+CONCURRENT_DISPATCH = (hasattr(Kernel, 'shell_main') and 'concurrent' in
+                       inspect.signature(Kernel.dispatch_shell).parameters)
+
+
+def magic_name(code):
+    """Return the ``%name`` or ``%%name`` a cell starts with, None if it is
+    not a magic"""
+    try:
+        magic = split_magic(code)
+    except MagicError:
+        # A line magic given a body, which its handler reports
+        magic = split_magic(code.lstrip().partition('\n')[0])
+    if magic is None:
+        return None
+    return ('%%' if code.lstrip().startswith('%%') else '%') + magic[0]
+
+
+# What the normal prompt prints before the traceback of an error
+TRACEBACK = u'Traceback (most recent call last):'
+
+
+class PromptReader(object):
+    """
+    Incrementally separate command output from the prompt that follows it
+
+    The echo of the command is dropped, and text at the start of a line that
+    could still turn out to be a prompt is held back, so :meth:`feed` only
+    ever returns text that belongs to the command. ``failed`` is set once
+    that text includes a traceback.
+    """
+    def __init__(self, prompt, continuation_prompt, echo=''):
+        self.prompts = (prompt, continuation_prompt)
+        self.echo = echo
+        self.done = False
+        self.incomplete = False
+        self.failed = False
+        self._tail = u''
+        self._line_start = True
+        # The end of the output returned so far, to find a traceback split
+        # between reads
+        self._seen = u''
+
+    def _held(self, text):
+        """Return how much of the end of ``text`` may be the start of a prompt"""
+        line = text[text.rfind('\n') + 1:]
+        if len(line) == len(text) and not self._line_start:
+            return 0
+        for prompt in self.prompts:
+            if prompt.startswith(line):
+                return len(line)
+        return 0
+
+    def feed(self, data):
+        """Consume ``data`` and return the output that is safe to emit"""
+        out = self._feed(data)
+        seen = self._seen + out
+        self.failed = self.failed or TRACEBACK in seen
+        self._seen = seen[-len(TRACEBACK):]
+        return out
+
+    def _feed(self, data):
+        text = self._tail + data
+        if self.echo:
+            if len(text) < len(self.echo) and self.echo.startswith(text):
+                self._tail = text
+                return u''
+            if text.startswith(self.echo):
+                text = text[len(self.echo):]
+            self.echo = ''
+        held = self._held(text)
+        line = text[len(text) - held:]
+        if held and line in self.prompts:
+            self.done = True
+            self.incomplete = line == self.prompts[1]
+            self._tail = u''
+            return text[:-held]
+        self._tail = line
+        out = text[:len(text) - held]
+        if out:
+            self._line_start = out.endswith('\n')
+        return out
 
 
 class MPUnixInterpreter(replwrap.REPLWrapper):
     """
     Extension of replwrap to micropython for the unix port
     """
-    def __init__(self, cmd, **kw):
+    raw_banner = 'raw REPL; CTRL-B to exit\r*\n>'
+
+    def __init__(self, cmd, capture=None, **kw):
         self.prompt = '>>> '
         self.buffer = []
         self.output = ''
-        super(MPUnixInterpreter, self).__init__(cmd, self.prompt, None, **kw)
+        # Set once the interpreter has been switched to the raw REPL
+        self.raw = False
+        # Whether the raw REPL supports raw-paste mode, None until it is tried
+        self.raw_paste = None
+        self._pushback = u''
+        # Raw-paste flow control bytes are not valid utf-8. The SIGINT
+        # handler is reset in the child since spawning may happen off the
+        # main thread, where the kernel cannot change it around the fork.
+        child = spawn(cmd, echo=False, encoding='utf-8',
+                      codec_errors='surrogateescape',
+                      preexec_fn=lambda: signal.signal(signal.SIGINT, signal.SIG_DFL))
+        # A :class:`~mpkernel.capture.Capture` of everything read from and
+        # written to the interpreter, from its banner on
+        self.capture = capture
+        if capture is not None:
+            child.logfile_read = capture.reads
+            child.logfile_send = capture.writes
+        super(MPUnixInterpreter, self).__init__(child, self.prompt, None, **kw)
 
     def run_command(self, command, timeout=-1):
         """Send a command to the REPL, wait for and return output.
@@ -61,6 +185,332 @@ class MPUnixInterpreter(replwrap.REPLWrapper):
                              + command)
         return u''.join(res + [self.child.before])
 
+    def stream_command(self, command, stream, timeout=-1, interval=0.05):
+        """Send a command to the REPL and write its output to ``stream`` as it arrives.
+
+        :param str command: A single line of input that will trigger execution.
+        :param stream: An object with ``write`` and ``flush`` methods, usually
+          an :class:`OutputStream`. ``flush`` is called whenever the child has
+          been quiet for ``interval`` seconds.
+        :param int timeout: How long to wait without receiving any output.
+          -1 means the default from the :class:`pexpect.spawn` object, None
+          means to wait indefinitely.
+        :param float interval: How long a single read waits for data.
+        """
+        reader = self.send_line(command)
+        self._follow(reader, stream, timeout, interval)
+        self.check_complete(reader, command)
+
+    def send_line(self, command):
+        """Send a line to the REPL and return the reader for its output"""
+        reader = PromptReader(self.prompt, self.continuation_prompt,
+                              echo=command + '\r\n')
+        self.child.sendline(command)
+        return reader
+
+    def check_complete(self, reader, command):
+        """Raise ValueError, once the REPL is idle again, if ``command`` was
+        left waiting for more input"""
+        if reader.incomplete:
+            self.child.kill(signal.SIGINT)
+            self._expect_prompt(timeout=1)
+            raise ValueError("Continuation prompt found - input was incomplete:\n"
+                             + command)
+
+    def _follow(self, reader, stream, timeout=-1, interval=0.05):
+        """Feed the child's output to ``reader`` until it is done"""
+        if timeout == -1:
+            timeout = self.child.timeout
+        last_read = time.time()
+        while not reader.done:
+            try:
+                data = self._read(self.child.maxread, interval)
+            except TIMEOUT:
+                stream.flush()
+                if timeout is not None and time.time() - last_read > timeout:
+                    raise TIMEOUT("No output from the interpreter in %s seconds"
+                                  % timeout)
+                continue
+            last_read = time.time()
+            stream.write(reader.feed(data))
+        stream.flush()
+
+    def follow_async(self, reader, stream, interval=0.05):
+        """Feed the child's output to ``reader`` from the IOLoop until it is done.
+
+        The child's file descriptor is watched by the current IOLoop, so other
+        messages are served while a command runs, and there is no timeout.
+
+        :return: A Future that resolves once ``reader`` is done, or fails with
+          :class:`pexpect.EOF` if the child exits.
+        """
+        loop = IOLoop.current()
+        future = Future()
+        fd = self.child.child_fd
+        flusher = PeriodicCallback(stream.flush, interval * 1000)
+
+        def finish(error=None):
+            loop.remove_handler(fd)
+            flusher.stop()
+            stream.flush()
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(None)
+
+        def on_readable(fd, events):
+            if future.done():
+                return
+            try:
+                while not reader.done:
+                    stream.write(reader.feed(self._read(self.child.maxread, 0)))
+            except TIMEOUT:
+                return
+            except EOF as e:
+                finish(e)
+                return
+            finish()
+
+        loop.add_handler(fd, on_readable, IOLoop.READ | IOLoop.ERROR)
+        flusher.start()
+        if self._pushback:
+            loop.add_callback(on_readable, fd, IOLoop.READ)
+        return future
+
+    def enter_raw_repl(self, timeout=1):
+        """Switch the interpreter to the raw REPL (Ctrl-A).
+
+        Returns False, leaving the interpreter at the normal prompt, if it
+        does not answer with the raw REPL banner within ``timeout`` seconds.
+        """
+        self.child.send('\x01')
+        try:
+            self.child.expect(self.raw_banner, timeout=timeout)
+        except TIMEOUT:
+            # Most likely taken as a line editing key, discard the line
+            self.child.send('\x03')
+            self._expect_prompt(timeout=timeout)
+            return False
+        self.raw = True
+        return True
+
+    def exit_raw_repl(self):
+        """Return from the raw REPL to the normal prompt (Ctrl-B)"""
+        self.child.send('\x02')
+        self._expect_prompt()
+        self.raw = False
+
+    def soft_reset(self, timeout=1):
+        """Bring a live interpreter back to an idle prompt without respawning it.
+
+        Ctrl-C interrupts whatever is running. In the raw REPL a Ctrl-D then
+        soft reboots the interpreter, which also clears its state; the normal
+        prompt keeps its state, since Ctrl-D would exit the unix port there.
+
+        :return: False if the interpreter is not alive or did not respond
+          within ``timeout`` seconds.
+        """
+        if not self.child.isalive():
+            return False
+        self._pushback = u''
+        delay, self.child.delaybeforesend = self.child.delaybeforesend, None
+        try:
+            self.child.send('\r\x03\x03')
+            self._drain(0.05)
+            if self.raw:
+                self.child.send('\r\x01')
+                self.child.expect(self.raw_banner, timeout=timeout)
+                self.child.send('\x04')
+                self.child.expect_exact('soft reboot', timeout=timeout)
+                self.child.expect(self.raw_banner, timeout=timeout)
+            else:
+                self.child.send('\x03')
+                self._expect_prompt(timeout=timeout)
+                self._drain(0.05)
+        except (TIMEOUT, EOF):
+            return False
+        finally:
+            self.child.delaybeforesend = delay
+        return True
+
+    def _drain(self, timeout):
+        """Discard output until the child has been quiet for ``timeout`` seconds"""
+        try:
+            while True:
+                self.child.read_nonblocking(self.child.maxread, timeout)
+        except TIMEOUT:
+            pass
+        self.child.buffer = self.child.string_type()
+
+    def interrupt(self):
+        """Interrupt the running command and wait until the REPL is ready again"""
+        self.child.sendintr()
+        if self.raw:
+            self._pushback = u''
+            self.child.expect_exact('\x04>')
+        else:
+            self._expect_prompt()
+
+    def unread(self, data):
+        """Return ``data`` to the front of the output"""
+        self._pushback = data + self._pushback
+
+    def _read(self, size, timeout):
+        """Read up to ``size`` characters, starting with any pushed back"""
+        if self._pushback:
+            data = self._pushback[:size]
+            self._pushback = self._pushback[size:]
+            return data
+        return self.child.read_nonblocking(size, timeout)
+
+    def _read_until(self, marker, timeout):
+        """Read up to and including ``marker``, keeping what follows it"""
+        data = u''
+        while marker not in data:
+            data += self._read(self.child.maxread, timeout)
+        end = data.index(marker) + len(marker)
+        self._pushback = data[end:] + self._pushback
+        return data[:end]
+
+    def _send_bytes(self, data):
+        self.child.send(data.decode('utf-8', 'surrogateescape'))
+
+    def _read_bytes(self, size, timeout):
+        data = b''
+        while len(data) < size:
+            data += self._read(size - len(data), timeout).encode(
+                'utf-8', 'surrogateescape')
+        return data
+
+    def _raw_paste_write(self, data, timeout):
+        """Send ``data`` in raw-paste mode, False if that is not supported"""
+        self.child.send('\x05A\x01')
+        reply = self._read_bytes(2, timeout)
+        if reply != b'R\x01':
+            if reply != b'R\x00':
+                # Taken as the start of a normal raw REPL command
+                self._read_until('CTRL-B to exit', timeout)
+                self._read_until('>', timeout)
+            self.raw_paste = False
+            return False
+        self.raw_paste = True
+        window = struct.unpack('<H', self._read_bytes(2, timeout))[0]
+        remaining = window
+        i = 0
+        while i < len(data):
+            # The device sends \x01 each time it has room for another window
+            while remaining == 0:
+                flow = self._read_bytes(1, timeout)
+                if flow == b'\x01':
+                    remaining += window
+                elif flow == b'\x04':
+                    # The device gave up on the command (e.g. a syntax error)
+                    self.child.send('\x04')
+                    return True
+                else:
+                    raise ValueError("Unexpected data during raw paste: %r" % flow)
+            chunk = data[i:i + remaining]
+            self._send_bytes(chunk)
+            remaining -= len(chunk)
+            i += len(chunk)
+        self.child.send('\x04')
+        self._read_until('\x04', timeout)
+        return True
+
+    def exec_raw(self, command, stream, timeout=-1, interval=0.05,
+                 chunk_size=256):
+        """Run a command in the raw REPL in a single exchange.
+
+        The command is sent in raw-paste mode, which has flow control, if the
+        interpreter supports it, or otherwise in ``chunk_size`` writes
+        terminated by Ctrl-D. Output is written to ``stream`` as it arrives.
+
+        :param str command: The source to run, of any size.
+        :param stream: An object with ``write`` and ``flush`` methods.
+        :param int timeout: How long to wait without receiving any output.
+        :param float interval: How long a single read waits for data.
+        :return: The exception message, an empty string if there was none.
+        """
+        self.send_raw(command, self.child.timeout if timeout == -1 else timeout,
+                      chunk_size)
+        reader = RawReplReader()
+        self._follow(reader, stream, timeout, interval)
+        return reader.error
+
+    def send_raw(self, command, timeout=None, chunk_size=256):
+        """Send a command to the raw REPL and return once it has started,
+        see :meth:`exec_raw`"""
+        if not self.raw:
+            raise ValueError("The interpreter is not in the raw REPL")
+        write_timeout = timeout
+        data = command.encode('utf-8')
+        # The raw REPL does not switch terminal modes, so the delay pexpect
+        # leaves before each send is only a cost here
+        delay, self.child.delaybeforesend = self.child.delaybeforesend, None
+        try:
+            if (self.raw_paste is False or
+                    not self._raw_paste_write(data, write_timeout)):
+                for i in range(0, len(data), chunk_size):
+                    self._send_bytes(data[i:i + chunk_size])
+                self.child.send('\x04')
+                self._read_until('OK', write_timeout)
+        finally:
+            self.child.delaybeforesend = delay
+
+
+class InterpreterPool(object):
+    """
+    Spare interpreters, started in the background, to swap in on a restart
+
+    ``factory`` is called in a worker thread and should return an interpreter
+    that is ready to run a command.
+    """
+    def __init__(self, factory, size=1, log=None):
+        self.factory = factory
+        self.size = size
+        self.log = log
+        self._ready = collections.deque()
+        self._starting = 0
+        self._lock = threading.Lock()
+
+    def fill(self):
+        """Start as many interpreters as are missing from the pool"""
+        with self._lock:
+            missing = self.size - len(self._ready) - self._starting
+            self._starting += max(missing, 0)
+        for _ in range(missing):
+            worker = threading.Thread(target=self._start_one)
+            worker.daemon = True
+            worker.start()
+
+    def _start_one(self):
+        try:
+            self._ready.append(self.factory())
+        except Exception:
+            if self.log:
+                self.log.warning("Could not start a spare interpreter",
+                                 exc_info=True)
+        finally:
+            with self._lock:
+                self._starting -= 1
+
+    def get(self):
+        """Return a ready interpreter and refill the pool, None if none is ready"""
+        interpreter = None
+        while self._ready:
+            candidate = self._ready.popleft()
+            if candidate.child.isalive():
+                interpreter = candidate
+                break
+            candidate.child.close(force=True)
+        self.fill()
+        return interpreter
+
+    def close(self):
+        self.size = 0
+        while self._ready:
+            self._ready.popleft().child.close(force=True)
+
 
 class MPKernelUnix(Kernel):
     """
@@ -81,10 +531,143 @@ class MPKernelUnix(Kernel):
                     'pygments_lexer': 'python3',
                     }
 
+    stream_output = Bool(True, help="""Send output to the frontend while a
+        cell is still running instead of once it has finished""").tag(config=True)
+    stream_interval = Float(0.05, help="""Longest time in seconds that streamed
+        output is held back before it is sent""").tag(config=True)
+    stream_max_bytes = Integer(4096, help="""Number of pending characters that
+        triggers an immediate send of streamed output""").tag(config=True)
+    output_head_bytes = Integer(65536, help="""Characters of a cell's output
+        shown before the rest goes to a log file, of which only the last
+        output_tail_bytes are shown, 0 for no limit""").tag(config=True)
+    output_tail_bytes = Integer(8192, help="""Characters shown from the end of
+        a cell's output once it overflows""").tag(config=True)
+    output_log_dir = Unicode('mpkernel_output', help="""Directory of the log
+        files of cells whose output overflows, relative to the kernel's
+        working directory""").tag(config=True)
+    micropython_exe = Unicode('micropython', help="""The micropython
+        executable, with any arguments""").tag(config=True)
+    pool_size = Integer(1, help="""Number of spare interpreters kept started
+        so that a restart does not wait for a new one, 0 to disable""").tag(config=True)
+    raw_repl = Bool(True, help="""Run cells in a single raw REPL exchange
+        when the interpreter supports it, instead of a compile and an exec
+        round trip at the normal prompt""").tag(config=True)
+    precompile = Bool(False, help="""Compile cells to .mpy bytecode on the
+        host with mpy-cross and import them, instead of sending the source.
+        Functions defined in such a cell see the globals as they were when
+        the cell ran""").tag(config=True)
+    mpy_cross = Unicode('mpy-cross', help="""The mpy-cross executable, with
+        any arguments; its bytecode version must match micropython_exe""").tag(config=True)
+    mpy_cache_dir = Unicode('', help="""Directory of compiled cells, by default
+        ~/.cache/mpkernel/mpy""").tag(config=True)
+    mpy_cache_size = Integer(16 * 1024 * 1024, help="""Size in bytes above which
+        the least recently used compiled cells are removed""").tag(config=True)
+
+    metrics_file = Unicode('', help="""File the cell timing metrics are
+        written to after each cell, in the Prometheus text format""").tag(config=True)
+    metrics_port = Integer(0, help="""Serve the cell timing metrics at
+        http://127.0.0.1:<port>/metrics, 0 to disable""").tag(config=True)
+    completion_cache_size = Integer(256, help="""Number of interpreter objects
+        whose names are kept for completion and inspection""").tag(config=True)
+    cell_log_bytes = Integer(1024 * 1024, help="""Source of the successful cells
+        kept for %restore to replay after a restart, 0 for no limit""").tag(config=True)
+    pipeline_cells = Integer(0, help="""Cells queued behind the one being run,
+        as in Run All, sent to the interpreter along with it as a single
+        program whose output is split between them as it arrives, so they
+        do not each wait for a round trip. 0 to run cells one at a
+        time""").tag(config=True)
+    capture_dir = Unicode('', help="""Directory to record every byte read from
+        and written to the interpreters in, with its time, one capture file per
+        interpreter that python -m mpkernel.capture can summarize or replay in
+        place of micropython_exe; empty to disable""").tag(config=True)
+    heap_usage = Bool(False, help="""Measure the interpreter's heap before and
+        after each cell, in the same exchange, for the reply metadata and
+        %memtrace""").tag(config=True)
+    parallel_workers = Integer(0, help="""Interpreters %%parallel runs a cell
+        on at once, 0 for one per core""").tag(config=True)
+
+    # Answered straight away, even while a cell is running
+    concurrent_requests = frozenset(['complete_request', 'inspect_request',
+                                     'is_complete_request', 'kernel_info_request'])
+
     def __init__(self, **kwargs):
         Kernel.__init__(self, **kwargs)
-        self.micropython_exe = 'micropython'
-        self.start_interpreter()
+        self.mpy_cache = None
+        if self.precompile:
+            self.mpy_cache = mpy.MpyCache(self.mpy_cache_dir or None,
+                                          max_bytes=self.mpy_cache_size,
+                                          mpy_cross=self.mpy_cross)
+        self.shutting_down = False
+        self.metrics = Metrics({'kernel': 'unix'})
+        # Times the phases of the cell being run
+        self.timer = None
+        # Set while a cell runs, when completions come from the cache only
+        self.executing = False
+        self.completions = NamespaceCache(self._query, self.completion_cache_size)
+        # The cells that succeeded in the interpreter, and those that did
+        # before it was last restarted, which %restore runs again
+        self.cell_log = CellLog(self.cell_log_bytes)
+        self.lost_cells = CellLog(self.cell_log_bytes)
+        # The micropython_exe commands found to have no raw REPL, which later
+        # interpreters are not probed for, since the probe waits for a timeout
+        self._no_raw_repl = set()
+        self.pool = InterpreterPool(self._new_interpreter, self.pool_size,
+                                    log=self.log)
+        # The interpreter starts while the kernel sets up its sockets, and
+        # the first cell waits for it
+        self._interpreter = None
+        self._starting = background(self._first_interpreter)
+        # The content of the execute requests received and not yet handled,
+        # by msg_id in the order they arrived, for pipelining
+        self.queued = collections.OrderedDict()
+        # The cells sent to the interpreter together whose output is still
+        # being read
+        self.pipeline = None
+        # The heap usage of the cells, once measured, and of the cell being run
+        self._heap_trace = None
+        self.heap = None
+        # The interpreters %%parallel runs cells on, kept between cells, and
+        # the command they were started with
+        self.workers = []
+        self._worker_command = None
+
+    @property
+    def heap_trace(self):
+        """The :class:`~mpkernel.heap.HeapTrace` of the cells"""
+        if self._heap_trace is None:
+            from mpkernel.heap import HeapTrace
+            self._heap_trace = HeapTrace()
+        return self._heap_trace
+
+    @property
+    def interpreter(self):
+        """The running interpreter, waiting for it if it is still starting"""
+        if self._interpreter is None:
+            self._interpreter = self._starting.result()
+            if self.raw_repl and not self._interpreter.raw:
+                self.log.info("No raw REPL, running cells through compile and exec")
+        return self._interpreter
+
+    @interpreter.setter
+    def interpreter(self, interpreter):
+        self._interpreter = interpreter
+
+    def _first_interpreter(self):
+        interpreter = self._new_interpreter()
+        # Spares are only started once the first interpreter is running
+        self.pool.fill()
+        return interpreter
+
+    async def _wait_for_interpreter(self):
+        """Wait for the interpreter started in the background without
+        blocking the IOLoop, starting another if it failed"""
+        if self._interpreter is not None:
+            return
+        try:
+            await asyncio.wrap_future(self._starting)
+        except Exception:
+            self._starting = background(self._first_interpreter)
+            raise
 
     def start_interpreter(self):
         # Signal handlers are inherited by forked processes, we can't easily
@@ -93,77 +676,749 @@ class MPKernelUnix(Kernel):
         # so that bash and its children are interruptible.
         sig = signal.signal(signal.SIGINT, signal.SIG_DFL)
         try:
-            self.interpreter = MPUnixInterpreter(self.micropython_exe)
+            self.interpreter = self._new_interpreter()
         finally:
             signal.signal(signal.SIGINT, sig)
+        if self.raw_repl and not self.interpreter.raw:
+            self.log.info("No raw REPL, running cells through compile and exec")
 
-    def do_execute(self, code, silent, store_history=True,
-                   user_expressions=None, allow_stdin=False):
+    def _new_interpreter(self):
+        recorder = None
+        if self.capture_dir:
+            from mpkernel import capture
+            recorder = capture.Capture(capture.capture_path(self.capture_dir, 'unix'),
+                                       'spawn {}'.format(self.micropython_exe))
+        interpreter = MPUnixInterpreter(self.micropython_exe, capture=recorder)
+        if self.raw_repl and self.micropython_exe not in self._no_raw_repl:
+            if not interpreter.enter_raw_repl():
+                self._no_raw_repl.add(self.micropython_exe)
+        return interpreter
 
-        if not code.strip():
-            return {
-                'status': 'ok',
-                'execution_count': self.execution_count,
-                'payload': [],
-                'user_expressions': {},
-            }
+    def restart_interpreter(self):
+        """Recover from a failed cell with the cheapest option that works.
+
+        A live interpreter is soft reset, otherwise it is replaced by a spare
+        from the pool, and only if there is none is a new one started. Unless
+        a soft reset at the normal prompt kept the interpreter's state, the
+        cells logged since it was last lost move to ``lost_cells`` for
+        %restore.
+
+        :return: How the interpreter was recovered.
+        """
+        start = time.time()
+        old = self.interpreter
+        lost = old.raw
+        if old.soft_reset():
+            kind, how = 'soft_reset', 'soft reset'
+        else:
+            lost = True
+            spare = self.pool.get()
+            if spare is not None:
+                self.interpreter = spare
+                kind, how = 'spare', 'swapped in a spare interpreter'
+            else:
+                self.start_interpreter()
+                kind, how = 'respawn', 'started a new interpreter'
+        elapsed = time.time() - start
+        if self.interpreter is not old:
+            old.child.close(force=True)
+        self.completions.clear()
+        if lost:
+            self.lost_cells.extend(self.cell_log)
+            self.cell_log.clear()
+        self.metrics.observe('restart', elapsed, how=kind)
+        self.log.info("Interpreter restart (%s) took %.1f ms", how, elapsed * 1000)
+        how = '{} in {:.1f} ms'.format(how, elapsed * 1000)
+        if self.lost_cells:
+            how += ', run %restore to replay {} cells'.format(len(self.lost_cells))
+        return how
+
+    def start(self):
+        super(MPKernelUnix, self).start()
+        if self.metrics_port:
+            self.metrics.serve(self.metrics_port)
+
+    def init_metadata(self, parent):
+        self.timer = CellTimer(queue=seconds_since(parent['header'].get('date')))
+        return super(MPKernelUnix, self).init_metadata(parent)
+
+    def finish_metadata(self, parent, metadata, reply_content):
+        """Add the cell's timings and heap usage to the reply metadata, and
+        the timings to the metrics"""
+        metadata = super(MPKernelUnix, self).finish_metadata(parent, metadata, reply_content)
+        if self.heap is not None:
+            metadata['heap'] = self.heap.as_dict()
+            self.heap = None
+        if self.timer is not None:
+            metadata['timings'] = self.timer.as_dict()
+            self.metrics.record(self.timer, reply_content.get('status'))
+            if self.metrics_file:
+                self.metrics.write(self.metrics_file)
+            self.timer = None
+        return metadata
+
+    async def shell_main(self, subshell_id, msg):
+        """Dispatch ``concurrent_requests`` without waiting for a running cell,
+        and keep track of the execute requests waiting for it"""
+        queued = None
+        if CONCURRENT_DISPATCH and subshell_id is None and self.session is not None and (
+                self.pipeline_cells or self._main_asyncio_lock.locked()):
+            try:
+                _, frames = self.session.feed_identities(msg, copy=False)
+                message = self.session.deserialize(frames, content=False, copy=False)
+                header = message['header']
+            except Exception:
+                header = {}
+            if header.get('msg_type') in self.concurrent_requests and \
+                    self._main_asyncio_lock.locked():
+                # Dispatch sets the parent message, which the running cell's
+                # output must keep, so it runs in a copy of the context
+                await asyncio.create_task(
+                    self.dispatch_shell(msg, subshell_id=subshell_id, concurrent=True),
+                    context=contextvars.copy_context())
+                return
+            if header.get('msg_type') == 'execute_request' and self.pipeline_cells:
+                queued = header['msg_id']
+                self.queued[queued] = self.session.unpack(message['content'])
+        try:
+            await super(MPKernelUnix, self).shell_main(subshell_id, msg)
+        finally:
+            if queued is not None:
+                self.queued.pop(queued, None)
+
+    def do_shutdown(self, restart):
+        self.shutting_down = True
+        self.pool.close()
+        self._close_workers()
+        try:
+            self.interpreter.child.close(force=True)
+        except Exception:
+            # It never started
+            pass
+        return {'status': 'ok', 'restart': restart}
+
+    def _send_stdout(self, text):
+        stream_content = {'name': 'stdout', 'text': text}
+        self.send_response(self.iopub_socket, 'stream', stream_content)
+
+    def _output_stream(self, silent):
+        """Return where output goes while a cell runs, and the limit on what
+        reaches the notebook, which must be closed once the cell finishes"""
+        display_id = uuid.uuid4().hex
+
+        def display(bundle, update):
+            content = {'data': bundle, 'metadata': {}, 'transient': {'display_id': display_id}}
+            self.send_response(self.iopub_socket,
+                               'update_display_data' if update else 'display_data', content)
+
+        path = os.path.join(self.output_log_dir, 'cell-{}-{}.log'.format(
+            time.strftime('%Y%m%d-%H%M%S'), self.execution_count))
+        if silent:
+            limit = OutputLimit(lambda text: None, display, path, head_bytes=0)
+        else:
+            limit = OutputLimit(self._send_stdout, display, path,
+                                head_bytes=self.output_head_bytes,
+                                tail_bytes=self.output_tail_bytes,
+                                interval=max(self.stream_interval, 0.5),
+                                live=self.stream_output)
+        stream = OutputStream(limit.write, interval=self.stream_interval,
+                              max_bytes=self.stream_max_bytes)
+        return stream, limit
+
+    def _precompiled(self, code):
+        """Return the command importing the cell compiled to .mpy, or None
+        if mpy-cross cannot be run"""
+        source = mpy.cell_source(code)
+        try:
+            path = self.mpy_cache.compile(source)
+        except OSError as e:
+            self.log.warning("Could not run %s (%s), sending cells as source",
+                             self.mpy_cross, e)
+            self.mpy_cache = None
+            return None
+        return mpy.loader(os.path.dirname(path), self.mpy_cache.module_name(source))
+
+    async def _follow_cell(self, reader, stream):
+        """Relay a running cell's output to ``stream`` until ``reader`` is done.
+
+        While the cell runs an interrupt (SIGINT) is passed on to the
+        interpreter as Ctrl-C, and the time until its prompt returns goes
+        into the ``interrupt`` latency of the metrics.
+        """
+        interpreter = self.interpreter
+        interrupted = []
+
+        def interrupt(signum, frame):
+            interrupted.append(time.time())
+            interpreter.child.sendintr()
+
+        previous = signal.signal(signal.SIGINT, interrupt)
+        try:
+            await interpreter.follow_async(reader, stream, self.stream_interval)
+        finally:
+            signal.signal(signal.SIGINT, previous)
+            if interrupted:
+                latency = time.time() - interrupted[0]
+                self.metrics.observe('interrupt', latency)
+                self.log.info("Interrupted a cell in %.1f ms", latency * 1000)
+
+    def _query(self, program):
+        """Run a completion query, returning its output or ''"""
+        if self._interpreter is None or self.pipeline is not None:
+            # Not started, or still running the rest of a pipeline
+            return ''
+        try:
+            if not self.interpreter.raw:
+                return self.interpreter.run_command('exec({0!r})'.format(program),
+                                                    timeout=2) or ''
+            output = io.StringIO()
+            if self.interpreter.exec_raw(program, output, timeout=2):
+                return ''
+            return output.getvalue()
+        except TIMEOUT as e:
+            self.log.warning("Completion query timed out: %s", e)
+            self.interpreter.interrupt()
+        except (EOF, ValueError) as e:
+            self.log.warning("Completion query failed: %r", e)
+        return ''
+
+    async def do_complete(self, code, cursor_pos):
+        """Complete names in the interpreter, from the cache where possible"""
+        matches, start = self.completions.complete(code, cursor_pos,
+                                                   query=not self.executing)
+        return {'status': 'ok', 'matches': matches, 'cursor_start': start,
+                'cursor_end': cursor_pos, 'metadata': {}}
+
+    async def do_inspect(self, code, cursor_pos, detail_level=0, omit_sections=()):
+        text = self.completions.inspect(code, cursor_pos, query=not self.executing)
+        return {'status': 'ok', 'found': text is not None, 'metadata': {},
+                'data': {'text/plain': text} if text else {}}
+
+    async def do_execute(self, code, silent, store_history=True,
+                         user_expressions=None, allow_stdin=False):
+        self.executing = True
+        try:
+            return await self._execute(code, silent)
+        finally:
+            self.executing = False
+            self.completions.invalidate()
+
+    def _reply(self, status, error=None, timer=None, stream=None):
+        """Return the content of a cell's execute_reply, sending its error
+        if it failed, once its output has been flushed
+
+        :param str status: 'ok', 'error', 'interrupted' or 'abort'.
+        :param tuple error: The ename, evalue and traceback of an error.
+        :param timer: The cell's :class:`~mpkernel.metrics.CellTimer`, given
+          the time ``stream`` spent relaying output.
+        """
+        if timer is not None and stream is not None:
+            timer.add('relay', stream.send_seconds)
+        reply = {'status': status, 'execution_count': self.execution_count}
+        if status == 'error':
+            ename, evalue, traceback = error
+            err = {'ename': ename, 'evalue': evalue, 'traceback': traceback}
+            self.send_response(self.iopub_socket, 'error', err)
+            reply.update(err)
+        elif status == 'ok':
+            reply.update({'payload': [], 'user_expressions': {}})
+        elif status not in ('interrupted', 'abort'):
+            raise ValueError("Invalid status: %r" % status)
+        return reply
+
+    async def _execute(self, code, silent):
 
+        if not code.strip():
+            return self._reply('ok')
+        magic = magic_name(code)
+        if magic == '%memtrace':
+            return self._memtrace(code, silent)
+        try:
+            await self._wait_for_interpreter()
+        except Exception as e:
+            self.log.error("Could not start %s: %s", self.micropython_exe, e)
+            return self._reply('error', (type(e).__name__, str(e), [
+                'Could not start {}: {}'.format(self.micropython_exe, e)]))
         status = 'ok'
         traceback = None
+        ename, evalue = 'ename', 'evalue'
 
+        interpreter = self.interpreter
+        if interpreter.capture is not None:
+            interpreter.capture.note('cell {}'.format(self.execution_count))
+        timer = self.timer or CellTimer()
+        stream, limit = self._output_stream(silent)
+        output = ''
+        # Set if the cell is not to be logged for %restore though its status
+        # is ok: it failed at the normal prompt, or the interpreter restarted
+        failed = False
+        pipelined = False
+        probed = self.heap_usage
+        probe = stream
+        if probed:
+            from mpkernel.heap import HeapFilter
+            probe = HeapFilter(stream)
         try:
-            # compile the code then run an exec of that code object
-            compile_output = self.interpreter.run_command("c = compile({0!r}, 'mpkernel', 'exec')".format(code), timeout=5)
-            if compile_output is not None:
-                output = self.interpreter.run_command('exec(c)', timeout=5)
+            if self.pipeline is not None and self.pipeline.next_id != self._msg_id():
+                await self._drop_pipeline()
+            if code.strip() == '%restore':
+                limit.close()
+                return await self._restore(silent)
+            handler = {'%%parallel': self._parallel, '%%mprof': self._mprof,
+                       '%timeit': self._timeit, '%%timeit': self._timeit}.get(magic)
+            if handler is not None:
+                limit.close()
+                return await handler(code, silent)
+            command = None
+            if self.mpy_cache:
+                with timer.phase('compile'):
+                    command = self._precompiled(code)
+            if interpreter.raw:
+                reader = self._pipelined(code, silent, timer)
+                pipelined = reader is not None
+                if not pipelined:
+                    with timer.phase('transfer'):
+                        interpreter.send_raw(self._program(command or code), timeout=5)
+                    reader = RawReplReader()
+            else:
+                if command:
+                    line = 'exec({0!r})'.format(self._program(command))
+                else:
+                    # Compiled and run in one line, so the IOLoop is not
+                    # blocked waiting for a separate compile
+                    line = "exec(compile({0!r}, 'mpkernel', 'exec'))".format(
+                        self._program(code))
+                with timer.phase('transfer'):
+                    reader = interpreter.send_line(line)
+            with timer.phase('exec'):
+                await self._follow_cell(reader, probe)
+            if probed:
+                probe.close()
+                self.heap = probe.usage
+                if probe.usage is not None:
+                    self.heap_trace.add(self.execution_count, probe.usage)
+            if pipelined and not getattr(reader, 'ended', True):
+                interpreter.unread(reader.rest)
+            elif pipelined:
+                # The pipeline ended with this cell
+                self.pipeline = None
+            if interpreter.raw:
+                error = reader.error
+                if error.strip():
+                    status = 'error'
+                    if command:
+                        error = mpy.fix_line_numbers(error)
+                    if pipelined or probed:
+                        error = fix_traceback(error, int(pipelined) + int(probed))
+                    ename, evalue, traceback = split_exception(error)
             else:
-                raise Exception("Error in compile: ({})\n".format(compile_output))
+                interpreter.check_complete(reader, line)
+                failed = reader.failed
         except KeyboardInterrupt:
-            self.interpreter.child.sendintr()
+            self.pipeline = None
+            self.interpreter.interrupt()
             status = 'interrupted'
-            self.interpreter._expect_prompt()
             output = self.interpreter.output
+        except mpy.MpyCrossError as e:
+            status = 'error'
+            ename, evalue, traceback = split_exception(mpy.fix_line_numbers(str(e)))
         except ValueError:
-            output = self.interpreter.output + 'Incomplete input, restarting'
-            self.start_interpreter()
+            self.pipeline = None
+            failed = True
+            output = self.interpreter.output + 'Incomplete input, restarting ({})'.format(
+                self.restart_interpreter())
         except EOF:
-            output = self.interpreter.output + ' Restarting MPKernelUnix'
-            self.start_interpreter()
+            self.pipeline = None
+            if self.shutting_down:
+                limit.close()
+                return self._reply('abort')
+            output = self.interpreter.output + ' Restarting MPKernelUnix ({})'.format(
+                self.restart_interpreter())
             status = 'error'
             traceback = []
+        stream.flush()
+        limit.close()
 
         if not self.interpreter.child.isalive():
             self.log.error("MPKernelUnix interpreter died")
             loop = IOLoop.current()
             loop.add_callback(loop.stop)
 
-        if not silent:
+        if not silent and output:
             # Send output on stdout
-            stream_content = {'name': 'stdout', 'text': output}
-            self.send_response(self.iopub_socket, 'stream', stream_content)
+            self._send_stdout(output)
+
+        if status == 'ok' and not failed:
+            self.cell_log.record(code)
+        return self._reply(status, (ename, evalue, traceback), timer, stream)
+
+    def _program(self, code):
+        """Return what is sent to run ``code``, measuring the heap around it
+        if heap_usage is set"""
+        if not self.heap_usage:
+            return code
+        from mpkernel import heap
+        return heap.probe(code)
 
-        reply = {
-            'status': status,
-            'execution_count': self.execution_count,
-        }
+    def _msg_id(self):
+        return self.get_parent('shell').get('header', {}).get('msg_id')
 
-        if status == 'interrupted':
+    def _pipelined(self, code, silent, timer):
+        """Return the reader of the cell's output if it runs in a pipeline,
+        first sending the pipeline if the cell starts one, otherwise None"""
+        if self.pipeline is not None:
+            reader = self.pipeline.reader()
+            if self.pipeline.next_id is None:
+                self.pipeline = None
+            return reader
+        msg_id = self._msg_id()
+        content = self.queued.get(msg_id)
+        if (not self.pipeline_cells or self.mpy_cache or silent or content is None or
+                not content.get('stop_on_error', True)):
+            return None
+        requests = [(msg_id, self._program(code))]
+        ids = list(self.queued)
+        for other in ids[ids.index(msg_id) + 1:]:
+            if len(requests) > self.pipeline_cells:
+                break
+            content = self.queued[other]
+            other_code = content.get('code', '')
+            if not other_code.strip():
+                # Answered without reaching the interpreter
+                continue
+            if (content.get('silent') or not content.get('stop_on_error', True) or
+                    other_code.lstrip().startswith('%')):
+                break
+            requests.append((other, self._program(other_code)))
+        if len(requests) == 1:
+            return None
+        from mpkernel.pipeline import Pipeline
+        pipeline = Pipeline(requests)
+        with timer.phase('transfer'):
+            self.interpreter.send_raw(pipeline.program(), timeout=5)
+        self.log.debug("Sent %d cells as a pipeline", len(pipeline))
+        self.pipeline = pipeline
+        return pipeline.reader()
+
+    async def _drop_pipeline(self):
+        """Let the rest of a pipeline whose cells will not be asked for run to
+        the end, discarding its output"""
+        pipeline, self.pipeline = self.pipeline, None
+        self.log.warning("Discarding the output of %d pipelined cells",
+                         len(pipeline) - pipeline.position)
+        await self._follow_cell(RawReplReader(), io.StringIO())
+
+    def _memtrace(self, code, silent):
+        """Show the heap usage of the cells run so far, or turn measuring it
+        on or off"""
+        from mpkernel import heap
+        try:
+            args = heap.memtrace_args(split_magic(code)[1])
+        except MagicError as e:
+            return self._reply('error', ('UsageError', str(e), ['UsageError: {}'.format(e)]))
+        if args.action == 'clear':
+            text = 'Cleared the heap usage of {} cells\n'.format(len(self.heap_trace))
+            self.heap_trace.clear()
+        elif args.action:
+            self.heap_usage = args.action == 'on'
+            text = 'Heap usage is {} measured\n'.format('now' if self.heap_usage else 'no longer')
+        if silent:
             pass
-        elif status == 'error':
-            err = {
-                'ename': 'ename',
-                'evalue': 'evalue',
-                'traceback': traceback,
-            }
-            self.send_response(self.iopub_socket, 'error', err)
-            reply.update(err)
-        elif status == 'ok':
-            reply.update({
-                'payload': [],
-                'user_expressions': {},
-            })
+        elif args.action:
+            self._send_stdout(text)
         else:
-            raise ValueError("Invalid status: %r" % status)
+            self.send_response(self.iopub_socket, 'display_data', {
+                'data': self.heap_trace.view(args.leak, args.fragmentation), 'metadata': {}})
+        return self._reply('ok')
 
-        return reply
+    async def _restore(self, silent):
+        """Run the cells that succeeded before the interpreter was last
+        restarted again, in a single exchange"""
+        lost = self.lost_cells
+        timer = self.timer or CellTimer()
+        stream, limit = self._output_stream(silent)
+        interpreter = self.interpreter
+        restored = None
+        error = ''
+        start = time.time()
+        if lost:
+            # The cells' output was seen when they first ran
+            output = io.StringIO()
+            try:
+                program = lost.program()
+                line = None
+                if interpreter.raw:
+                    with timer.phase('transfer'):
+                        interpreter.send_raw(program, timeout=5)
+                    reader = RawReplReader()
+                else:
+                    line = 'exec({0!r})'.format(program)
+                    with timer.phase('transfer'):
+                        reader = interpreter.send_line(line)
+                with timer.phase('exec'):
+                    await self._follow_cell(reader, output)
+                if line is None:
+                    error = reader.error
+                else:
+                    interpreter.check_complete(reader, line)
+                restored = lost.replayed(output.getvalue())
+                error = error or output.getvalue()[-1000:]
+            except KeyboardInterrupt:
+                interpreter.interrupt()
+                error = 'Interrupted'
+            except (EOF, ValueError):
+                if self.shutting_down:
+                    limit.close()
+                    return self._reply('abort')
+                error = 'The interpreter died, restarting ({})'.format(
+                    self.restart_interpreter())
+        elapsed = time.time() - start
+
+        if not lost:
+            stream.write('No cells to restore\n')
+        elif restored is None:
+            stream.write('Restore failed: {}\n'.format(error.strip()))
+        else:
+            self.log.info("Restored %d of %d cells in %.1f ms",
+                          len(restored), len(lost), elapsed * 1000)
+            stream.write('Restored {} of {} cells ({:.1f} KB) in {:.1f} ms\n'.format(
+                len(restored), len(lost), lost.size / 1024.0, elapsed * 1000))
+            if len(restored) < len(lost):
+                stream.write('{} cells failed and were left out\n'.format(
+                    len(lost) - len(restored)))
+            if lost.truncated:
+                stream.write('Cells past cell_log_bytes were not recorded '
+                             'and were not restored\n')
+            restored.extend(self.cell_log)
+            self.cell_log = restored
+            lost.clear()
+        stream.flush()
+        limit.close()
+        if lost and restored is None:
+            return self._reply('error', ('RestoreError', error.strip(), []), timer, stream)
+        return self._reply('ok', timer=timer, stream=stream)
 
+    def _new_worker(self, command):
+        worker = MPUnixInterpreter(command)
+        if not worker.enter_raw_repl():
+            worker.child.close(force=True)
+            raise MagicError('%%parallel needs an interpreter with a raw REPL')
+        return worker
+
+    async def _workers(self, count, options):
+        """Return ``count`` workers started with the ``-X`` ``options``,
+        starting those missing at once"""
+        command = ' '.join([self.micropython_exe] + ['-X ' + o for o in options])
+        if command != self._worker_command:
+            self._close_workers()
+            self._worker_command = command
+        for worker in self.workers:
+            if not worker.child.isalive():
+                worker.child.close(force=True)
+        self.workers = [worker for worker in self.workers if worker.child.isalive()]
+        starting = [background(self._new_worker, command)
+                    for _ in range(count - len(self.workers))]
+        for future in starting:
+            self.workers.append(await asyncio.wrap_future(future))
+        return self.workers[:count]
+
+    def _close_workers(self):
+        for worker in self.workers:
+            worker.child.close(force=True)
+        self.workers = []
+
+    async def _run_cell_program(self, program, stream):
+        """Run a program of the kernel's own in the interpreter, returning
+        its error"""
+        self.interpreter.send_raw(program, timeout=5)
+        reader = RawReplReader()
+        await self._follow_cell(reader, stream)
+        return reader.error
+
+    async def _parallel_worker(self, worker, run, body, stream):
+        """Run the inputs of ``run`` on one worker until there are none left"""
+        from mpkernel import parallel
+        error = await self._worker_exchange(worker, parallel.SETUP.format(cell=body),
+                                            io.StringIO())
+        if error.strip():
+            # A syntax error, which every worker finds
+            run.errors.setdefault(-1, error)
+            return
+        while True:
+            index = run.take()
+            if index is None:
+                return
+            output = io.StringIO()
+            error = await self._worker_exchange(worker, run.program(index), output)
+            run.finish(index, output.getvalue(), error)
+            stream.write(run.ready())
+
+    async def _worker_exchange(self, worker, program, stream):
+        try:
+            worker.send_raw(program, timeout=5)
+            reader = RawReplReader()
+            await worker.follow_async(reader, stream, self.stream_interval)
+        except (EOF, TIMEOUT, ValueError) as e:
+            worker.child.close(force=True)
+            return 'The worker interpreter died: {!r}'.format(e)
+        return reader.error
+
+    async def _parallel(self, code, silent):
+        """Run a %%parallel cell on the workers, once for each input"""
+        from mpkernel import parallel
+        timer = self.timer or CellTimer()
+        stream, limit = self._output_stream(silent)
+        status = 'ok'
+        ename = evalue = None
+        traceback = []
+        run = None
+        start = time.time()
+        previous = None
+        try:
+            _, line, body = split_magic(code)
+            target, expression, args = parallel.parallel_args(line)
+            if not self.interpreter.raw:
+                raise MagicError('%%parallel needs an interpreter with a raw REPL')
+            count = args.workers or self.parallel_workers or os.cpu_count() or 1
+            if expression is None:
+                # Once on each worker
+                target, values = 'worker', [repr(i) for i in range(count)]
+            else:
+                output = io.StringIO()
+                with timer.phase('transfer'):
+                    error = await self._run_cell_program(
+                        parallel.INPUTS.format(expression=expression), output)
+                if error.strip():
+                    raise MagicError('Could not evaluate the inputs: {}'.format(
+                        split_exception(error)[1] or error.strip()))
+                values = parallel.parse_inputs(output.getvalue())
+            run = parallel.ParallelRun(target, values)
+            with timer.phase('connect'):
+                workers = await self._workers(min(count, len(run)) or 1, args.options)
+
+            def interrupt(signum, frame):
+                run.stopped = True
+                for worker in workers:
+                    worker.child.sendintr()
+
+            previous = signal.signal(signal.SIGINT, interrupt)
+            with timer.phase('exec'):
+                await asyncio.gather(*[self._parallel_worker(worker, run, body, stream)
+                                       for worker in workers])
+            stream.write(run.ready())
+            results = run.results_program(args.output)
+            if run.stopped:
+                status, ename, evalue = 'error', 'KeyboardInterrupt', ''
+                traceback = ['KeyboardInterrupt']
+            elif run.error is not None:
+                index, error = run.error
+                status = 'error'
+                ename, evalue, traceback = split_exception(fix_traceback(error))
+                if index >= 0:
+                    traceback.insert(0, 'In the run with {} = {}'.format(target, run.values[index]))
+            elif results is not None:
+                error = await self._run_cell_program(results, io.StringIO())
+                if error.strip():
+                    status = 'error'
+                    ename, evalue, traceback = split_exception(error)
+        except MagicError as e:
+            status, ename, evalue = 'error', 'UsageError', str(e)
+            traceback = ['UsageError: {}'.format(e)]
+        except TIMEOUT as e:
+            status, ename, evalue = 'error', type(e).__name__, str(e)
+            traceback = ['{}: {}'.format(ename, evalue)]
+        except (EOF, ValueError):
+            # The interpreter died while the inputs or results were evaluated
+            status, ename, evalue = 'error', 'EOF', ''
+            traceback = ['The interpreter died, restarting ({})'.format(
+                self.restart_interpreter())]
+        finally:
+            if previous is not None:
+                signal.signal(signal.SIGINT, previous)
+        stream.flush()
+        limit.close()
+        if run is not None:
+            self.log.info("Ran %d inputs on %d workers in %.1f ms", len(run),
+                          len(self.workers), (time.time() - start) * 1000)
+        return self._reply(status, (ename, evalue, traceback), timer, stream)
+
+    async def _mprof(self, code, silent):
+        """Run a %%mprof cell with its probes and show the profile"""
+        from mpkernel import mprof
+        timer = self.timer or CellTimer()
+        stream, limit = self._output_stream(silent)
+        status = 'ok'
+        ename = evalue = None
+        traceback = []
+        try:
+            _, line, body = split_magic(code)
+            args = mprof.mprof_args(line)
+            if not self.interpreter.raw:
+                raise MagicError('%%mprof needs an interpreter with a raw REPL')
+            instrumented = mprof.Instrumented(body, functions=args.functions)
+            probe = RecordFilter(stream, mprof.MARKER, mprof.END)
+            with timer.phase('exec'):
+                error = await self._run_cell_program(instrumented.program(), probe)
+            probe.close()
+            profile = instrumented.profile(probe.record)
+            if profile is not None and not silent:
+                stream.flush()
+                self.send_response(self.iopub_socket, 'display_data', {
+                    'data': {'text/plain': profile.table(args.rows, args.sort)},
+                    'metadata': {'mprof': profile.as_dict()}})
+            if error.strip():
+                status = 'error'
+                ename, evalue, traceback = split_exception(
+                    instrumented.fix_traceback(fix_traceback(error)))
+        except MagicError as e:
+            status, ename, evalue = 'error', 'UsageError', str(e)
+            traceback = ['UsageError: {}'.format(e)]
+        except (EOF, ValueError):
+            status, ename, evalue = 'error', 'EOF', ''
+            traceback = ['The interpreter died, restarting ({})'.format(
+                self.restart_interpreter())]
+        stream.flush()
+        limit.close()
+        if status == 'ok':
+            self.cell_log.record(body)
+        return self._reply(status, (ename, evalue, traceback), timer, stream)
+
+    async def _timeit(self, code, silent):
+        """Time the statement of a %timeit or %%timeit cell in the interpreter"""
+        from mpkernel import timeit
+        timer = self.timer or CellTimer()
+        stream, limit = self._output_stream(silent)
+        status = 'ok'
+        ename = evalue = None
+        traceback = []
+        try:
+            _, line, body = split_magic(code)
+            if not self.interpreter.raw:
+                raise MagicError('%timeit needs an interpreter with a raw REPL')
+            timing = timeit.Timeit(line, body if magic_name(code) == '%%timeit' else None,
+                                   target=self.micropython_exe)
+            probe = RecordFilter(stream, timeit.MARKER, timeit.END)
+            with timer.phase('exec'):
+                error = await self._run_cell_program(timing.source, probe)
+            probe.close()
+            result = timing.result(probe.record)
+            if error.strip():
+                status = 'error'
+                ename, evalue, traceback = split_exception(timing.fix_traceback(error))
+            elif result is None:
+                raise MagicError('The interpreter sent no timings')
+            else:
+                stream.write(str(result) + '\n')
+                comparison = timing.save(result)
+                if comparison:
+                    stream.write(comparison + '\n')
+        except MagicError as e:
+            status, ename, evalue = 'error', 'UsageError', str(e)
+            traceback = ['UsageError: {}'.format(e)]
+        except (EOF, ValueError):
+            status, ename, evalue = 'error', 'EOF', ''
+            traceback = ['The interpreter died, restarting ({})'.format(
+                self.restart_interpreter())]
+        stream.flush()
+        limit.close()
+        return self._reply(status, (ename, evalue, traceback), timer, stream)